@@ -134,11 +134,14 @@ class Agent(Daemon):
         # if no check was given, reload them all
         if not checks_to_reload:
             log.debug("No check list was passed, reloading every check")
-            # stop checks
-            for check in self._checksd.get('initialized_checks', []):
-                check.stop()
-
+            previous_checks = self._checksd.get('initialized_checks', [])
             self._checksd = load_check_directory(self._agentConfig, hostname)
+
+            # stop the checks that have been replaced, the unchanged ones are kept
+            kept_checks = set(id(check) for check in self._checksd['initialized_checks'])
+            for check in previous_checks:
+                if id(check) not in kept_checks:
+                    check.stop()
             if self._jmx_service_discovery_enabled:
                 jmx_sd_configs = generate_jmx_configs(self._agentConfig, hostname)
         else:
@@ -317,6 +320,11 @@ class Agent(Daemon):
         profiled = False
         collector_profiled_runs = 0
 
+        # The collector runs on a fixed cadence: every `check_frequency` seconds
+        # from the first run, however long each run takes
+        next_run_time = time.time()
+        overrun_count = 0
+
         # Run the main loop.
         while self.run_forever:
             # Setup profiling if necessary
@@ -348,7 +356,9 @@ class Agent(Daemon):
             # look for the AgentMetrics check and pop it out.
             self.collector.run(checksd=self._checksd,
                                start_event=self.start_event,
-                               configs_reloaded=True if self.reload_configs_flag else False)
+                               configs_reloaded=True if self.reload_configs_flag else False,
+                               scheduled_time=next_run_time,
+                               overrun_count=overrun_count)
 
             self.reload_configs_flag = False
 
@@ -390,8 +400,11 @@ class Agent(Daemon):
                     watchdog.reset()
                 if profiled:
                     collector_profiled_runs += 1
-                log.debug("Sleeping for {0} seconds".format(self.check_frequency))
-                time.sleep(self.check_frequency)
+                next_run_time, overrun_count = self._schedule_next_run(next_run_time)
+                sleep_time = next_run_time - time.time()
+                if sleep_time > 0:
+                    log.debug("Sleeping for {0:.2f} seconds".format(sleep_time))
+                    time.sleep(sleep_time)
 
         # Now clean-up.
         try:
@@ -403,6 +416,25 @@ class Agent(Daemon):
         log.info("Exiting. Bye bye.")
         sys.exit(0)
 
+    def _schedule_next_run(self, scheduled_time):
+        """
+        Return the time of the next collector run after the one scheduled at
+        `scheduled_time`, and the number of runs it overran.
+
+        A run that takes longer than `check_frequency` delays the next one,
+        which then starts right away, and the runs it overlaps entirely are
+        skipped so that the next ones stay on the cadence.
+        """
+        next_run_time = scheduled_time + self.check_frequency
+        now = time.time()
+        if now <= next_run_time:
+            return next_run_time, 0
+
+        skipped_runs = int((now - next_run_time) // self.check_frequency)
+        log.warning("Collector run took %.2fs, longer than check_freq (%ss)",
+                    now - scheduled_time, self.check_frequency)
+        return next_run_time + skipped_runs * self.check_frequency, skipped_runs + 1
+
     def _get_emitters(self):
         return [http_emitter]
 
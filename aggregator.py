@@ -3,11 +3,14 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from heapq import heappop, heappush
 import logging
 from time import time
 
 # project
 from checks.metric_types import MetricTypes
+from utils.lru_cache import LRUCache
+from utils.sketch import HeavyHitters, QuantileSketch
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +26,14 @@ log = logging.getLogger(__name__)
 # MetricsBucketAggregator constructor.
 RECENT_POINT_THRESHOLD_DEFAULT = 3600
 
+# Number of (metric name, raw tags) pairs whose context is cached by
+# `Aggregator.get_context`
+DEFAULT_CONTEXT_CACHE_SIZE = 10000
+
+# Number of metric names whose samples and contexts are counted by the
+# telemetry of `MetricsBucketAggregator`
+DEFAULT_TELEMETRY_CAPACITY = 1000
+
 
 class Infinity(Exception):
     pass
@@ -36,22 +47,30 @@ class Metric(object):
     """
     A base metric class that accepts points, slices them into time intervals
     and performs roll-ups within those intervals.
+
+    There's one metric object per context, so subclasses declare their
+    attributes in `__slots__` to keep them small.
     """
+    __slots__ = ('name', 'tags', 'hostname', 'device_name', 'last_sample_time')
 
     def sample(self, value, sample_rate, timestamp=None):
         """ Add a point to the given metric. """
         raise NotImplementedError()
 
-    def flush(self, timestamp, interval):
-        """ Flush all metrics up to the given timestamp. """
+    def flush(self, timestamp, interval, formatter):
+        """ Flush all metrics up to the given timestamp, formatted with `formatter`. """
+        raise NotImplementedError()
+
+    def merge(self, other):
+        """ Merge the points of another metric of the same context into this one. """
         raise NotImplementedError()
 
 
 class Gauge(Metric):
     """ A metric that tracks a value at particular points in time. """
+    __slots__ = ('value', 'timestamp')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
         self.name = name
         self.value = None
         self.tags = tags
@@ -65,10 +84,17 @@ class Gauge(Metric):
         self.last_sample_time = time()
         self.timestamp = timestamp
 
+    def merge(self, other):
+        # Last write wins
+        if other.value is not None and \
+                (self.value is None or other.last_sample_time >= self.last_sample_time):
+            self.value = other.value
+            self.timestamp = other.timestamp
+            self.last_sample_time = other.last_sample_time
 
-    def flush(self, timestamp, interval):
+    def flush(self, timestamp, interval, formatter):
         if self.value is not None:
-            res = [self.formatter(
+            res = [formatter(
                 metric=self.name,
                 timestamp=self.timestamp or timestamp,
                 value=self.value,
@@ -90,10 +116,11 @@ class BucketGauge(Gauge):
     opposed to the time that the sample was collected.
 
     """
+    __slots__ = ()
 
-    def flush(self, timestamp, interval):
+    def flush(self, timestamp, interval, formatter):
         if self.value is not None:
-            res = [self.formatter(
+            res = [formatter(
                 metric=self.name,
                 timestamp=timestamp,
                 value=self.value,
@@ -111,9 +138,9 @@ class BucketGauge(Gauge):
 
 class Count(Metric):
     """ A metric that tracks a count. """
+    __slots__ = ('value',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
         self.name = name
         self.value = None
         self.tags = tags
@@ -125,11 +152,11 @@ class Count(Metric):
         self.value = (self.value or 0) + value
         self.last_sample_time = time()
 
-    def flush(self, timestamp, interval):
+    def flush(self, timestamp, interval, formatter):
         if self.value is None:
             return []
         try:
-            return [self.formatter(
+            return [formatter(
                 metric=self.name,
                 value=self.value,
                 timestamp=timestamp,
@@ -143,9 +170,9 @@ class Count(Metric):
             self.value = None
 
 class MonotonicCount(Metric):
+    __slots__ = ('prev_counter', 'curr_counter', 'count')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
         self.name = name
         self.tags = tags
         self.hostname = hostname
@@ -169,11 +196,11 @@ class MonotonicCount(Metric):
 
         self.last_sample_time = time()
 
-    def flush(self, timestamp, interval):
+    def flush(self, timestamp, interval, formatter):
         if self.count is None:
             return []
         try:
-            return [self.formatter(
+            return [formatter(
                 hostname=self.hostname,
                 device_name=self.device_name,
                 tags=self.tags,
@@ -191,9 +218,9 @@ class MonotonicCount(Metric):
 
 class Counter(Metric):
     """ A metric that tracks a counter value. """
+    __slots__ = ('value',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
         self.name = name
         self.value = 0
         self.tags = tags
@@ -205,10 +232,14 @@ class Counter(Metric):
         self.value += value * int(1 / sample_rate)
         self.last_sample_time = time()
 
-    def flush(self, timestamp, interval):
+    def merge(self, other):
+        self.value += other.value
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def flush(self, timestamp, interval, formatter):
         try:
             value = self.value / interval
-            return [self.formatter(
+            return [formatter(
                 metric=self.name,
                 value=value,
                 timestamp=timestamp,
@@ -226,9 +257,9 @@ DEFAULT_HISTOGRAM_PERCENTILES = [0.95]
 
 class Histogram(Metric):
     """ A metric to track the distribution of a set of values. """
+    __slots__ = ('count', 'samples', 'aggregates', 'percentiles')
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
         self.name = name
         self.count = 0
         self.samples = []
@@ -248,17 +279,30 @@ class Histogram(Metric):
         self.samples.append(value)
         self.last_sample_time = time()
 
-    def flush(self, ts, interval):
-        if not self.count:
-            return []
+    def merge(self, other):
+        self.count += other.count
+        self.samples.extend(other.samples)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
 
+    def _summary(self):
+        """ Return the min, max, sum and number of the samples """
         self.samples.sort()
-        length = len(self.samples)
+        return self.samples[0], self.samples[-1], sum(self.samples), len(self.samples)
+
+    def _value_at_rank(self, rank):
+        """ Return the sample at index `rank` in the sorted samples """
+        return self.samples[rank]
+
+    def _reset(self):
+        self.samples = []
+        self.count = 0
+
+    def flush(self, ts, interval, formatter):
+        if not self.count:
+            return []
 
-        min_ = self.samples[0]
-        max_ = self.samples[-1]
-        med = self.samples[int(round(length/2 - 1))]
-        sum_ = sum(self.samples)
+        min_, max_, sum_, length = self._summary()
+        med = self._value_at_rank(int(round(length/2 - 1)))
         avg = sum_ / float(length)
 
         aggregators = [
@@ -276,7 +320,7 @@ class Histogram(Metric):
             if agg_name in self.aggregates
         ]
 
-        metrics = [self.formatter(
+        metrics = [formatter(
             hostname=self.hostname,
             device_name=self.device_name,
             tags=self.tags,
@@ -288,9 +332,9 @@ class Histogram(Metric):
         ]
 
         for p in self.percentiles:
-            val = self.samples[int(round(p * length - 1))]
+            val = self._value_at_rank(int(round(p * length - 1)))
             name = '%s.%spercentile' % (self.name, int(p * 100))
-            metrics.append(self.formatter(
+            metrics.append(formatter(
                 hostname=self.hostname,
                 tags=self.tags,
                 metric=name,
@@ -301,17 +345,77 @@ class Histogram(Metric):
             ))
 
         # Reset our state.
-        self.samples = []
-        self.count = 0
+        self._reset()
 
         return metrics
 
 
+class SketchHistogram(Histogram):
+    """
+    A histogram that keeps its samples in a bounded-memory QuantileSketch
+    instead of a list. The min, max, avg, sum and count aggregates stay exact,
+    the median and the percentiles are within 1% of their exact value.
+    """
+    __slots__ = ('sketch', 'min', 'max', 'sum')
+
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
+        super(SketchHistogram, self).__init__(name, tags, hostname, device_name, extra_config)
+        self._reset()
+
+    def sample(self, value, sample_rate, timestamp=None):
+        self.count += int(1 / sample_rate)
+        self.sketch.add(value)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.sum += value
+        self.last_sample_time = time()
+
+    def merge(self, other):
+        self.count += other.count
+        self.sketch.merge(other.sketch)
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+        self.sum += other.sum
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def _summary(self):
+        return self.min, self.max, self.sum, self.sketch.count
+
+    def _value_at_rank(self, rank):
+        # Behave like an index in the sorted list of samples
+        if rank < 0:
+            rank += self.sketch.count
+        if rank <= 0:
+            return self.min
+        if rank >= self.sketch.count - 1:
+            return self.max
+        value = self.sketch.value_at_rank(rank)
+        return min(max(value, self.min), self.max)
+
+    def _reset(self):
+        self.sketch = QuantileSketch()
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.count = 0
+
+
+HISTOGRAM_BACKENDS = {
+    'exact': Histogram,
+    'sketch': SketchHistogram,
+}
+DEFAULT_HISTOGRAM_BACKEND = 'exact'
+
+
 class Set(Metric):
     """ A metric to track the number of unique elements in a set. """
+    __slots__ = ('values',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
         self.name = name
         self.tags = tags
         self.hostname = hostname
@@ -323,11 +427,15 @@ class Set(Metric):
         self.values.add(value)
         self.last_sample_time = time()
 
-    def flush(self, timestamp, interval):
+    def merge(self, other):
+        self.values.update(other.values)
+        self.last_sample_time = max(self.last_sample_time, other.last_sample_time)
+
+    def flush(self, timestamp, interval, formatter):
         if not self.values:
             return []
         try:
-            return [self.formatter(
+            return [formatter(
                 hostname=self.hostname,
                 device_name=self.device_name,
                 tags=self.tags,
@@ -343,9 +451,9 @@ class Set(Metric):
 
 class Rate(Metric):
     """ Track the rate of metrics over each flush interval """
+    __slots__ = ('samples',)
 
-    def __init__(self, formatter, name, tags, hostname, device_name, extra_config=None):
-        self.formatter = formatter
+    def __init__(self, name, tags, hostname, device_name, extra_config=None):
         self.name = name
         self.tags = tags
         self.hostname = hostname
@@ -371,7 +479,7 @@ class Rate(Metric):
 
         return (delta / float(interval))
 
-    def flush(self, timestamp, interval):
+    def flush(self, timestamp, interval, formatter):
         if len(self.samples) < 2:
             return []
         try:
@@ -380,7 +488,7 @@ class Rate(Metric):
             except Exception:
                 return []
 
-            return [self.formatter(
+            return [formatter(
                 hostname=self.hostname,
                 device_name=self.device_name,
                 tags=self.tags,
@@ -393,6 +501,48 @@ class Rate(Metric):
         finally:
             self.samples = self.samples[-1:]
 
+
+class MetricsTelemetry(object):
+    """
+    The metric names with the most samples and the most contexts aggregated
+    during a time window, to find the ones to blame for a high volume or a
+    high cardinality.
+    """
+
+    def __init__(self, capacity=DEFAULT_TELEMETRY_CAPACITY):
+        self.capacity = capacity
+        self.start_time = time()
+        self.end_time = None
+        self.samples = HeavyHitters(capacity)
+        # Contexts created in the buckets, i.e. series flushed
+        self.contexts = HeavyHitters(capacity)
+
+    def merge(self, other):
+        self.samples.merge(other.samples)
+        self.contexts.merge(other.contexts)
+
+    def report(self, top):
+        """ Return the `top` metric names by samples and by contexts, as a JSON-serializable dict """
+        end_time = self.end_time or time()
+        duration = end_time - self.start_time
+        return {
+            'start_time': self.start_time,
+            'end_time': end_time,
+            'sample_count': self.samples.total,
+            'context_count': self.contexts.total,
+            'top_samples': [{
+                'name': name,
+                'samples': count,
+                'samples_per_second': round(count / duration, 2) if duration > 0 else 0,
+                'error': error,
+            } for name, count, error in self.samples.top(top)],
+            'top_contexts': [{
+                'name': name,
+                'contexts': count,
+                'error': error,
+            } for name, count, error in self.contexts.top(top)],
+        }
+
 class Aggregator(object):
     """
     Abstract metric aggregator class.
@@ -405,7 +555,8 @@ class Aggregator(object):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            context_cache_size=DEFAULT_CONTEXT_CACHE_SIZE, max_contexts=None):
         self.events = []
         self.service_checks = []
         self.total_count = 0
@@ -421,16 +572,35 @@ class Aggregator(object):
         self.recent_point_threshold = int(recent_point_threshold)
         self.num_discarded_old_points = 0
 
+        # Points of new contexts are discarded once `max_contexts` contexts
+        # are held, to bound the memory used by high cardinality metrics
+        self.max_contexts = max_contexts
+        self.num_discarded_new_contexts_points = 0
+
+        # Class used for histograms and timers
+        self.histogram_class = HISTOGRAM_BACKENDS[histogram_backend or DEFAULT_HISTOGRAM_BACKEND]
+
         # Additional config passed when instantiating metric configs
+        histogram_config = {
+            'aggregates': histogram_aggregates,
+            'percentiles': histogram_percentiles
+        }
         self.metric_config = {
-            Histogram: {
-                'aggregates': histogram_aggregates,
-                'percentiles': histogram_percentiles
-            }
+            Histogram: histogram_config,
+            self.histogram_class: histogram_config,
         }
 
         self.utf8_decoding = utf8_decoding
 
+        # Contexts of the metrics submitted in packets, by name and raw tags
+        self.context_cache = LRUCache(context_cache_size)
+
+        # Batched receive stats, fed by the dogstatsd server
+        self.batch_count = 0
+        self.batch_packet_count = 0
+        self.max_batch_size = 0
+        self.dropped_packet_count = 0
+
     def deduplicate_tags(self, tags):
         return sorted(set(tags))
 
@@ -511,6 +681,155 @@ class Aggregator(object):
 
         return parsed_packets
 
+    def parse_metric_line(self, packet):
+        """
+        Single-pass equivalent of `parse_metric_packet`, followed by
+        `_extract_magic_tags` and `deduplicate_tags` on each value.
+
+        Return a list of (name, value, metric_type, tags, sample_rate, hostname, device_name)
+        tuples, where `tags` is a sorted tuple of unique tags without the magic
+        ones, or None.
+        """
+        parsed_packets = []
+        for name, value, metric_type, raw_tags, sample_rate in self._split_metric_line(packet):
+            tags, hostname, device_name = self._parse_tags(raw_tags)
+            parsed_packets.append((name, value, metric_type, tags, sample_rate, hostname, device_name))
+
+        return parsed_packets
+
+    def _split_metric_line(self, packet):
+        """
+        Return a list of (name, value, metric_type, raw_tags, sample_rate)
+        tuples, `raw_tags` being the tags as they appear in the packet.
+        """
+        name_end = packet.find(':')
+        if name_end == -1:
+            raise Exception(u'Unparseable metric packet: %s' % packet)
+
+        name = packet[:name_end]
+        length = len(packet)
+        parsed_packets = []
+
+        # A `:` starts a new value only if it's followed by a `|` before the
+        # next `:`, otherwise it's part of a tag. So there's no need to look
+        # at the ones after the last `|`, i.e. in the tags of the last value.
+        last_pipe = packet.rfind('|')
+        start = name_end + 1
+        colon = packet.find(':', start, last_pipe)
+        while True:
+            end = length
+            while colon != -1:
+                next_colon = packet.find(':', colon + 1, last_pipe)
+                if packet.find('|', colon + 1, length if next_colon == -1 else next_colon) != -1:
+                    end = colon
+                    break
+                colon = next_colon
+
+            parsed = self._parse_metric_datum(packet, name, packet[start:end])
+            if parsed is not None:
+                parsed_packets.append(parsed)
+
+            if end == length:
+                return parsed_packets
+            start = end + 1
+            colon = next_colon
+
+    def _parse_metric_datum(self, packet, name, datum):
+        """ Parse `<value>|<metric_type>|<metadata>...` for `_split_metric_line` """
+        value_end = datum.find('|')
+        if value_end == -1:
+            raise Exception(u'Unparseable metric packet: %s' % packet)
+
+        raw_value = datum[:value_end]
+        type_end = datum.find('|', value_end + 1)
+        if type_end == -1:
+            metric_type = datum[value_end + 1:]
+        else:
+            metric_type = datum[value_end + 1:type_end]
+
+        if metric_type in self.ALLOW_STRINGS:
+            value = raw_value
+        elif metric_type and metric_type[0] in self.IGNORE_TYPES:
+            return None
+        else:
+            # Try to cast as an int first to avoid precision issues, then as a
+            # float.
+            try:
+                value = int(raw_value)
+            except ValueError:
+                try:
+                    value = float(raw_value)
+                except ValueError:
+                    # Otherwise, raise an error saying it must be a number
+                    raise Exception(u'Metric value must be a number: %s, %s' % (name, raw_value))
+
+        # Parse the optional values - sample rate & tags.
+        sample_rate = 1
+        raw_tags = None
+        if type_end != -1:
+            metadata = datum[type_end + 1:].split('|')
+            try:
+                for m in metadata:
+                    if m[0] == '@':
+                        sample_rate = float(m[1:])
+                        # in case it's in a bad state
+                        sample_rate = 1 if sample_rate < 0 or sample_rate > 1 else sample_rate
+                    elif m[0] == '#':
+                        raw_tags = m[1:]
+            except IndexError:
+                log.warning(u'Incorrect metric metadata: metric_name:%s, metadata:%s',
+                            name, u' '.join(metadata))
+
+        return name, value, metric_type, raw_tags, sample_rate
+
+    def _parse_tags(self, raw_tags):
+        """
+        Return the (tags, hostname, device_name) found in the comma-separated
+        `raw_tags`, `tags` being a sorted tuple of unique tags without the
+        magic ones, or None.
+        """
+        if raw_tags is None:
+            return None, None, None
+
+        hostname = None
+        device_name = None
+        # Sort and deduplicate the tags only once
+        tags = sorted(set(raw_tags.split(',')))
+        if 'host:' in raw_tags or 'device:' in raw_tags:
+            # Like `_extract_magic_tags`, the last magic tag in sorted order wins
+            other_tags = []
+            for tag in tags:
+                if tag.startswith('host:'):
+                    hostname = tag[5:]
+                elif tag.startswith('device:'):
+                    device_name = tag[7:]
+                else:
+                    other_tags.append(tag)
+            tags = other_tags
+
+        return tuple(tags) or None, hostname, device_name
+
+    def get_context(self, name, raw_tags):
+        """
+        Return the (context, tags) of a metric submitted with the given raw
+        tag string, reusing the ones of its previous submissions when they
+        are still cached.
+        """
+        if raw_tags is None:
+            # Nothing to parse, building the context is cheaper than caching it
+            return (name, (), self.hostname, None), None
+
+        key = (name, raw_tags)
+        cached = self.context_cache.get(key)
+        if cached is None:
+            tags, hostname, device_name = self._parse_tags(raw_tags)
+            # Keep hostname with empty string to unset it
+            hostname = hostname if hostname is not None else self.hostname
+            cached = ((name, tags or (), hostname, device_name), tags)
+            self.context_cache.set(key, cached)
+
+        return cached
+
     def _unescape_sc_content(self, string):
         return string.replace('\\n', '\n').replace('m\:', 'm:')
 
@@ -617,12 +936,11 @@ class Aggregator(object):
                 self.service_check(**service_check)
                 self.service_check_count += 1
             else:
-                parsed_packets = self.parse_metric_packet(packet)
+                parsed_packets = self._split_metric_line(packet)
                 self.count += 1
-                for name, value, mtype, tags, sample_rate in parsed_packets:
-                    hostname, device_name, tags = self._extract_magic_tags(tags)
-                    self.submit_metric(name, value, mtype, tags=tags, hostname=hostname,
-                                       device_name=device_name, sample_rate=sample_rate)
+                for name, value, mtype, raw_tags, sample_rate in parsed_packets:
+                    context, tags = self.get_context(name, raw_tags)
+                    self._submit_metric(context, tags, value, mtype, None, sample_rate)
 
     def _extract_magic_tags(self, tags):
         """Magic tags (host, device) override metric hostname and device_name attributes"""
@@ -649,6 +967,23 @@ class Aggregator(object):
     def submit_metric(self, name, value, mtype, tags=None, hostname=None,
                       device_name=None, timestamp=None, sample_rate=1):
         """ Add a metric to be aggregated """
+        # Note: if you change the way that context is created, please also change
+        #  MetricsBucketAggregator.flush_idle_counters, which counts on this order
+        if tags is not None:
+            tags = tuple(self.deduplicate_tags(tags))
+
+        # Keep hostname with empty string to unset it
+        hostname = hostname if hostname is not None else self.hostname
+
+        context = (name, tags or (), hostname, device_name)
+        self._submit_metric(context, tags, value, mtype, timestamp, sample_rate)
+
+    def _submit_metric(self, context, tags, value, mtype, timestamp, sample_rate):
+        """
+        Add a metric to be aggregated under `context`, a
+        (name, tags, hostname, device_name) tuple, `tags` being the
+        deduplicated tuple of tags or None.
+        """
         raise NotImplementedError()
 
     def event(self, title, text, date_happened=None, alert_type=None, aggregation_key=None, source_type_name=None, priority=None, tags=None, hostname=None):
@@ -725,6 +1060,25 @@ class Aggregator(object):
     def send_packet_count(self, metric_name):
         self.submit_metric(metric_name, self.count, 'g')
 
+    def record_batch(self, size):
+        """ Account for a batch of `size` datagrams read in a single wakeup """
+        self.batch_count += 1
+        self.batch_packet_count += size
+        if size > self.max_batch_size:
+            self.max_batch_size = size
+
+    def flush_batch_stats(self):
+        """
+        Return the (batch_count, batch_packet_count, max_batch_size) seen
+        since the last call and reset them.
+        """
+        stats = (self.batch_count, self.batch_packet_count, self.max_batch_size)
+        self.batch_count = 0
+        self.batch_packet_count = 0
+        self.max_batch_size = 0
+
+        return stats
+
 class MetricsBucketAggregator(Aggregator):
     """
     A metric aggregator class.
@@ -733,7 +1087,9 @@ class MetricsBucketAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            context_cache_size=DEFAULT_CONTEXT_CACHE_SIZE, max_contexts=None,
+            telemetry_capacity=None):
         super(MetricsBucketAggregator, self).__init__(
             hostname,
             interval,
@@ -742,44 +1098,48 @@ class MetricsBucketAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            context_cache_size,
+            max_contexts
         )
         self.metric_by_bucket = {}
+        # Number of contexts in all the buckets
+        self.bucket_context_count = 0
         self.last_sample_time_by_context = {}
+        # (last_sample_time, context) of the counters in last_sample_time_by_context,
+        # one per context, the times being lazily updated when popped
+        self.counter_expiry_heap = []
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = 0
         self.metric_type_to_class = {
             'g': BucketGauge,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
         }
 
+        # Telemetry of the metrics submitted since the last flush, and of the
+        # ones submitted between the last two flushes
+        self.telemetry_capacity = telemetry_capacity
+        self.telemetry = MetricsTelemetry(telemetry_capacity) if telemetry_capacity else None
+        self.last_telemetry = None
+
     def calculate_bucket_start(self, timestamp):
         return timestamp - (timestamp % self.interval)
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                      device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-        # Note: if you change the way that context is created, please also change create_empty_metrics,
-        #  which counts on this order
-
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
-
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            tags = tuple(self.deduplicate_tags(tags))
-            context = (name, tags, hostname, device_name)
+    def _submit_metric(self, context, tags, value, mtype, timestamp, sample_rate):
+        telemetry = self.telemetry
+        if telemetry is not None:
+            telemetry.samples.add(context[0])
 
         cur_time = time()
         # Check to make sure that the timestamp that is passed in (if any) is not older than
         #  recent_point_threshold.  If so, discard the point.
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             timestamp = timestamp or cur_time
@@ -795,24 +1155,173 @@ class MetricsBucketAggregator(Aggregator):
                 self.current_mbc = metric_by_context
 
             if context not in metric_by_context:
+                if self._at_max_contexts(context):
+                    self.num_discarded_new_contexts_points += 1
+                    return
+                name, _, hostname, device_name = context
                 metric_class = self.metric_type_to_class[mtype]
-                metric_by_context[context] = metric_class(self.formatter, name, tags,
-                    hostname, device_name, self.metric_config.get(metric_class))
+                metric_by_context[context] = metric_class(name, tags, hostname, device_name,
+                    self.metric_config.get(metric_class))
+                self.bucket_context_count += 1
+                if telemetry is not None:
+                    telemetry.contexts.add(name)
 
             metric_by_context[context].sample(value, sample_rate, timestamp)
 
-    def create_empty_metrics(self, sample_time_by_context, expiry_timestamp, flush_timestamp, metrics):
-        # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
-        #  (Set, Gauge, Histogram) do not report if no data is submitted
-        for context, last_sample_time in sample_time_by_context.items():
+    def _at_max_contexts(self, context):
+        """
+        Whether a new `context` can't be added to a bucket without going over
+        `max_contexts`: the contexts of all the buckets count, along with the
+        counters kept reporting 0 until they expire. A counter that is still
+        reported is never discarded.
+        """
+        return bool(self.max_contexts) and \
+            self.bucket_context_count + len(self.last_sample_time_by_context) >= self.max_contexts and \
+            context not in self.last_sample_time_by_context
+
+    def snapshot(self, flush_cutoff_time):
+        """
+        Detach the buckets that started before `flush_cutoff_time`, along with
+        the pending events, service checks and packet stats, so that they can
+        be merged and flushed by another aggregator with `merge_snapshot`.
+        """
+        buckets = {}
+        for bucket_start_timestamp in self.metric_by_bucket.keys():
+            if bucket_start_timestamp < flush_cutoff_time:
+                buckets[bucket_start_timestamp] = self.metric_by_bucket.pop(bucket_start_timestamp)
+                self.bucket_context_count -= len(buckets[bucket_start_timestamp])
+        if self.current_bucket in buckets:
+            self.current_bucket = None
+            self.current_mbc = {}
+
+        snapshot = {
+            'buckets': buckets,
+            'events': self.events,
+            'service_checks': self.service_checks,
+            'count': self.count,
+            'event_count': self.event_count,
+            'service_check_count': self.service_check_count,
+            'num_discarded_old_points': self.num_discarded_old_points,
+            'num_discarded_new_contexts_points': self.num_discarded_new_contexts_points,
+            'batch_stats': self.flush_batch_stats(),
+            'context_cache_stats': self.context_cache.flush_stats(),
+            'dropped_packet_count': self.dropped_packet_count,
+            'telemetry': self._rotate_telemetry(),
+        }
+
+        self.events = []
+        self.service_checks = []
+        self.total_count += self.count + self.event_count + self.service_check_count
+        self.count = 0
+        self.event_count = 0
+        self.service_check_count = 0
+        self.num_discarded_old_points = 0
+        self.num_discarded_new_contexts_points = 0
+
+        return snapshot
+
+    def merge_snapshot(self, snapshot):
+        """
+        Merge a snapshot taken from another aggregator, its metrics will be
+        sent with the next flush. New contexts are discarded past
+        `max_contexts`, each counted as one discarded point.
+        """
+        for bucket_start_timestamp, snapshot_mbc in snapshot['buckets'].iteritems():
+            metric_by_context = self.metric_by_bucket.setdefault(bucket_start_timestamp, {})
+            for context, metric in snapshot_mbc.iteritems():
+                if context in metric_by_context:
+                    metric_by_context[context].merge(metric)
+                elif self._at_max_contexts(context):
+                    self.num_discarded_new_contexts_points += 1
+                else:
+                    metric_by_context[context] = metric
+                    self.bucket_context_count += 1
+
+        self.events.extend(snapshot['events'])
+        self.service_checks.extend(snapshot['service_checks'])
+        self.count += snapshot['count']
+        self.event_count += snapshot['event_count']
+        self.service_check_count += snapshot['service_check_count']
+        self.num_discarded_old_points += snapshot['num_discarded_old_points']
+        self.num_discarded_new_contexts_points += snapshot['num_discarded_new_contexts_points']
+
+        batch_count, batch_packet_count, max_batch_size = snapshot['batch_stats']
+        self.batch_count += batch_count
+        self.batch_packet_count += batch_packet_count
+        self.max_batch_size = max(self.max_batch_size, max_batch_size)
+
+        hits, misses, evictions = snapshot['context_cache_stats']
+        self.context_cache.hits += hits
+        self.context_cache.misses += misses
+        self.context_cache.evictions += evictions
+
+        if self.telemetry is not None and snapshot.get('telemetry') is not None:
+            self.telemetry.merge(snapshot['telemetry'])
+
+    def _rotate_telemetry(self):
+        """ Start a new telemetry window, return the one that ended """
+        telemetry = self.telemetry
+        if telemetry is None:
+            return None
+        telemetry.end_time = time()
+        self.telemetry = MetricsTelemetry(self.telemetry_capacity)
+        return telemetry
+
+    def telemetry_report(self, top):
+        """
+        Return the `top` metric names by samples and by contexts between the
+        last two flushes, None if the telemetry is disabled or there was no
+        flush yet.
+        """
+        telemetry = self.last_telemetry
+        if telemetry is None:
+            return None
+        return telemetry.report(top)
+
+    def set_counter_sample_time(self, context, last_sample_time):
+        if context not in self.last_sample_time_by_context:
+            heappush(self.counter_expiry_heap, (last_sample_time, context))
+        self.last_sample_time_by_context[context] = last_sample_time
+
+    def expire_counters(self, expiry_timestamp):
+        """ Forget the counters that haven't been sampled since `expiry_timestamp` """
+        heap = self.counter_expiry_heap
+        while heap and heap[0][0] < expiry_timestamp:
+            _, context = heappop(heap)
+            last_sample_time = self.last_sample_time_by_context.get(context)
+            if last_sample_time is None:
+                continue
             if last_sample_time < expiry_timestamp:
                 log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                self.last_sample_time_by_context.pop(context, None)
+                del self.last_sample_time_by_context[context]
             else:
-                # The expiration currently only applies to Counters
-                # This counts on the ordering of the context created in submit_metric not changing
-                metric = Counter(self.formatter, context[0], context[1], context[2], context[3])
-                metrics += metric.flush(flush_timestamp, self.interval)
+                # Sampled since it was pushed, check it again later
+                heappush(heap, (last_sample_time, context))
+
+    def flush_idle_counters(self, sampled_counters, expiry_timestamp, flush_timestamp, metrics):
+        # Even if no data is submitted, Counters keep reporting "0" for expiry_seconds.  The other Metrics
+        #  (Set, Gauge, Histogram) do not report if no data is submitted
+        self.expire_counters(expiry_timestamp)
+
+        formatter = self.formatter
+        interval = self.interval
+        metric_type = MetricTypes.RATE
+        for context in self.last_sample_time_by_context:
+            if context in sampled_counters:
+                continue
+            # The expiration currently only applies to Counters
+            # This counts on the ordering of the context created in submit_metric not changing
+            name, tags, hostname, device_name = context
+            metrics.append(formatter(
+                metric=name,
+                value=0.0,
+                timestamp=flush_timestamp,
+                tags=tags,
+                hostname=hostname,
+                device_name=device_name,
+                metric_type=metric_type,
+                interval=interval,
+            ))
 
     def flush(self):
         cur_time = time()
@@ -827,35 +1336,39 @@ class MetricsBucketAggregator(Aggregator):
             for bucket_start_timestamp in sorted(self.metric_by_bucket.keys()):
                 metric_by_context = self.metric_by_bucket[bucket_start_timestamp]
                 if bucket_start_timestamp < flush_cutoff_time:
-                    not_sampled_in_this_bucket = self.last_sample_time_by_context.copy()
+                    sampled_counters = set()
                     # We mutate this dictionary while iterating so don't use an iterator.
                     for context, metric in metric_by_context.items():
                         if metric.last_sample_time < expiry_timestamp:
                             # This should never happen
                             log.warning("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
-                            not_sampled_in_this_bucket.pop(context, None)
                             self.last_sample_time_by_context.pop(context, None)
                         else:
-                            metrics += metric.flush(bucket_start_timestamp, self.interval)
+                            metrics += metric.flush(bucket_start_timestamp, self.interval, self.formatter)
                             if isinstance(metric, Counter):
-                                self.last_sample_time_by_context[context] = metric.last_sample_time
-                                not_sampled_in_this_bucket.pop(context, None)
+                                self.set_counter_sample_time(context, metric.last_sample_time)
+                                sampled_counters.add(context)
                     # We need to account for Metrics that have not expired and were not flushed for this bucket
-                    self.create_empty_metrics(not_sampled_in_this_bucket, expiry_timestamp, bucket_start_timestamp, metrics)
+                    self.flush_idle_counters(sampled_counters, expiry_timestamp, bucket_start_timestamp, metrics)
 
                     del self.metric_by_bucket[bucket_start_timestamp]
+                    self.bucket_context_count -= len(metric_by_context)
         else:
             # Even if there are no metrics in this flush, there may be some non-expired counters
             #  We should only create these non-expired metrics if we've passed an interval since the last flush
             if flush_cutoff_time >= self.last_flush_cutoff_time + self.interval:
-                self.create_empty_metrics(self.last_sample_time_by_context.copy(), expiry_timestamp,
-                                          flush_cutoff_time-self.interval, metrics)
+                self.flush_idle_counters(set(), expiry_timestamp, flush_cutoff_time-self.interval, metrics)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.num_discarded_new_contexts_points > 0:
+            log.warn('%s points of new contexts were discarded as a result of reaching the limit of %s contexts'
+                     % (self.num_discarded_new_contexts_points, self.max_contexts))
+            self.num_discarded_new_contexts_points = 0
+
         # Save some stats.
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
@@ -863,6 +1376,8 @@ class MetricsBucketAggregator(Aggregator):
         self.current_bucket = None
         self.current_mbc = {}
         self.last_flush_cutoff_time = flush_cutoff_time
+        if self.telemetry is not None:
+            self.last_telemetry = self._rotate_telemetry()
         return metrics
 
 
@@ -874,7 +1389,8 @@ class MetricsAggregator(Aggregator):
     def __init__(self, hostname, interval=1.0, expiry_seconds=300,
             formatter=None, recent_point_threshold=None,
             histogram_aggregates=None, histogram_percentiles=None,
-            utf8_decoding=False):
+            utf8_decoding=False, histogram_backend=None,
+            context_cache_size=DEFAULT_CONTEXT_CACHE_SIZE, max_contexts=None):
         super(MetricsAggregator, self).__init__(
             hostname,
             interval,
@@ -883,7 +1399,10 @@ class MetricsAggregator(Aggregator):
             recent_point_threshold,
             histogram_aggregates,
             histogram_percentiles,
-            utf8_decoding
+            utf8_decoding,
+            histogram_backend,
+            context_cache_size,
+            max_contexts
         )
         self.metrics = {}
         self.metric_type_to_class = {
@@ -891,31 +1410,24 @@ class MetricsAggregator(Aggregator):
             'ct': Count,
             'ct-c': MonotonicCount,
             'c': Counter,
-            'h': Histogram,
-            'ms': Histogram,
+            'h': self.histogram_class,
+            'ms': self.histogram_class,
             's': Set,
             '_dd-r': Rate,
         }
 
-    def submit_metric(self, name, value, mtype, tags=None, hostname=None,
-                      device_name=None, timestamp=None, sample_rate=1):
-        # Avoid calling extra functions to dedupe tags if there are none
-
-        # Keep hostname with empty string to unset it
-        hostname = hostname if hostname is not None else self.hostname
-
-        if tags is None:
-            context = (name, tuple(), hostname, device_name)
-        else:
-            tags = tuple(self.deduplicate_tags(tags))
-            context = (name, tags, hostname, device_name)
+    def _submit_metric(self, context, tags, value, mtype, timestamp, sample_rate):
         if context not in self.metrics:
+            if self.max_contexts and len(self.metrics) >= self.max_contexts:
+                self.num_discarded_new_contexts_points += 1
+                return
+            name, _, hostname, device_name = context
             metric_class = self.metric_type_to_class[mtype]
-            self.metrics[context] = metric_class(self.formatter, name, tags,
-                hostname, device_name, self.metric_config.get(metric_class))
+            self.metrics[context] = metric_class(name, tags, hostname, device_name,
+                self.metric_config.get(metric_class))
         cur_time = time()
         if timestamp is not None and cur_time - int(timestamp) > self.recent_point_threshold:
-            log.debug("Discarding %s - ts = %s , current ts = %s " % (name, timestamp, cur_time))
+            log.debug("Discarding %s - ts = %s , current ts = %s " % (context[0], timestamp, cur_time))
             self.num_discarded_old_points += 1
         else:
             self.metrics[context].sample(value, sample_rate, timestamp)
@@ -958,13 +1470,18 @@ class MetricsAggregator(Aggregator):
                 log.debug("%s hasn't been submitted in %ss. Expiring." % (context, self.expiry_seconds))
                 del self.metrics[context]
             else:
-                metrics += metric.flush(timestamp, self.interval)
+                metrics += metric.flush(timestamp, self.interval, self.formatter)
 
         # Log a warning regarding metrics with old timestamps being submitted
         if self.num_discarded_old_points > 0:
             log.warn('%s points were discarded as a result of having an old timestamp' % self.num_discarded_old_points)
             self.num_discarded_old_points = 0
 
+        if self.num_discarded_new_contexts_points > 0:
+            log.warn('%s points of new contexts were discarded as a result of reaching the limit of %s contexts'
+                     % (self.num_discarded_new_contexts_points, self.max_contexts))
+            self.num_discarded_new_contexts_points = 0
+
         # Save some stats.
         log.debug("received %s payloads since last flush" % self.count)
         self.total_count += self.count
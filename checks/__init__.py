@@ -8,8 +8,9 @@ If you are writing your own checks you should subclass the AgentCheck class.
 The Check class is being deprecated so don't write new checks with it.
 """
 # stdlib
+from array import array
 from collections import defaultdict
-import copy
+from itertools import count, izip
 import logging
 import numbers
 import os
@@ -31,7 +32,9 @@ import yaml
 from checks import check_status
 from config import AGENT_VERSION, _is_affirmative
 from util import get_next_id, yLoader
+from utils.guarded_copy import MutationGuard, guarded_copy
 from utils.hostname import get_hostname
+from utils.lru_cache import LRUCache
 from utils.proxy import get_proxy
 from utils.profile import pretty_statistics
 from utils.proxy import get_no_proxy_from_env, config_proxy_skip
@@ -44,6 +47,25 @@ DEFAULT_PSUTIL_METHODS = ['memory_info', 'io_counters']
 
 AGENT_METRICS_CHECK_NAME = 'agent_metrics'
 
+# Number of normalized metric names each check remembers
+NORMALIZE_CACHE_SIZE = 10000
+
+# Characters replaced by `_` in metric names, along with the `_`s around them
+METRIC_NAME_UNDERSCORES_RE = re.compile(r"[,\@\+\*\-/()\[\]{}\s_]+")
+# `_`s around the dots of metric names
+METRIC_NAME_DOTS_RE = re.compile(r"_?\._?")
+
+
+def _clean_metric_name(name):
+    """
+    Replace the runs of special characters and `_`s of a metric name with a
+    single `_`, and drop the `_`s at both ends and around dots
+    """
+    name = METRIC_NAME_UNDERSCORES_RE.sub("_", name).strip("_")
+    if "_" in name and "." in name:
+        name = METRIC_NAME_DOTS_RE.sub(".", name)
+    return name
+
 
 # Konstants
 class CheckException(Exception):
@@ -81,44 +103,77 @@ class Check(object):
 
     """
     def __init__(self, logger):
-        # where to store samples, indexed by metric_name
-        # metric_name: {("sorted", "tags"): [(ts, value), (ts, value)],
-        #                 tuple(tags) are stored as a key since lists are not hashable
-        #               None: [(ts, value), (ts, value)]}
-        #                 untagged values are indexed by None
+        # Index of the series of each metric in the columns below
+        # metric_name: {(("sorted", "tags"), device_name): index}
+        #   tuple(tags) are stored as a key since lists are not hashable,
+        #   untagged series have None tags
         self._sample_store = {}
         self._counters = {}  # metric_name: bool
         self.logger = logger
+        self._normalize_cache = LRUCache(NORMALIZE_CACHE_SIZE)
+
+        # Series, stored as columns: a counter keeps its last two samples
+        # to compute its rate, a gauge only its last one
+        self._series_metrics = []  # metric_name, None for a free index
+        self._series_keys = []  # (tags, device_name)
+        self._series_hostnames = []
+        self._sample_counts = array('b')  # 0, 1 or 2
+        self._previous_timestamps = array('d')
+        self._previous_values = []  # as cast by cast_metric_val, ints are kept
+        self._timestamps = array('d')
+        self._values = []
+        # Indexes of the series of the metrics that have been reset
+        self._free_series = []
 
     def normalize(self, metric, prefix=None):
         """Turn a metric into a well-formed metric name
         prefix.b.c
         """
-        name = re.sub(r"[,\@\+\*\-/()\[\]{}\s]", "_", metric)
-        # Eliminate multiple _
-        name = re.sub(r"__+", "_", name)
-        # Don't start/end with _
-        name = re.sub(r"^_", "", name)
-        name = re.sub(r"_$", "", name)
-        # Drop ._ and _.
-        name = re.sub(r"\._", ".", name)
-        name = re.sub(r"_\.", ".", name)
-
-        if prefix is not None:
-            return prefix + "." + name
-        else:
-            return name
+        key = (metric, prefix)
+        normalized = self._normalize_cache.get(key)
+        if normalized is None:
+            name = _clean_metric_name(metric)
+            normalized = name if prefix is None else prefix + "." + name
+            self._normalize_cache.set(key, normalized)
+        return normalized
 
     def normalize_device_name(self, device_name):
         return device_name.strip().lower().replace(' ', '_')
 
+    def _reset_metric(self, metric):
+        for i in self._sample_store.get(metric, {}).itervalues():
+            self._series_metrics[i] = None
+            self._series_keys[i] = None
+            self._series_hostnames[i] = None
+            self._sample_counts[i] = 0
+            self._free_series.append(i)
+        self._sample_store[metric] = {}
+
+    def _add_series(self, metric, key):
+        if self._free_series:
+            i = self._free_series.pop()
+            self._series_metrics[i] = metric
+            self._series_keys[i] = key
+        else:
+            i = len(self._series_metrics)
+            self._series_metrics.append(metric)
+            self._series_keys.append(key)
+            self._series_hostnames.append(None)
+            self._sample_counts.append(0)
+            self._previous_timestamps.append(0)
+            self._previous_values.append(0)
+            self._timestamps.append(0)
+            self._values.append(0)
+        self._sample_store[metric][key] = i
+        return i
+
     def counter(self, metric):
         """
         Treats the metric as a counter, i.e. computes its per second derivative
         ACHTUNG: Resets previous values associated with this metric.
         """
         self._counters[metric] = True
-        self._sample_store[metric] = {}
+        self._reset_metric(metric)
 
     def is_counter(self, metric):
         "Is this metric a counter?"
@@ -129,7 +184,7 @@ class Check(object):
         Treats the metric as a gauge, i.e. keep the data as is
         ACHTUNG: Resets previous values associated with this metric.
         """
-        self._sample_store[metric] = {}
+        self._reset_metric(metric)
 
     def is_metric(self, metric):
         return metric in self._sample_store
@@ -155,7 +210,8 @@ class Check(object):
 
         if timestamp is None:
             timestamp = time.time()
-        if metric not in self._sample_store:
+        series = self._sample_store.get(metric)
+        if series is None:
             raise CheckException("Saving a sample for an undefined metric: %s" % metric)
         try:
             value = cast_metric_val(value)
@@ -169,23 +225,21 @@ class Check(object):
             else:
                 tags = tuple(sorted(tags))
 
-        # Data eviction rules
         key = (tags, device_name)
-        if self.is_gauge(metric):
-            self._sample_store[metric][key] = ((timestamp, value, hostname, device_name), )
-        elif self.is_counter(metric):
-            if self._sample_store[metric].get(key) is None:
-                self._sample_store[metric][key] = [(timestamp, value, hostname, device_name)]
-            else:
-                self._sample_store[metric][key] = self._sample_store[metric][key][-1:] + [(timestamp, value, hostname, device_name)]
+        i = series.get(key)
+        if i is None:
+            i = self._add_series(metric, key)
+
+        # Data eviction rules: a counter keeps the previous sample
+        if metric in self._counters and self._sample_counts[i]:
+            self._previous_timestamps[i] = self._timestamps[i]
+            self._previous_values[i] = self._values[i]
+            self._sample_counts[i] = 2
         else:
-            raise CheckException("%s must be either gauge or counter, skipping sample at %s" % (metric, time.ctime(timestamp)))
-
-        if self.is_gauge(metric):
-            # store[metric][tags] = (ts, val) - only 1 value allowed
-            assert len(self._sample_store[metric][key]) == 1, self._sample_store[metric]
-        elif self.is_counter(metric):
-            assert len(self._sample_store[metric][key]) in (1, 2), self._sample_store[metric]
+            self._sample_counts[i] = 1
+        self._timestamps[i] = timestamp
+        self._values[i] = value
+        self._series_hostnames[i] = hostname
 
     @classmethod
     def _rate(cls, sample1, sample2):
@@ -220,18 +274,23 @@ class Check(object):
         if metric not in self._sample_store:
             raise UnknownValue()
 
-        # Not enough value to compute rate
-        elif self.is_counter(metric) and len(self._sample_store[metric][key]) < 2:
+        i = self._sample_store[metric].get(key)
+        if i is None:
             raise UnknownValue()
+        sample = (self._timestamps[i], self._values[i], self._series_hostnames[i], device_name)
 
-        elif self.is_counter(metric) and len(self._sample_store[metric][key]) >= 2:
-            res = self._rate(self._sample_store[metric][key][-2], self._sample_store[metric][key][-1])
+        if self.is_counter(metric):
+            # Not enough value to compute rate
+            if self._sample_counts[i] < 2:
+                raise UnknownValue()
+            previous_sample = (self._previous_timestamps[i], self._previous_values[i])
+            res = self._rate(previous_sample, sample)
             if expire:
-                del self._sample_store[metric][key][:-1]
+                self._sample_counts[i] = 1
             return res
 
-        elif self.is_gauge(metric) and len(self._sample_store[metric][key]) >= 1:
-            return self._sample_store[metric][key][-1]
+        elif self._sample_counts[i] >= 1:
+            return sample
 
         else:
             raise UnknownValue()
@@ -271,24 +330,36 @@ class Check(object):
         @rtype [(metric_name, timestamp, value, {"tags": ["tag1", "tag2"]}), ...]
         """
         metrics = []
-        for m in self._sample_store:
-            try:
-                for key in self._sample_store[m]:
-                    tags, device_name = key
-                    try:
-                        ts, val, hostname, device_name = self.get_sample_with_timestamp(m, tags, device_name, expire)
-                    except UnknownValue:
-                        continue
-                    attributes = {}
-                    if tags:
-                        attributes['tags'] = list(tags)
-                    if hostname:
-                        attributes['host_name'] = hostname
-                    if device_name:
-                        attributes['device_name'] = device_name
-                    metrics.append((m, int(ts), val, attributes))
-            except Exception:
-                pass
+        counters = self._counters
+        sample_counts = self._sample_counts
+        # All the series at once, the rates of the counters included
+        columns = izip(count(), self._series_metrics, self._series_keys, self._series_hostnames,
+                       sample_counts, self._previous_timestamps, self._previous_values,
+                       self._timestamps, self._values)
+        for i, m, key, hostname, sample_count, previous_ts, previous_val, ts, val in columns:
+            if not sample_count:
+                continue
+            if m in counters:
+                # Not enough value to compute rate
+                if sample_count < 2:
+                    continue
+                interval = ts - previous_ts
+                delta = val - previous_val
+                if interval == 0 or delta < 0:
+                    continue
+                val = delta / interval
+                if expire:
+                    sample_counts[i] = 1
+
+            tags, device_name = key
+            attributes = {}
+            if tags:
+                attributes['tags'] = list(tags)
+            if hostname:
+                attributes['host_name'] = hostname
+            if device_name:
+                attributes['device_name'] = device_name
+            metrics.append((m, int(ts), val, attributes))
         return metrics
 
 
@@ -301,6 +372,10 @@ class AgentCheck(object):
 
     DEFAULT_MIN_COLLECTION_INTERVAL = 0
 
+    # How early (in seconds) an instance with a min_collection_interval can run,
+    # so that collector runs due at the same time as its slot don't miss it
+    COLLECTION_INTERVAL_TOLERANCE = 0.5
+
     _enabled_checks = []
 
     @classmethod
@@ -343,7 +418,8 @@ class AgentCheck(object):
             formatter=agent_formatter,
             recent_point_threshold=agentConfig.get('recent_point_threshold', None),
             histogram_aggregates=agentConfig.get('histogram_aggregates'),
-            histogram_percentiles=agentConfig.get('histogram_percentiles')
+            histogram_percentiles=agentConfig.get('histogram_percentiles'),
+            histogram_backend=agentConfig.get('histogram_backend')
         )
 
         self.events = []
@@ -354,6 +430,9 @@ class AgentCheck(object):
         self.check_version = None
         self.library_versions = None
         self.last_collection_time = defaultdict(int)
+        # Copies of the instances the check runs with, by instance index
+        self._instance_copies = {}
+        self._normalize_cache = LRUCache(NORMALIZE_CACHE_SIZE)
         self._instance_metadata = []
         self.svc_metadata = []
         self.historate_dict = {}
@@ -794,6 +873,50 @@ class AgentCheck(object):
         self._internal_profiling_stats = None
         return stats
 
+    def _is_instance_due(self, i, min_collection_interval, now):
+        """
+        Return whether instance `i` should run, and if so move its
+        `last_collection_time` to the slot it runs for.
+
+        The slots are `min_collection_interval` apart from its first run, so
+        that the instance keeps its own cadence whatever the delays of the
+        collector runs, instead of drifting by them.
+        """
+        last_collection_time = self.last_collection_time[i]
+        if not last_collection_time or min_collection_interval <= 0:
+            self.last_collection_time[i] = now
+            return True
+
+        elapsed = now - last_collection_time + self.COLLECTION_INTERVAL_TOLERANCE
+        if elapsed < min_collection_interval:
+            return False
+
+        # Skip the slots missed since the last run, if any
+        self.last_collection_time[i] += min_collection_interval * (elapsed // min_collection_interval)
+        return True
+
+    def _get_instance_copy(self, i, instance):
+        """
+        Return a copy of `instance` for the check to run with.
+
+        The copy is reused from one run to the next as long as neither the check
+        nor anything else modified it or the original, so that instances aren't
+        deep copied at every run. Its dicts and lists keep track of their
+        changes, the rest is caught by comparing the copy to the original,
+        which is much cheaper than copying it: modified values, including the
+        ones of the original, and objects that are only equal to themselves.
+        """
+        cached = self._instance_copies.get(i)
+        if cached is not None:
+            original, instance_copy, guard = cached
+            if original is instance and not guard.mutated and instance_copy == instance:
+                return instance_copy
+
+        guard = MutationGuard()
+        instance_copy = guarded_copy(instance, guard)
+        self._instance_copies[i] = (instance, instance_copy, guard)
+        return instance_copy
+
     def run(self):
         """ Run all instances. """
 
@@ -811,16 +934,14 @@ class AgentCheck(object):
                 min_collection_interval = instance.get('min_collection_interval', self.min_collection_interval)
 
                 now = time.time()
-                if now - self.last_collection_time[i] < min_collection_interval:
+                if not self._is_instance_due(i, min_collection_interval, now):
                     self.log.debug("Not running instance #{0} of check {1} as it ran less than {2}s ago".format(i, self.name, min_collection_interval))
                     continue
 
-                self.last_collection_time[i] = now
-
                 check_start_time = None
                 if self.in_developer_mode:
                     check_start_time = timeit.default_timer()
-                self.check(copy.deepcopy(instance))
+                self.check(self._get_instance_copy(i, instance))
 
                 instance_check_stats = None
                 if check_start_time is not None:
@@ -911,6 +1032,12 @@ class AgentCheck(object):
         :param fix_case A boolean, indicating whether to make sure that
                         the metric name returned is in underscore_case
         """
+        # Checks normalize the same names at every run
+        key = (metric, prefix, fix_case)
+        normalized = self._normalize_cache.get(key)
+        if normalized is not None:
+            return normalized
+
         if isinstance(metric, unicode):
             metric_name = unicodedata.normalize('NFKD', metric).encode('ascii','ignore')
         else:
@@ -921,20 +1048,15 @@ class AgentCheck(object):
             if prefix is not None:
                 prefix = self.convert_to_underscore_separated(prefix)
         else:
-            name = re.sub(r"[,\@\+\*\-/()\[\]{}\s]", "_", metric_name)
-        # Eliminate multiple _
-        name = re.sub(r"__+", "_", name)
-        # Don't start/end with _
-        name = re.sub(r"^_", "", name)
-        name = re.sub(r"_$", "", name)
-        # Drop ._ and _.
-        name = re.sub(r"\._", ".", name)
-        name = re.sub(r"_\.", ".", name)
+            name = metric_name
+        name = _clean_metric_name(name)
 
         if prefix is not None:
-            return prefix + "." + name
+            normalized = prefix + "." + name
         else:
-            return name
+            normalized = name
+        self._normalize_cache.set(key, normalized)
+        return normalized
 
     FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
     ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
@@ -7,12 +7,15 @@ This module contains classes which are used to occasionally persist the status
 of checks.
 """
 # stdlib
+import binascii
 from collections import defaultdict
 import cPickle as pickle
 import datetime
 import logging
+import mmap
 import os
 import platform
+import struct
 import sys
 import tempfile
 import time
@@ -43,6 +46,15 @@ STATUS_WARNING = 'WARNING'
 
 NTP_OFFSET_THRESHOLD = 60
 
+# Counters files: magic, layout version and number of the last complete update,
+# then the pid and time of the update and the counters, then the number of the
+# update in progress
+COUNTERS_MAGIC = 'DDST'
+COUNTERS_HEADER = struct.Struct('<4sII')
+COUNTERS_TRAILER = struct.Struct('<I')
+# Attempts at reading a counters file that isn't being updated
+COUNTERS_READ_ATTEMPTS = 10
+
 
 log = logging.getLogger(__name__)
 
@@ -157,12 +169,75 @@ def validate_api_key(config):
 
     return "API Key is valid"
 
+def _counters_layout(counters):
+    """ Return the (body struct, file size, layout version) of a counters file """
+    body = struct.Struct('<qd' + ''.join(fmt for _, fmt in counters))
+    size = COUNTERS_HEADER.size + body.size + COUNTERS_TRAILER.size
+    # Readers don't take counters of another layout
+    version = binascii.crc32(repr(counters)) & 0xffffffff
+    return body, size, version
+
+
+class CountersFile(object):
+    """
+    The counters of a status, published in a memory mapped file updated in
+    place: publishing them is a memory copy, without any system call.
+    """
+
+    def __init__(self, path, counters):
+        self.path = path
+        self.body, self.size, self.version = _counters_layout(counters)
+        self.pid = os.getpid()
+        self.update = 0
+
+        self._file = open(path, 'w+b')
+        self._file.truncate(self.size)
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def publish(self, created_at, values):
+        self.update += 1
+        # The update in progress first and the complete one last: a reader that
+        # gets the same number at the start and the end has consistent values
+        COUNTERS_TRAILER.pack_into(self._map, self.size - COUNTERS_TRAILER.size, self.update)
+        self.body.pack_into(self._map, COUNTERS_HEADER.size, self.pid, created_at, *values)
+        COUNTERS_HEADER.pack_into(self._map, 0, COUNTERS_MAGIC, self.version, self.update)
+
+    @classmethod
+    def read(cls, path, counters):
+        """ Return the (pid, time, values) of the counters file at `path`, None if there's none """
+        body, size, version = _counters_layout(counters)
+        for _ in xrange(COUNTERS_READ_ATTEMPTS):
+            with open(path, 'rb') as f:
+                data = f.read(size)
+            if len(data) != size:
+                return None
+            magic, file_version, complete = COUNTERS_HEADER.unpack_from(data)
+            if magic != COUNTERS_MAGIC or file_version != version:
+                return None
+            if complete == COUNTERS_TRAILER.unpack_from(data, size - COUNTERS_TRAILER.size)[0]:
+                values = body.unpack_from(data, COUNTERS_HEADER.size)
+                return values[0], values[1], values[2:]
+            # Read during an update
+            time.sleep(0.001)
+        return None
+
+
 class AgentStatus(object):
     """
     A small class used to load and save status messages to the filesystem.
     """
 
     NAME = None
+    # (attribute, struct format) of the statuses made of numbers only: they're
+    # published in place in a memory mapped file instead of being pickled
+    COUNTERS = None
+
+    # The counters files opened by this process, by status class
+    _counters_files = {}
 
     def __init__(self):
         self.created_at = datetime.datetime.now()
@@ -173,6 +248,9 @@ class AgentStatus(object):
 
     def persist(self):
         try:
+            if self.COUNTERS:
+                self._publish_counters()
+                return
             path = self._get_pickle_path()
             log.debug("Persisting status to %s" % path)
             f = open(path, 'w')
@@ -183,6 +261,18 @@ class AgentStatus(object):
         except Exception:
             log.exception("Error persisting status")
 
+    def _publish_counters(self):
+        cls = type(self)
+        counters_file = AgentStatus._counters_files.get(cls)
+        if counters_file is None or counters_file.pid != os.getpid():
+            path = cls._get_counters_path()
+            log.debug("Publishing status to %s" % path)
+            counters_file = AgentStatus._counters_files[cls] = CountersFile(path, cls.COUNTERS)
+        counters_file.publish(
+            time.mktime(self.created_at.timetuple()) + self.created_at.microsecond / 1e6,
+            [getattr(self, name) for name, _ in cls.COUNTERS]
+        )
+
     def created_seconds_ago(self):
         td = datetime.datetime.now() - self.created_at
         return td.seconds
@@ -260,13 +350,19 @@ class AgentStatus(object):
     @classmethod
     def remove_latest_status(cls):
         log.debug("Removing latest status")
+        if cls.COUNTERS:
+            counters_file = AgentStatus._counters_files.pop(cls, None)
+            if counters_file is not None:
+                counters_file.close()
         try:
-            os.remove(cls._get_pickle_path())
+            os.remove(cls._get_counters_path() if cls.COUNTERS else cls._get_pickle_path())
         except OSError:
             pass
 
     @classmethod
     def load_latest_status(cls):
+        if cls.COUNTERS:
+            return cls._load_counters()
         try:
             f = open(cls._get_pickle_path())
             try:
@@ -276,6 +372,20 @@ class AgentStatus(object):
         except (IOError, EOFError):
             return None
 
+    @classmethod
+    def _load_counters(cls):
+        try:
+            counters = CountersFile.read(cls._get_counters_path(), cls.COUNTERS)
+        except IOError:
+            return None
+        if counters is None:
+            return None
+        pid, created_at, values = counters
+        status = cls(**dict(zip((name for name, _ in cls.COUNTERS), values)))
+        status.created_at = datetime.datetime.fromtimestamp(created_at)
+        status.created_by_pid = pid
+        return status
+
     @classmethod
     def print_latest_status(cls, verbose=False):
         cls.verbose = verbose
@@ -302,7 +412,7 @@ class AgentStatus(object):
         return exit_code
 
     @classmethod
-    def _get_pickle_path(cls):
+    def _get_status_dir(cls):
         if Platform.is_win32():
             path = os.path.join(_windows_commondata_path(), 'Datadog')
             if not os.path.isdir(path):
@@ -311,7 +421,15 @@ class AgentStatus(object):
             path = PidFile.get_dir()
         else:
             path = tempfile.gettempdir()
-        return os.path.join(path, cls.__name__ + '.pickle')
+        return path
+
+    @classmethod
+    def _get_pickle_path(cls):
+        return os.path.join(cls._get_status_dir(), cls.__name__ + '.pickle')
+
+    @classmethod
+    def _get_counters_path(cls):
+        return os.path.join(cls._get_status_dir(), cls.__name__ + '.status')
 
 
 class InstanceStatus(object):
@@ -392,11 +510,12 @@ class CollectorStatus(AgentStatus):
 
     NAME = 'Collector'
 
-    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None):
+    def __init__(self, check_statuses=None, emitter_statuses=None, metadata=None, checks_load_stats=None):
         AgentStatus.__init__(self)
         self.check_statuses = check_statuses or []
         self.emitter_statuses = emitter_statuses or []
         self.host_metadata = metadata or []
+        self.checks_load_stats = checks_load_stats
 
     @property
     def status(self):
@@ -544,6 +663,29 @@ class CollectorStatus(AgentStatus):
 
         lines.append('')
 
+        # Checks.d loading
+        lines += [
+            'Checks loading',
+            '==============',
+            ''
+        ]
+        load_stats = getattr(self, 'checks_load_stats', None)
+        if not load_stats:
+            lines.append("  No checks have been loaded yet.")
+        else:
+            timings = load_stats['timings']
+            lines += [
+                "  %s config%s (%s parsed), %s check%s (%s unchanged) loaded in %.2fs" % (
+                    load_stats['configs'], plural(load_stats['configs']), load_stats['parsed_configs'],
+                    load_stats['checks'], plural(load_stats['checks']), load_stats['reused_checks'],
+                    timings['total']),
+                "    - Parse configs: %.2fs" % timings['configs'],
+                "    - Service discovery: %.2fs" % timings['service_discovery'],
+                "    - Import checks: %.2fs" % timings['imports'],
+                "    - Initialize checks: %.2fs" % timings['initialization'],
+            ]
+        lines.append('')
+
         # Checks.d Status
         lines += [
             'Checks',
@@ -694,6 +836,8 @@ class CollectorStatus(AgentStatus):
                         status_info['hostnames'][key] = host
                         break
 
+        status_info['checks_load'] = getattr(self, 'checks_load_stats', None)
+
         # Checks.d Status
         status_info['checks'] = {}
         check_statuses = self.check_statuses + get_jmx_status()
@@ -762,9 +906,36 @@ class CollectorStatus(AgentStatus):
 class DogstatsdStatus(AgentStatus):
 
     NAME = 'Dogstatsd'
+    COUNTERS = (
+        ('flush_count', 'q'),
+        ('packet_count', 'q'),
+        ('packets_per_second', 'd'),
+        ('metric_count', 'q'),
+        ('event_count', 'q'),
+        ('service_check_count', 'q'),
+        ('dropped_packet_count', 'q'),
+        ('batch_count', 'q'),
+        ('avg_batch_size', 'd'),
+        ('max_batch_size', 'q'),
+        ('context_cache_hits', 'q'),
+        ('context_cache_misses', 'q'),
+        ('context_cache_evictions', 'q'),
+        ('discarded_context_point_count', 'q'),
+        ('flush_duration', 'd'),
+        ('request_count', 'q'),
+        ('avg_request_latency', 'd'),
+        ('max_request_latency', 'd'),
+        ('reused_connection_count', 'q'),
+        ('dropped_flush_count', 'q'),
+    )
 
     def __init__(self, flush_count=0, packet_count=0, packets_per_second=0,
-                 metric_count=0, event_count=0, service_check_count=0):
+                 metric_count=0, event_count=0, service_check_count=0,
+                 dropped_packet_count=0, batch_count=0, avg_batch_size=0,
+                 max_batch_size=0, context_cache_hits=0, context_cache_misses=0,
+                 context_cache_evictions=0, discarded_context_point_count=0,
+                 flush_duration=0, request_count=0, avg_request_latency=0,
+                 max_request_latency=0, reused_connection_count=0, dropped_flush_count=0):
         AgentStatus.__init__(self)
         self.flush_count = flush_count
         self.packet_count = packet_count
@@ -772,6 +943,20 @@ class DogstatsdStatus(AgentStatus):
         self.metric_count = metric_count
         self.event_count = event_count
         self.service_check_count = service_check_count
+        self.dropped_packet_count = dropped_packet_count
+        self.batch_count = batch_count
+        self.avg_batch_size = avg_batch_size
+        self.max_batch_size = max_batch_size
+        self.context_cache_hits = context_cache_hits
+        self.context_cache_misses = context_cache_misses
+        self.context_cache_evictions = context_cache_evictions
+        self.discarded_context_point_count = discarded_context_point_count
+        self.flush_duration = flush_duration
+        self.request_count = request_count
+        self.avg_request_latency = avg_request_latency
+        self.max_request_latency = max_request_latency
+        self.reused_connection_count = reused_connection_count
+        self.dropped_flush_count = dropped_flush_count
 
     def has_error(self):
         return self.flush_count == 0 and self.packet_count == 0 and self.metric_count == 0
@@ -784,7 +969,26 @@ class DogstatsdStatus(AgentStatus):
             "Metric count: %s" % self.metric_count,
             "Event count: %s" % self.event_count,
             "Service check count: %s" % self.service_check_count,
+            "Context cache hits/misses/evictions: %s/%s/%s" % (
+                self.context_cache_hits, self.context_cache_misses, self.context_cache_evictions),
         ]
+        if self.discarded_context_point_count:
+            lines.append("Points discarded by the context limit: %s" % self.discarded_context_point_count)
+        if self.request_count:
+            lines += [
+                "Flush duration (ms): %s" % self.flush_duration,
+                "Requests: %s (%s on reused connections)" % (self.request_count, self.reused_connection_count),
+                "Request latency avg/max (ms): %s/%s" % (self.avg_request_latency, self.max_request_latency),
+            ]
+        if self.dropped_flush_count:
+            lines.append("Flushes dropped by a slow intake: %s" % self.dropped_flush_count)
+        if self.batch_count:
+            lines += [
+                "Dropped packet count: %s" % self.dropped_packet_count,
+                "Batch count: %s" % self.batch_count,
+                "Average batch size: %s" % self.avg_batch_size,
+                "Max batch size: %s" % self.max_batch_size,
+            ]
         return lines
 
     def to_dict(self):
@@ -796,6 +1000,20 @@ class DogstatsdStatus(AgentStatus):
             'metric_count': self.metric_count,
             'event_count': self.event_count,
             'service_check_count': self.service_check_count,
+            'dropped_packet_count': self.dropped_packet_count,
+            'batch_count': self.batch_count,
+            'avg_batch_size': self.avg_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'context_cache_hits': self.context_cache_hits,
+            'context_cache_misses': self.context_cache_misses,
+            'context_cache_evictions': self.context_cache_evictions,
+            'discarded_context_point_count': self.discarded_context_point_count,
+            'flush_duration': self.flush_duration,
+            'request_count': self.request_count,
+            'avg_request_latency': self.avg_request_latency,
+            'max_request_latency': self.max_request_latency,
+            'reused_connection_count': self.reused_connection_count,
+            'dropped_flush_count': self.dropped_flush_count,
         })
         return status_info
 
@@ -814,6 +1032,14 @@ class DogstatsdStatus(AgentStatus):
 class ForwarderStatus(AgentStatus):
 
     NAME = 'Forwarder'
+    COUNTERS = (
+        ('queue_length', 'q'),
+        ('queue_size', 'q'),
+        ('flush_count', 'q'),
+        ('transactions_received', 'q'),
+        ('transactions_flushed', 'q'),
+        ('transactions_rejected', 'q'),
+    )
 
     def __init__(self, queue_length=0, queue_size=0, flush_count=0, transactions_received=0,
                  transactions_flushed=0, transactions_rejected=0):
@@ -7,6 +7,7 @@ import collections
 import locale
 import logging
 import pprint
+import Queue
 import socket
 import sys
 import time
@@ -25,15 +26,16 @@ from checks.check_status import (
     CheckStatus,
     CollectorStatus,
     EmitterStatus,
+    InstanceStatus,
     STATUS_ERROR,
     STATUS_OK,
 )
 from checks.datadog import Dogstreams
 from checks.ganglia import Ganglia
+from checks.libs.thread_pool import Pool
 from config import (
-    PY3_COMPATIBILITY_ATTR,
-    PY3_COMPATIBILITY_READY,
     AGENT_VERSION,
+    DEFAULT_CHECK_TIMEOUT,
     get_system_stats,
     get_version,
 )
@@ -45,6 +47,7 @@ from utils.cloud_metadata import GCE, EC2, CloudFoundry, Azure
 from utils.logger import log_exceptions, RedactedLogRecord
 from utils.jmx import JMXFiles
 from utils.platform import Platform, get_os
+from utils.py3_validation import PY3_COMPATIBILITY_ATTR, PY3_COMPATIBILITY_READY
 from utils.subprocess_output import get_subprocess_output
 from utils.timer import Timer
 from utils.orchestrator import MetadataCollector
@@ -205,6 +208,16 @@ class Collector(object):
         self.hostname_metadata_cache = None
         self.initialized_checks_d = []
         self.init_failed_checks_d = {}
+        # Number of configs and checks loaded, and time spent in each phase of the load
+        self.checks_load_stats = None
+
+        # With more than one worker, the checks.d checks run concurrently,
+        # each with a deadline of `check_timeout` seconds
+        self.check_workers = int(agentConfig.get('check_workers') or 1)
+        self.check_timeout = float(agentConfig.get('check_timeout') or DEFAULT_CHECK_TIMEOUT)
+        self.check_pool = None
+        # Last run of each check, which may still be running if it timed out
+        self.check_runs = {}
 
         if Platform.is_linux() and psutil is not None:
             procfs_path = agentConfig.get('procfs_path', '/proc').rstrip('/')
@@ -263,15 +276,120 @@ class Collector(object):
         self.continue_running = False
         for check in self.initialized_checks_d:
             check.stop()
+        if self.check_pool is not None:
+            self.check_pool.terminate()
+        if self._dogstream is not None:
+            self._dogstream.stop()
+
+    def _run_check(self, check, start_times=None):
+        """
+        Run a checks.d check, return it with its
+        (instance_statuses, check_stats, run_time).
+        """
+        start_time = time.time()
+        if start_times is not None:
+            start_times[check] = start_time
+
+        instance_statuses = []
+        check_stats = None
+        try:
+            instance_statuses = check.run()
+            check_stats = check._get_internal_profiling_stats()
+        except Exception:
+            log.exception("Error running check %s" % check.name)
+
+        return check, (instance_statuses, check_stats, time.time() - start_time)
+
+    def _report_check_timeout(self, check, check_statuses, service_checks):
+        """
+        Add the status and service check of a check that didn't finish in time,
+        without touching the check itself since it's still running.
+        """
+        error = "Check didn't finish within %ss" % self.check_timeout
+        instance_statuses = [
+            InstanceStatus(i, STATUS_ERROR, error=Exception(error))
+            for i in xrange(len(check.instances))
+        ]
+        check_statuses.append(CheckStatus(
+            check.name, instance_statuses, service_metadata=[{}] * len(instance_statuses),
+            source_type_name=check.SOURCE_TYPE_NAME or check.name,
+            check_version=check.check_version
+        ))
+        service_checks.append(create_service_check(
+            'datadog.agent.check_status', AgentCheck.CRITICAL,
+            tags=["check:%s" % check.name], hostname=self.hostname, message=error
+        ))
+
+    def _run_checks_d_serially(self, log_at_first_run):
+        """ Run the checks.d checks one after the other, yield their runs """
+        for check in self.initialized_checks_d:
+            if not self.continue_running:
+                return
+            log_at_first_run("Running check %s", check.name)
+            yield self._run_check(check)
+
+    def _run_checks_d_concurrently(self, log_at_first_run):
+        """
+        Run the checks.d checks in the check pool, yield their runs as they
+        finish. The run of a check that doesn't finish within `check_timeout`
+        seconds of its start is None, the check won't run again until it's done.
+        """
+        if self.check_pool is None:
+            self.check_pool = Pool(self.check_workers, name="Checks")
+
+        # Forget the runs of the checks replaced by a reload
+        self.check_runs = dict(
+            (check, check_run) for check, check_run in self.check_runs.iteritems()
+            if check in self.initialized_checks_d
+        )
+
+        done = Queue.Queue()
+        start_times = {}
+        collection_start_time = time.time()
+        running = set()
+        for check in self.initialized_checks_d:
+            last_run = self.check_runs.get(check)
+            if last_run is not None and not last_run.ready():
+                log.warning("Check %s is still running, skipping it", check.name)
+                yield check, None
+                continue
+            log_at_first_run("Running check %s", check.name)
+            self.check_runs[check] = self.check_pool.apply_async(
+                self._run_check, (check, start_times), callback=done.put)
+            running.add(check)
+
+        while running:
+            if not self.continue_running:
+                return
+            # The checks waiting for a worker time out from the start of the collection
+            deadline = min(start_times.get(c, collection_start_time) for c in running) + self.check_timeout
+            try:
+                check, check_run = done.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                now = time.time()
+                for check in list(running):
+                    if start_times.get(check, collection_start_time) + self.check_timeout <= now:
+                        log.warning("Check %s didn't finish within %ss", check.name, self.check_timeout)
+                        running.remove(check)
+                        yield check, None
+                continue
+
+            running.discard(check)
+            yield check, check_run
 
     @staticmethod
     def _stats_for_display(raw_stats):
         return pprint.pformat(raw_stats, indent=4)
 
     @log_exceptions(log)
-    def run(self, checksd=None, start_event=True, configs_reloaded=False):
+    def run(self, checksd=None, start_event=True, configs_reloaded=False,
+            scheduled_time=None, overrun_count=0):
         """
         Collect data from each check and submit their data.
+
+        `scheduled_time` is the time the run was due at, and `overrun_count`
+        the number of runs the previous one delayed or skipped by lasting longer
+        than the check frequency, they're sent as the schedule lag and overruns.
         """
         log.debug("Found {num_checks} checks".format(num_checks=len(checksd['initialized_checks'])))
         timer = Timer()
@@ -283,6 +401,7 @@ class Collector(object):
         if checksd:
             self.initialized_checks_d = checksd['initialized_checks']  # is a list of AgentCheck instances
             self.init_failed_checks_d = checksd['init_failed_checks']  # is of type {check_name: {error, traceback}}
+            self.checks_load_stats = checksd.get('load_stats')
 
         payload = AgentPayload()
 
@@ -409,25 +528,29 @@ class Collector(object):
 
         # checks.d checks
         check_statuses = []
-        for check in self.initialized_checks_d:
+        if self.check_workers > 1:
+            check_runs = self._run_checks_d_concurrently(log_at_first_run)
+        else:
+            check_runs = self._run_checks_d_serially(log_at_first_run)
+
+        for check, check_run in check_runs:
             if not self.continue_running:
                 return
-            log_at_first_run("Running check %s", check.name)
-            instance_statuses = []
             metric_count = 0
             event_count = 0
             service_check_count = 0
-            check_start_time = time.time()
-            check_stats = None
+            current_check_metadata = []
+            if check_run is None:
+                # The check is still running, report all its instances as failing,
+                # what it collects is kept for the run after it finishes
+                self._report_check_timeout(check, check_statuses, service_checks)
+                continue
 
+            instance_statuses, check_stats, check_run_time = check_run
             try:
-                # Run the check.
-                instance_statuses = check.run()
-
                 # Collect the metrics and events.
                 current_check_metrics = check.get_metrics()
                 current_check_events = check.get_events()
-                check_stats = check._get_internal_profiling_stats()
 
                 # Collect metadata
                 current_check_metadata = check.get_service_metadata()
@@ -474,7 +597,6 @@ class Collector(object):
             check_status.service_check_count = service_check_count
             check_statuses.append(check_status)
 
-            check_run_time = time.time() - check_start_time
             log.debug("Check %s ran in %.2f s" % (check.name, check_run_time))
 
             # Intrument check run timings if enabled.
@@ -511,6 +633,13 @@ class Collector(object):
         service_checks.append(create_service_check('datadog.agent.up', AgentCheck.OK,
                               hostname=self.hostname))
 
+        # Instrument the collector schedule
+        if scheduled_time is not None:
+            now = time.time()
+            metrics.append(('datadog.agent.collector.schedule_lag', now,
+                            max(0, timer.started - scheduled_time), {}))
+            metrics.append(('datadog.agent.collector.overruns', now, overrun_count, {}))
+
         # Store the metrics and events in the payload.
         payload['metrics'] = metrics
         payload['events'] = events
@@ -562,7 +691,7 @@ class Collector(object):
         # Persist the status of the collection run.
         try:
             CollectorStatus(check_statuses, emitter_statuses,
-                            self.hostname_metadata_cache).persist()
+                            self.hostname_metadata_cache, self.checks_load_stats).persist()
         except Exception:
             log.exception("Error persisting collector status")
 
@@ -5,16 +5,29 @@
 # stdlib
 from datetime import datetime
 import glob
-from itertools import groupby
 import os
+import tempfile
 import time
 import traceback
 
+# 3p
+import simplejson as json
+
 # project
+from checks.libs.thread_pool import Pool
+from config import _windows_commondata_path
 import modules
 from util import windows_friendly_colon_split
+from utils.pidfile import PidFile
+from utils.platform import Platform
 from utils.tailfile import TailFile
 
+# Where the position of the dogstreams in their logs is kept across restarts
+POSITIONS_FILE = 'dogstream_positions.json'
+
+# Most lines parsed in a log each run, the rest is left for the next runs
+DEFAULT_MAX_LINES = 500000
+
 
 def partition(s, sep):
     pos = s.find(sep)
@@ -31,6 +44,14 @@ def point_sorter(p):
     # Include tags (or attibutes if tags do not exists) to determine the uniqueness of a metric.
     return (p[1], p[0], p[3].get('host_name'), p[3].get('device_name'), attribs)
 
+
+def point_key(metric, ts, attrs):
+    # Hashable equivalent of `point_sorter`, to aggregate points in a dict
+    tags = attrs.get('tags')
+    attribs = tuple(sorted(tags.split(","))) if tags is not None else tuple(sorted(attrs.iteritems()))
+    return (ts, metric, attrs.get('host_name'), attrs.get('device_name'), attribs)
+
+
 class EventDefaults(object):
     EVENT_TYPE = 'dogstream_event'
     EVENT_OBJECT = 'dogstream_event:default'
@@ -48,11 +69,57 @@ class Dogstreams(object):
         logger.warning("Dogstream is a deprecated feature, and is removed from version 6 of the Datadog Agent")
         logger.info("Dogstream parsers: %s" % repr(dogstreams))
 
-        return cls(logger, dogstreams)
+        return cls(logger, dogstreams, workers=int(config.get('dogstream_workers') or 1))
 
-    def __init__(self, logger, dogstreams):
+    def __init__(self, logger, dogstreams, workers=1):
         self.logger = logger
         self.dogstreams = dogstreams
+        # Logs tailed at the same time
+        self.workers = min(workers, len(dogstreams))
+        self.pool = None
+
+        self._positions = self._load_positions()
+        for dogstream in self.dogstreams:
+            dogstream.position = self._positions.get(dogstream.log_path)
+
+    @classmethod
+    def _get_positions_path(cls):
+        if Platform.is_win32():
+            path = os.path.join(_windows_commondata_path(), 'Datadog')
+            if not os.path.isdir(path):
+                path = tempfile.gettempdir()
+        elif os.path.isdir(PidFile.get_dir()):
+            path = PidFile.get_dir()
+        else:
+            path = tempfile.gettempdir()
+        return os.path.join(path, POSITIONS_FILE)
+
+    def _load_positions(self):
+        """ Return the last saved positions, by log path """
+        if not self.dogstreams:
+            return {}
+        try:
+            with open(self._get_positions_path()) as f:
+                return dict((path, tuple(position)) for path, position in json.load(f).iteritems())
+        except IOError:
+            return {}
+        except Exception:
+            self.logger.warning("Can't load the dogstream positions", exc_info=True)
+            return {}
+
+    def _save_positions(self):
+        positions = dict(
+            (dogstream.log_path, dogstream.position) for dogstream in self.dogstreams
+            if dogstream.position is not None
+        )
+        if positions == self._positions:
+            return
+        try:
+            with open(self._get_positions_path(), 'w') as f:
+                json.dump(positions, f)
+            self._positions = positions
+        except Exception:
+            self.logger.warning("Can't save the dogstream positions", exc_info=True)
 
     @classmethod
     def _instantiate_dogstreams(cls, logger, config, dogstreams_config):
@@ -104,22 +171,41 @@ class Dogstreams(object):
         if not self.dogstreams:
             return {}
 
+        if self.workers > 1:
+            if self.pool is None:
+                self.pool = Pool(self.workers, name="Dogstreams")
+            results = self.pool.imap(lambda d: self._check_dogstream(d, agentConfig, move_end),
+                                     self.dogstreams)
+        else:
+            results = (self._check_dogstream(d, agentConfig, move_end) for d in self.dogstreams)
+
         output = {}
-        for dogstream in self.dogstreams:
-            try:
-                result = dogstream.check(agentConfig, move_end)
-                # result may contain {"dogstream": [new]}.
-                # If output contains {"dogstream": [old]}, that old value will get concatenated with the new value
-                assert type(result) == type(output), "dogstream.check must return a dictionary"
-                for k in result:
-                    if k in output:
-                        output[k].extend(result[k])
-                    else:
-                        output[k] = result[k]
-            except Exception:
-                self.logger.exception("Error in parsing %s" % (dogstream.log_path))
+        for result in results:
+            # result may contain {"dogstream": [new]}.
+            # If output contains {"dogstream": [old]}, that old value will get concatenated with the new value
+            for k in result:
+                if k in output:
+                    output[k].extend(result[k])
+                else:
+                    output[k] = result[k]
+
+        self._save_positions()
         return output
 
+    def _check_dogstream(self, dogstream, agentConfig, move_end):
+        try:
+            result = dogstream.check(agentConfig, move_end)
+            assert type(result) == dict, "dogstream.check must return a dictionary"
+            return result
+        except Exception:
+            self.logger.exception("Error in parsing %s" % (dogstream.log_path))
+            return {}
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
 
 class Dogstream(object):
 
@@ -164,8 +250,12 @@ class Dogstream(object):
         self.parse_func = parse_func or self._default_line_parser
         self.parse_args = parse_args
 
+        self._tail = None
         self._gen = None
-        self._values = None
+        # (inode, offset, crc) of the data parsed so far, None until the log is opened
+        self.position = None
+        # Points aggregated as they're parsed, by `point_key`
+        self._points = None
         self._freq = 15 # Will get updated on each check()
         self._error_count = 0L
         self._line_count = 0L
@@ -174,27 +264,30 @@ class Dogstream(object):
     def check(self, agentConfig, move_end=True):
         if self.log_path:
             self._freq = int(agentConfig.get('check_freq', 15))
-            self._values = []
+            self._points = {}
             self._events = []
 
             # Build our tail -f
             if self._gen is None:
-                self._gen = TailFile(self.logger, self.log_path, self._line_parser).tail(line_by_line=False, move_end=move_end)
+                max_lines = int(agentConfig.get('dogstream_max_lines') or DEFAULT_MAX_LINES)
+                self._tail = TailFile(self.logger, self.log_path, self._line_parser)
+                self._gen = self._tail.tail(line_by_line=False, move_end=move_end,
+                                            position=self.position, max_lines=max_lines)
 
             # read until the end of file
             try:
                 self._gen.next()
+                self.position = self._tail.position()
                 self.logger.debug("Done dogstream check for file {0}".format(self.log_path))
-                self.logger.debug("Found {0} metric points".format(len(self._values)))
+                self.logger.debug("Found {0} metric points".format(len(self._points)))
             except StopIteration as e:
                 self.logger.exception(e)
                 self.logger.warn("Can't tail %s file" % self.log_path)
                 # reset generator to try again during the next check interval
                 self._gen = None
 
-            self.logger.debug("Pre-aggregated metrics: {0}".format(self._values))
-            check_output = self._aggregate(self._values)
-            self.logger.debug("Aggregated metrics: {0}".format(check_output))
+            check_output = self._aggregate()
+            self.logger.debug("Aggregated metrics: %s", check_output)
             if self._events:
                 check_output.update({"dogstreamEvents": self._events})
                 self.logger.debug("Found {0} events".format(len(self._events)))
@@ -276,7 +369,7 @@ class Dogstream(object):
                     self.logger.debug('Invalid parsed values %s (%s): "%s"',
                         repr(datum), ', '.join(invalid_reasons), line)
                 else:
-                    self._values.append((metric, ts, value, attrs))
+                    self._add_point(metric, ts, value, attrs)
         except Exception:
             self.logger.debug("Error while parsing line %s" % line, exc_info=True)
             self._error_count += 1
@@ -299,44 +392,41 @@ class Dogstream(object):
 
         return metric, timestamp, value, attributes
 
-    def _aggregate(self, values):
+    def _add_point(self, metric, ts, value, attrs):
+        key = point_key(metric, ts, attrs)
+        try:
+            point = self._points.get(key)
+        except TypeError:
+            # Attributes that can't be hashed
+            key = key[:-1] + (repr(key[-1]),)
+            point = self._points.get(key)
+        if point is None:
+            # Last value, sum of the values, attributes
+            self._points[key] = [value, value, dict(attrs)]
+        else:
+            point[0] = value
+            point[1] += value
+            point[2].update(attrs)
+
+    def _aggregate(self):
         """ Aggregate values down to the second and store as:
             {
                 "dogstream": [(metric, timestamp, value, {key: val})]
             }
-            If there are many values per second for a metric, take the median
+            If there are many values per second for a metric, take the last
+            one, or their sum for counters
         """
         output = []
 
-        values.sort(key=point_sorter)
-
-        for (timestamp, metric, host_name, device_name, attribs), val_attrs in groupby(values, key=point_sorter):
-            attributes = {}
-            vals = []
-            for _metric, _timestamp, v, a in val_attrs:
-                try:
-                    v = float(v)
-                    vals.append(v)
-                    attributes.update(a)
-                except Exception:
-                    self.logger.debug("Could not convert %s into a float", v)
-
-            if len(vals) == 1:
-                val = vals[0]
-            elif len(vals) > 1:
-                val = vals[-1]
-            else: # len(vals) == 0
-                continue
-
+        for (timestamp, metric, _, _, _), (val, total, attributes) in self._points.iteritems():
             metric_type = str(attributes.get('metric_type', '')).lower()
-            if metric_type == 'gauge':
-                val = float(val)
-            elif metric_type == 'counter':
-                val = sum(vals)
+            if metric_type == 'counter':
+                val = total
 
             output.append((metric, timestamp, val, attributes))
 
         if output:
+            output.sort(key=point_sorter)
             return {"dogstream": output}
         else:
             return {}
@@ -0,0 +1,232 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+"""
+Run a checks.d check in a worker process of its own, so that a CPU-heavy check
+doesn't hold the GIL of the collector.
+
+Enabled per check in its `init_config`:
+
+    init_config:
+      process_isolation: true
+      # Restart the worker when its memory goes above this many MB
+      process_memory_limit: 256
+
+The worker is forked from the collector with the check in it. Each run, the
+collector asks the worker to run the check and gets back in one message
+(pickled, over a pipe) the instance statuses and everything the check
+submitted. A worker that doesn't answer within `check_timeout` seconds is
+killed, and restarted by the next run.
+"""
+
+# stdlib
+import logging
+import multiprocessing
+import os
+import signal
+import traceback
+
+# 3p
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# project
+from checks import check_status
+from utils.logger import reset_logging_locks
+
+log = logging.getLogger(__name__)
+
+# Messages sent to the worker
+RUN = 'run'
+STOP = 'stop'
+
+# Time (in seconds) given to a worker to stop before it's killed
+WORKER_STOP_TIMEOUT = 5
+
+
+def _run_worker(check, conn, memory_limit):
+    """
+    Main loop of the worker process: run the check and send back what it
+    collected each time the collector asks for it.
+    """
+    # Workers can be forked while other threads run, e.g. when the checks run
+    # concurrently
+    reset_logging_locks()
+
+    # The signals sent to the agent are its own business, the worker is
+    # stopped by the agent when it exits
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(signum, signal.SIG_IGN)
+
+    process = None
+    if memory_limit and psutil is not None:
+        process = psutil.Process(os.getpid())
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            # The collector is gone
+            break
+        if message != RUN:
+            break
+
+        result, error = None, None
+        try:
+            result = (
+                check.run(),
+                check.get_metrics(),
+                check.get_events(),
+                check.get_service_checks(),
+                check.get_service_metadata(),
+                check._get_internal_profiling_stats(),
+            )
+        except Exception:
+            error = traceback.format_exc()
+
+        over_memory_limit = process is not None and process.memory_info().rss > memory_limit
+        conn.send((result, error, over_memory_limit))
+        if over_memory_limit:
+            break
+
+    check.stop()
+    conn.close()
+
+
+class ProcessIsolatedCheck(object):
+    """
+    Stands for a check in the collector while it runs in a worker process.
+
+    Only running the check and getting what it collected go to the worker,
+    everything else is delegated to the check in the collector, which is
+    never run.
+    """
+
+    def __init__(self, check, memory_limit=None, timeout=None):
+        self.check = check
+        # In bytes
+        self.memory_limit = memory_limit
+        # In seconds, a run can last forever if None
+        self.timeout = timeout
+        if memory_limit and psutil is None:
+            log.warning("psutil is missing, the memory of the worker process of "
+                        "check %s won't be limited", check.name)
+        self.worker = None
+        self.conn = None
+        self.worker_restarts = 0
+
+        self._metrics = []
+        self._events = []
+        self._service_checks = []
+        self._service_metadata = []
+        self._internal_profiling_stats = None
+
+        self._start_worker()
+
+    def __getattr__(self, name):
+        return getattr(self.check, name)
+
+    def _start_worker(self):
+        self.conn, worker_conn = multiprocessing.Pipe()
+        self.worker = multiprocessing.Process(
+            target=_run_worker, args=(self.check, worker_conn, self.memory_limit),
+            name="%s check" % self.check.name
+        )
+        self.worker.daemon = True
+        self.worker.start()
+        # Only the worker holds its end, so that `recv` fails if it dies
+        worker_conn.close()
+        log.debug("Started worker process %s for check %s", self.worker.pid, self.check.name)
+
+    def _stop_worker(self, kill=False):
+        if self.worker is None:
+            return
+        if not kill:
+            try:
+                self.conn.send(STOP)
+            except (IOError, EOFError):
+                pass
+            self.worker.join(WORKER_STOP_TIMEOUT)
+        if self.worker.is_alive():
+            self.worker.terminate()
+            self.worker.join()
+        self.conn.close()
+        self.worker = None
+        self.conn = None
+
+    def _error_statuses(self, error):
+        return [
+            check_status.InstanceStatus(i, check_status.STATUS_ERROR, error=error)
+            for i in xrange(len(self.check.instances))
+        ]
+
+    def run(self):
+        """ Run all instances in the worker process. """
+        if self.worker is None:
+            self.worker_restarts += 1
+            log.info("Restarting the worker process of check %s", self.check.name)
+            self._start_worker()
+
+        try:
+            self.conn.send(RUN)
+            if not self.conn.poll(self.timeout):
+                log.warning("Check %s didn't finish within %ss, killing its worker process",
+                            self.check.name, self.timeout)
+                self._stop_worker(kill=True)
+                return self._error_statuses("Check didn't finish within %ss" % self.timeout)
+            result, error, over_memory_limit = self.conn.recv()
+        except (IOError, EOFError):
+            log.error("The worker process of check %s died, restarting it on the next run",
+                      self.check.name)
+            self._stop_worker()
+            return self._error_statuses("Worker process died")
+
+        if over_memory_limit:
+            log.warning("The worker process of check %s uses more than %sMB, restarting it",
+                        self.check.name, self.memory_limit / (1024 * 1024))
+            self._stop_worker()
+
+        if error is not None:
+            log.error("Check %s failed in its worker process:\n%s", self.check.name, error)
+            return self._error_statuses(error.strip().splitlines()[-1])
+
+        instance_statuses, metrics, events, service_checks, service_metadata, stats = result
+        self._metrics.extend(metrics)
+        self._events.extend(events)
+        self._service_checks.extend(service_checks)
+        self._service_metadata.extend(service_metadata)
+        self._internal_profiling_stats = stats
+
+        return instance_statuses
+
+    def get_metrics(self):
+        metrics = self._metrics
+        self._metrics = []
+        return metrics
+
+    def get_events(self):
+        events = self._events
+        self._events = []
+        return events
+
+    def get_service_checks(self):
+        # The collector submits the status of the check to the check itself
+        service_checks = self._service_checks + self.check.get_service_checks()
+        self._service_checks = []
+        return service_checks
+
+    def get_service_metadata(self):
+        service_metadata = self._service_metadata
+        self._service_metadata = []
+        return service_metadata
+
+    def _get_internal_profiling_stats(self):
+        stats = self._internal_profiling_stats
+        self._internal_profiling_stats = None
+        return stats
+
+    def stop(self):
+        self._stop_worker()
@@ -7,7 +7,9 @@ Unix system checks.
 """
 # stdlib
 import operator
+import os
 import platform
+import pwd
 import re
 import sys
 import time
@@ -29,6 +31,29 @@ from utils.subprocess_output import get_subprocess_output
 # locale-resilient float converter
 to_float = lambda s: float(s.replace(",", "."))
 
+# Fields of /proc/diskstats, after the major, minor and device name
+(DISK_READS, DISK_READS_MERGED, DISK_SECTORS_READ, DISK_READ_MS,
+ DISK_WRITES, DISK_WRITES_MERGED, DISK_SECTORS_WRITTEN, DISK_WRITE_MS,
+ DISK_IOS_IN_PROGRESS, DISK_IO_MS, DISK_WEIGHTED_IO_MS) = range(11)
+
+# Fields of the cpu line of /proc/stat
+(CPU_USER, CPU_NICE, CPU_SYSTEM, CPU_IDLE, CPU_IOWAIT, CPU_IRQ, CPU_SOFTIRQ,
+ CPU_STEAL, CPU_GUEST, CPU_GUEST_NICE) = range(10)
+
+# Fields of /proc/[pid]/stat, after the pid and command
+(PROC_STATE, PROC_PPID, PROC_PGRP, PROC_SESSION, PROC_TTY_NR, PROC_TPGID) = range(6)
+PROC_UTIME, PROC_STIME = 11, 12
+PROC_NICE, PROC_NUM_THREADS = 16, 17
+PROC_STARTTIME, PROC_VSIZE, PROC_RSS = 19, 20, 21
+
+# Characters ps shows as ?
+CONTROL_CHARS_RE = re.compile(r'[\x00-\x1f\x7f]')
+
+
+def _sysfs_block_path(proc_location):
+    # The sysfs mounted next to the procfs, /sys for /proc, /host/sys for /host/proc
+    return os.path.join(os.path.dirname(proc_location), 'sys', 'block')
+
 
 class IO(Check):
 
@@ -37,6 +62,8 @@ class IO(Check):
         self.header_re = re.compile(r'([%\\/\-_a-zA-Z0-9]+)[\s+]?')
         self.item_re = re.compile(r'^([\-a-zA-Z0-9\/]+)')
         self.value_re = re.compile(r'\d+\.\d+')
+        # (time, {device: counters}) of the previous run, on Linux
+        self._last_diskstats = None
 
     def _cap_io_util_value(self, val):
         # Cap system.io.util metric value to 102%
@@ -87,6 +114,77 @@ class IO(Check):
 
         return ioStats
 
+    def _read_diskstats(self, proc_location):
+        """
+        Return the counters of /proc/diskstats by device, for the devices
+        iostat reports: the disks, not their partitions, that have had I/O.
+        """
+        sysfs_block = _sysfs_block_path(proc_location)
+        disks = set(os.listdir(sysfs_block)) if os.path.isdir(sysfs_block) else None
+
+        diskstats = {}
+        with open("{}/diskstats".format(proc_location), 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 14:
+                    continue
+                device = fields[2]
+                if disks is not None and device.replace('/', '!') not in disks:
+                    continue
+                counters = [int(v) for v in fields[3:14]]
+                if counters[DISK_READS] or counters[DISK_WRITES]:
+                    diskstats[device] = counters
+        return diskstats
+
+    def _compute_linux_io(self, previous, current, interval):
+        """
+        Compute the extended stats of `iostat -d -x -k` from two snapshots of
+        /proc/diskstats taken `interval` seconds apart.
+        """
+        io = {}
+        for device, counters in current.iteritems():
+            if device not in previous:
+                continue
+            delta = [c - p for c, p in zip(counters, previous[device])]
+            # The counters of the device have been reset
+            if any(d < 0 for i, d in enumerate(delta) if i != DISK_IOS_IN_PROGRESS):
+                continue
+
+            reads, writes = delta[DISK_READS], delta[DISK_WRITES]
+            ios = reads + writes
+            sectors = delta[DISK_SECTORS_READ] + delta[DISK_SECTORS_WRITTEN]
+            io_ms = delta[DISK_READ_MS] + delta[DISK_WRITE_MS]
+            stats = {
+                'rrqm/s': delta[DISK_READS_MERGED] / interval,
+                'wrqm/s': delta[DISK_WRITES_MERGED] / interval,
+                'r/s': reads / interval,
+                'w/s': writes / interval,
+                # 512 bytes sectors
+                'rkB/s': delta[DISK_SECTORS_READ] / 2.0 / interval,
+                'wkB/s': delta[DISK_SECTORS_WRITTEN] / 2.0 / interval,
+                'avgrq-sz': float(sectors) / ios if ios else 0.0,
+                'avgqu-sz': delta[DISK_WEIGHTED_IO_MS] / 1000.0 / interval,
+                'await': float(io_ms) / ios if ios else 0.0,
+                'r_await': float(delta[DISK_READ_MS]) / reads if reads else 0.0,
+                'w_await': float(delta[DISK_WRITE_MS]) / writes if writes else 0.0,
+                'svctm': float(delta[DISK_IO_MS]) / ios if ios else 0.0,
+                '%util': self._cap_io_util_value(delta[DISK_IO_MS] / 10.0 / interval),
+            }
+            io[device] = dict((k, round(v, 2)) for k, v in stats.iteritems())
+        return io
+
+    def _check_linux(self, proc_location):
+        """
+        I/O stats of the Linux disks since the last run, from /proc/diskstats.
+        Nothing is returned on the first run.
+        """
+        now = time.time()
+        diskstats = self._read_diskstats(proc_location)
+        previous, self._last_diskstats = self._last_diskstats, (now, diskstats)
+        if previous is None or now <= previous[0]:
+            return {}
+        return self._compute_linux_io(previous[1], diskstats, now - previous[0])
+
     def _parse_darwin(self, output):
         lines = [l.split() for l in output.split("\n") if len(l) > 0]
         disks = lines[0]
@@ -129,7 +227,11 @@ class IO(Check):
         """
         io = {}
         try:
-            if Platform.is_linux():
+            proc_location = agentConfig.get('procfs_path', '/proc').rstrip('/')
+            if Platform.is_linux() and os.path.exists("{}/diskstats".format(proc_location)):
+                io = self._check_linux(proc_location)
+
+            elif Platform.is_linux():
                 stdout, _, _ = get_subprocess_output(['iostat', '-d', '1', '2', '-x', '-k'], self.logger)
 
                 #                 Linux 2.6.32-343-ec2 (ip-10-35-95-10)   12/11/2012      _x86_64_        (2 CPU)
@@ -602,28 +704,169 @@ class Memory(Check):
 
 class Processes(Check):
 
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        self._usernames = {}
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if Platform.is_linux() else 0
+
+    def _get_username(self, uid):
+        username = self._usernames.get(uid)
+        if username is None:
+            try:
+                username = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                username = str(uid)
+            # ps truncates the names that don't fit in its column
+            if len(username) > 8:
+                username = username[:7] + '+'
+            self._usernames[uid] = username
+        return username
+
+    def _format_tty(self, tty_nr):
+        major = (tty_nr >> 8) & 0xfff
+        minor = (tty_nr & 0xff) | ((tty_nr >> 12) & 0xfff00)
+        if 136 <= major <= 143:
+            return 'pts/{}'.format((major - 136) * 256 + minor)
+        if major == 4:
+            return 'tty{}'.format(minor) if minor < 64 else 'ttyS{}'.format(minor - 64)
+        if major == 5 and minor == 0:
+            return 'tty'
+        return '?'
+
+    def _format_start(self, start, now):
+        if now - start < 24 * 3600:
+            return time.strftime('%H:%M', time.localtime(start))
+        if time.localtime(start).tm_year == time.localtime(now).tm_year:
+            return time.strftime('%b%d', time.localtime(start))
+        return time.strftime('%Y', time.localtime(start))
+
+    def _read_process(self, proc_location, pid, exclude_args):
+        """
+        Return the fields `ps aux` outputs for a process, but %CPU, %MEM and
+        START, from /proc/[pid]
+        """
+        proc_dir = "{}/{}".format(proc_location, pid)
+        with open(proc_dir + '/stat', 'r') as f:
+            stat = f.read()
+        # The command is between parentheses, and can contain any of them
+        command = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+
+        uid, locked = 0, False
+        # In KiB, as ps reports it, from the page count of stat otherwise
+        rss = int(fields[PROC_RSS]) * self._page_size / 1024
+        with open(proc_dir + '/status', 'r') as f:
+            for line in f:
+                if line.startswith('Uid:'):
+                    # The effective uid
+                    uid = int(line.split()[2])
+                elif line.startswith('VmLck:'):
+                    locked = int(line.split()[1]) > 0
+                elif line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+
+        with open(proc_dir + '/cmdline', 'r') as f:
+            args = [a for a in f.read().split('\0') if a]
+        if not args:
+            # Kernel threads
+            args = ['[{}]'.format(command)]
+        elif exclude_args:
+            args = args[:1]
+        command = CONTROL_CHARS_RE.sub('?', ' '.join(args))
+
+        nice = int(fields[PROC_NICE])
+        state = fields[PROC_STATE]
+        if nice < 0:
+            state += '<'
+        elif nice > 0:
+            state += 'N'
+        if locked:
+            state += 'L'
+        if int(fields[PROC_SESSION]) == pid:
+            state += 's'
+        if int(fields[PROC_NUM_THREADS]) > 1:
+            state += 'l'
+        if fields[PROC_TPGID] == fields[PROC_PGRP]:
+            state += '+'
+
+        return {
+            'user': self._get_username(uid),
+            'cpu_ticks': int(fields[PROC_UTIME]) + int(fields[PROC_STIME]),
+            'start_ticks': int(fields[PROC_STARTTIME]),
+            'vsz': int(fields[PROC_VSIZE]) / 1024,
+            'rss': rss,
+            'tty': self._format_tty(int(fields[PROC_TTY_NR])),
+            'stat': state,
+            'command': command,
+        }
+
+    def _get_linux_processes(self, proc_location, exclude_args):
+        """
+        The lines of `ps auxww` (`ps aux` if `exclude_args`), split in their
+        11 columns, from /proc instead of a ps process.
+        """
+        clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        with open("{}/uptime".format(proc_location), 'r') as f:
+            uptime = float(f.read().split()[0])
+        with open("{}/stat".format(proc_location), 'r') as f:
+            boot_time = int([l for l in f if l.startswith('btime ')][0].split()[1])
+        with open("{}/meminfo".format(proc_location), 'r') as f:
+            mem_total = int([l for l in f if l.startswith('MemTotal:')][0].split()[1])
+        now = time.time()
+
+        processes = []
+        pids = sorted(int(pid) for pid in os.listdir(proc_location) if pid.isdigit())
+        for pid in pids:
+            try:
+                process = self._read_process(proc_location, pid, exclude_args)
+            except (IOError, OSError):
+                # The process has exited
+                continue
+
+            cpu_time = process['cpu_ticks'] / clock_ticks
+            elapsed = uptime - process['start_ticks'] / clock_ticks
+            rss = process['rss']
+            processes.append([
+                process['user'],
+                str(pid),
+                # Truncated to the permille, as ps does
+                '%.1f' % (int(1000 * cpu_time / elapsed) / 10.0 if elapsed > 0 else 0.0),
+                '%.1f' % (1000 * rss / mem_total / 10.0 if mem_total else 0.0),
+                str(process['vsz']),
+                str(rss),
+                process['tty'],
+                process['stat'],
+                self._format_start(boot_time + process['start_ticks'] / clock_ticks, now),
+                '%d:%02d' % divmod(int(cpu_time), 60),
+                process['command'],
+            ])
+        return processes
+
     def check(self, agentConfig):
         process_exclude_args = agentConfig.get('exclude_process_args', False)
         if process_exclude_args:
             ps_arg = 'aux'
         else:
             ps_arg = 'auxww'
+        proc_location = agentConfig.get('procfs_path', '/proc').rstrip('/')
         # Get output from ps
         try:
-            output, _, _ = get_subprocess_output(['ps', ps_arg], self.logger)
-            processLines = output.splitlines()  # Also removes a trailing empty line
+            if Platform.is_linux() and os.path.exists("{}/stat".format(proc_location)):
+                processes = self._get_linux_processes(proc_location, process_exclude_args)
+            else:
+                output, _, _ = get_subprocess_output(['ps', ps_arg], self.logger)
+                processLines = output.splitlines()  # Also removes a trailing empty line
+
+                del processLines[0]  # Removes the headers
 
-            del processLines[0]  # Removes the headers
+                processes = []
+                for line in processLines:
+                    line = line.split(None, 10)
+                    processes.append(map(lambda s: s.strip(), line))
         except Exception:
             self.logger.exception('getProcesses')
             return False
 
-        processes = []
-
-        for line in processLines:
-            line = line.split(None, 10)
-            processes.append(map(lambda s: s.strip(), line))
-
         return {'processes':   processes,
                 'apiKey':      agentConfig['api_key'],
                 'host':        get_hostname(agentConfig)}
@@ -631,6 +874,46 @@ class Processes(Check):
 
 class Cpu(Check):
 
+    def __init__(self, logger):
+        Check.__init__(self, logger)
+        # Times of the cpu line of /proc/stat at the previous run, on Linux
+        self._last_cpu_times = None
+
+    def _read_cpu_times(self, proc_location):
+        with open("{}/stat".format(proc_location), 'r') as f:
+            for line in f:
+                if line.startswith('cpu '):
+                    times = [float(v) for v in line.split()[1:]]
+                    # Older kernels don't have the steal and guest times
+                    return times + [0.0] * (CPU_GUEST_NICE + 1 - len(times))
+        raise Exception("No cpu times in {}/stat".format(proc_location))
+
+    def _check_linux(self, proc_location, format_results):
+        """
+        Share of the CPU time spent in each state since the last run, as
+        mpstat computes them, from /proc/stat. False on the first run.
+        """
+        times = self._read_cpu_times(proc_location)
+        previous, self._last_cpu_times = self._last_cpu_times, times
+        if previous is None:
+            return False
+
+        delta = [max(t - p, 0.0) for t, p in zip(times, previous)]
+        # The guest times are accounted in the user and nice times too
+        total = sum(delta[:CPU_GUEST])
+        if not total:
+            return False
+        pct = [100.0 * d / total for d in delta]
+
+        cpu_user = max(pct[CPU_USER] - pct[CPU_GUEST], 0.0) + max(pct[CPU_NICE] - pct[CPU_GUEST_NICE], 0.0)
+        cpu_system = pct[CPU_SYSTEM] + pct[CPU_IRQ] + pct[CPU_SOFTIRQ]
+        return format_results(cpu_user,
+                              cpu_system,
+                              pct[CPU_IOWAIT],
+                              pct[CPU_IDLE],
+                              pct[CPU_STEAL],
+                              pct[CPU_GUEST])
+
     def check(self, agentConfig):
         """Return an aggregate of CPU stats across all CPUs
         When figures are not available, False is sent back.
@@ -653,7 +936,11 @@ class Cpu(Check):
                 self.logger.debug("Cannot extract cpu value %s from %s (%s)" % (name, data, legend))
                 return 0.0
         try:
-            if Platform.is_linux():
+            proc_location = agentConfig.get('procfs_path', '/proc').rstrip('/')
+            if Platform.is_linux() and os.path.exists("{}/stat".format(proc_location)):
+                return self._check_linux(proc_location, format_results)
+
+            elif Platform.is_linux():
                 output, _, _ = get_subprocess_output(['mpstat', '1', '3'], self.logger)
                 mpstat = output.splitlines()
                 # topdog@ip:~$ mpstat 1 3
@@ -3,7 +3,9 @@
 # Licensed under Simplified BSD License (see LICENSE)
 
 # stdlib
+from collections import defaultdict
 import ConfigParser
+import cPickle as pickle
 from cStringIO import StringIO
 import glob
 import imp
@@ -12,6 +14,7 @@ import itertools
 import logging
 import logging.config
 import logging.handlers
+import multiprocessing
 from optparse import OptionParser, Values
 import os
 import platform
@@ -19,6 +22,8 @@ import re
 from socket import gaierror, gethostbyname
 import string
 import sys
+import tempfile
+import time
 import traceback
 from urlparse import urlparse
 from importlib import import_module
@@ -29,8 +34,14 @@ import distro
 
 # project
 from util import check_yaml, config_to_yaml
+from utils.pidfile import PidFile
 from utils.platform import Platform, get_os
 from utils.proxy import get_proxy
+from utils.py3_validation import (
+    Py3Validation,
+    PY3_COMPATIBILITY_ATTR,
+    PY3_COMPATIBILITY_UNKNOWN,
+)
 from utils.sdk import load_manifest
 from utils.service_discovery.config import extract_agent_config
 from utils.service_discovery.config_stores import CONFIG_FROM_FILE, TRACE_CONFIG
@@ -56,13 +67,25 @@ SD_PIPE_UNIX_PATH = '/opt/datadog-agent/run'
 SD_PIPE_WIN_PATH = "\\\\.\\pipe\\{pipename}"
 UNKNOWN_WHEEL_VERSION_MSG = 'Unknown Wheel'
 CUSTOM_CHECK_VERSION_MSG = 'custom'
-PY3_COMPATIBILITY_ATTR = 'py3_compatible'
-PY3_COMPATIBILITY_READY = 'ready'
-PY3_COMPATIBILITY_NOT_READY = 'not_ready'
-PY3_COMPATIBILITY_UNKNOWN = 'unknown'
+PY3_VALIDATION_CACHE_FILE = 'py3_validation.json'
+# Processes parsing the conf.d files that changed since the last load
+DEFAULT_CHECK_LOAD_WORKERS = min(multiprocessing.cpu_count(), 4)
+# Under this many files to parse, starting the processes costs more than it saves
+PARALLEL_CONFIG_PARSING_MIN = 16
+# Time (in seconds) a checks.d check can run for when the checks run concurrently
+# or in a worker process of their own
+DEFAULT_CHECK_TIMEOUT = 60
 
 log = logging.getLogger(__name__)
 
+# conf.d file path -> ((mtime, size), pickled config), to only parse the files that changed
+_file_configs_cache = {}
+# checks.d file path -> ((mtime, size), module), to only import the checks that changed
+_check_modules_cache = {}
+# check name -> (pickled config, check path, source path, (mtime, size), hostname, check) of the
+# checks of the last load_check_directory, to keep the ones whose config and code haven't changed
+_loaded_checks = {}
+
 OLD_STYLE_PARAMETERS = [
     ('apache_status_url', "apache"),
     ('cacti_mysql_server', "cacti"),
@@ -337,6 +360,18 @@ def get_histogram_percentiles(configstr=None):
     return result
 
 
+def get_histogram_backend(configstr=None):
+    if configstr is None:
+        return None
+
+    backend = configstr.strip().lower()
+    if backend not in ('exact', 'sketch'):
+        log.warning("Ignored histogram backend {0}, must be one of: exact, sketch".format(configstr))
+        return None
+
+    return backend
+
+
 def clean_dd_url(url):
     url = url.strip()
     if not url.startswith('http'):
@@ -359,6 +394,7 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
         'dogstatsd_port': 8125,
         'dogstatsd_target': 'http://localhost:17123',
         'graphite_listen_port': None,
+        'graphite_plaintext_listen_port': None,
         'hostname': None,
         'listen_port': None,
         'tags': None,
@@ -508,6 +544,9 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
         if config.has_option('Main', 'histogram_percentiles'):
             agentConfig['histogram_percentiles'] = get_histogram_percentiles(config.get('Main', 'histogram_percentiles'))
 
+        if config.has_option('Main', 'histogram_backend'):
+            agentConfig['histogram_backend'] = get_histogram_backend(config.get('Main', 'histogram_backend'))
+
         # Disable Watchdog (optionally)
         if config.has_option('Main', 'watchdog'):
             if config.get('Main', 'watchdog').lower() in ('no', 'false'):
@@ -520,6 +559,15 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
         else:
             agentConfig['graphite_listen_port'] = None
 
+        if config.has_option('Main', 'graphite_plaintext_listen_port'):
+            agentConfig['graphite_plaintext_listen_port'] = \
+                int(config.get('Main', 'graphite_plaintext_listen_port'))
+        else:
+            agentConfig['graphite_plaintext_listen_port'] = None
+
+        if config.has_option('Main', 'graphite_name_rules'):
+            agentConfig['graphite_name_rules'] = config.get('Main', 'graphite_name_rules')
+
         # Dogstatsd config
         dogstatsd_defaults = {
             'dogstatsd_port': 8125,
@@ -554,6 +602,24 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
         if config.has_option('Main', 'check_timings'):
             agentConfig['check_timings'] = _is_affirmative(config.get('Main', 'check_timings'))
 
+        if config.has_option('Main', 'check_workers'):
+            try:
+                agentConfig['check_workers'] = int(config.get('Main', 'check_workers'))
+            except Exception:
+                pass
+
+        if config.has_option('Main', 'check_load_workers'):
+            try:
+                agentConfig['check_load_workers'] = int(config.get('Main', 'check_load_workers'))
+            except Exception:
+                pass
+
+        if config.has_option('Main', 'check_timeout'):
+            try:
+                agentConfig['check_timeout'] = float(config.get('Main', 'check_timeout'))
+            except Exception:
+                pass
+
         if config.has_option('Main', 'exclude_process_args'):
             agentConfig['exclude_process_args'] = _is_affirmative(config.get('Main', 'exclude_process_args'))
 
@@ -575,6 +641,13 @@ def get_config(parse_args=True, cfg_path=None, options=None, can_query_registry=
         elif config.has_option("Main", "dogstreams"):
             agentConfig["dogstreams"] = config.get("Main", "dogstreams")
 
+        for key in ('dogstream_workers', 'dogstream_max_lines'):
+            if config.has_option('Main', key):
+                try:
+                    agentConfig[key] = int(config.get('Main', key))
+                except Exception:
+                    pass
+
         if config.has_option("Main", "nagios_perf_cfg"):
             agentConfig["nagios_perf_cfg"] = config.get("Main", "nagios_perf_cfg")
 
@@ -891,8 +964,13 @@ def _get_check_module(check_name, check_path, from_site=False):
             # Log at debug level since this code path is expected if the check is not installed as a wheel
             log.debug('Unable to import check module %s from site-packages: %s', check_name, e)
     else:
+        signature = _file_signature(check_path)
+        cached = _check_modules_cache.get(check_path)
+        if cached is not None and signature is not None and cached[0] == signature:
+            return cached[1], None
         try:
             check_module = imp.load_source('checksd_%s' % check_name, check_path)
+            _check_modules_cache[check_path] = (signature, check_module)
         except Exception as e:
             error = e
             traceback_message = traceback.format_exc()
@@ -1034,7 +1112,75 @@ def get_checks_places(osname, agentConfig):
     return places
 
 
-def _load_file_config(config_path, check_name, agentConfig):
+def _file_signature(path):
+    """ The (mtime, size) of a file, None if it can't be read """
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def _parse_file_config(config_path):
+    """
+    Parse a conf.d file, return its (config, None), or (None, (error, traceback))
+    if it's invalid. Runs in the check load workers.
+    """
+    try:
+        return check_yaml(config_path), None
+    except Exception as e:
+        return None, (str(e), traceback.format_exc())
+
+
+def _parse_file_configs(config_paths, agentConfig, timings=None):
+    """
+    Return the (config, error) of each conf.d file of `config_paths`, by path.
+    The files that haven't changed since they were last parsed are taken from
+    the cache, the others are parsed in `check_load_workers` processes when
+    there are enough of them. Their number is added to the `parsed` of `timings`.
+    """
+    parsed, stale = {}, []
+    for config_path in config_paths:
+        signature = _file_signature(config_path)
+        cached = _file_configs_cache.get(config_path)
+        if cached is not None and signature is not None and cached[0] == signature:
+            # A copy, the checks can modify their config
+            parsed[config_path] = (pickle.loads(cached[1]), None)
+        else:
+            stale.append((config_path, signature))
+
+    stale_paths = [config_path for config_path, _ in stale]
+    workers = min(agentConfig.get('check_load_workers', DEFAULT_CHECK_LOAD_WORKERS), len(stale_paths))
+    results = None
+    if workers > 1 and len(stale_paths) >= PARALLEL_CONFIG_PARSING_MIN and not Platform.is_windows():
+        try:
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(_parse_file_config, stale_paths)
+            finally:
+                pool.terminate()
+        except Exception:
+            log.warning("Unable to parse the configs in worker processes, parsing them one by one", exc_info=True)
+    if results is None:
+        results = map(_parse_file_config, stale_paths)
+
+    for (config_path, signature), (check_config, error) in zip(stale, results):
+        if error is None and signature is not None:
+            _file_configs_cache[config_path] = (signature, pickle.dumps(check_config, pickle.HIGHEST_PROTOCOL))
+        else:
+            _file_configs_cache.pop(config_path, None)
+        parsed[config_path] = (check_config, error)
+
+    if timings is not None:
+        timings['parsed'] += len(stale_paths)
+    return parsed
+
+
+def _load_file_config(config_path, check_name, agentConfig, parsed_configs=None):
+    """
+    Load the config of a check from its conf.d file, from `parsed_configs`
+    if it has been parsed already by _parse_file_configs.
+    """
     if config_path == 'deprecated/nagios':
         log.warning("Configuring Nagios in datadog.conf is deprecated "
                     "and will be removed in a future version. "
@@ -1042,12 +1188,13 @@ def _load_file_config(config_path, check_name, agentConfig):
         check_config = {'instances': [dict((key, value) for (key, value) in agentConfig.iteritems() if key in NAGIOS_OLD_CONF_KEYS)]}
         return True, check_config, {}
 
-    try:
-        check_config = check_yaml(config_path)
-    except Exception as e:
-        log.exception("Unable to parse yaml config in %s" % config_path)
-        traceback_message = traceback.format_exc()
-        return False, None, {check_name: {'error': str(e), 'traceback': traceback_message, 'version': 'unknown'}}
+    if parsed_configs is None or config_path not in parsed_configs:
+        parsed_configs = _parse_file_configs([config_path], agentConfig)
+    check_config, error = parsed_configs[config_path]
+    if error is not None:
+        message, traceback_message = error
+        log.error("Unable to parse yaml config in %s\n%s" % (config_path, traceback_message))
+        return False, None, {check_name: {'error': message, 'traceback': traceback_message, 'version': 'unknown'}}
     return True, check_config, {}
 
 
@@ -1086,6 +1233,9 @@ def _initialize_check(check_config, check_name, check_class, agentConfig,
             check.set_check_version(manifest=load_manifest(manifest_path))
         else:
             check.set_check_version(version=version_override)
+
+        if _is_affirmative(init_config.get('process_isolation')):
+            check = _isolate_check(check, init_config)
     except Exception as e:
         log.exception('Unable to initialize check %s' % check_name)
         traceback_message = traceback.format_exc()
@@ -1103,6 +1253,21 @@ def _initialize_check(check_config, check_name, check_class, agentConfig,
         return {check_name: check}, {}
 
 
+def _isolate_check(check, init_config):
+    """ Run the check in a worker process, where it's supported """
+    if Platform.is_windows():
+        log.warning("Process isolation is not supported on Windows, "
+                    "check %s runs in the collector", check.name)
+        return check
+
+    from checks.process_check import ProcessIsolatedCheck
+    memory_limit = init_config.get('process_memory_limit')
+    if memory_limit:
+        memory_limit = int(memory_limit) * 1024 * 1024
+    timeout = float(check.agentConfig.get('check_timeout') or DEFAULT_CHECK_TIMEOUT)
+    return ProcessIsolatedCheck(check, memory_limit=memory_limit, timeout=timeout)
+
+
 def _update_python_path(check_config):
     # Add custom pythonpath(s) if available
     if 'pythonpath' in check_config:
@@ -1143,9 +1308,67 @@ def validate_sdk_check(manifest_path):
     return (min_validated and max_validated)
 
 
-def load_check_from_places(check_config, check_name, checks_places, agentConfig):
+_py3_validation = None
+
+
+def _get_py3_validation_cache_path():
+    if Platform.is_win32():
+        path = os.path.join(_windows_commondata_path(), 'Datadog')
+        if not os.path.isdir(path):
+            path = tempfile.gettempdir()
+    else:
+        path = PidFile.get_dir()
+    return os.path.join(path, PY3_VALIDATION_CACHE_FILE)
+
+
+def get_py3_validation():
+    """ The validation of the checks' Python 3 compatibility, shared by all the check loads """
+    global _py3_validation
+    if _py3_validation is None:
+        _py3_validation = Py3Validation(_get_py3_validation_cache_path())
+    return _py3_validation
+
+
+def _get_loaded_check(check_name, check_config, checks_places, agentConfig):
+    ''' Return the check of the last load_check_directory if its config, its code and the
+    place it's loaded from haven't changed since then, None otherwise. '''
+    loaded = _loaded_checks.get(check_name)
+    if loaded is None:
+        return None
+
+    config, check_path, source_path, signature, hostname, check = loaded
+    if pickle.loads(config) != check_config or hostname != agentConfig.get('checksd_hostname') or \
+            _file_signature(source_path) != signature:
+        return None
+
+    for check_path_builder in checks_places:
+        path, _ = check_path_builder(check_name)
+        if path == check_path:
+            return check
+        if path and os.path.exists(path):
+            # A check that takes precedence over the loaded one has been added
+            return None
+    return None
+
+
+def load_check_from_places(check_config, check_name, checks_places, agentConfig,
+                           loaded_checks=None, timings=None):
     '''Find a check named check_name in the given checks_places and try to initialize it with the given check_config.
-    A failure (`load_failure`) can happen when the check class can't be validated or when the check can't be initialized. '''
+    A failure (`load_failure`) can happen when the check class can't be validated or when the check can't be initialized.
+    With `loaded_checks`, the check of the last load is kept if its config and code haven't changed, and the
+    loaded check is added to `loaded_checks`. The time spent importing and initializing the check is added to
+    the `imports` and `initialization` of `timings`. '''
+    if timings is None:
+        timings = defaultdict(float)
+
+    if loaded_checks is not None:
+        check = _get_loaded_check(check_name, check_config, checks_places, agentConfig)
+        if check is not None:
+            log.debug('Keeping %s, its config and code are unchanged', check_name)
+            loaded_checks[check_name] = _loaded_checks[check_name]
+            timings['reused'] += 1
+            return {check_name: check}, {}
+
     load_success, load_failure = {}, {}
     for check_path_builder in checks_places:
         check_path, manifest_path = check_path_builder(check_name)
@@ -1157,7 +1380,9 @@ def load_check_from_places(check_config, check_name, checks_places, agentConfig)
             continue
 
         prev_failures = bool(load_failure)
+        start = time.time()
         check_is_valid, check_class, load_failure = get_valid_check_class(check_name, check_path, from_site=is_wheel)
+        timings['imports'] += time.time() - start
         if not check_is_valid:
             load_error = load_failure.get(check_name, {}).get('error')
             if is_wheel and not prev_failures and isinstance(load_error, ImportError):
@@ -1181,36 +1406,37 @@ def load_check_from_places(check_config, check_name, checks_places, agentConfig)
             version_override = CUSTOM_CHECK_VERSION_MSG  # custom check
 
 
+        start = time.time()
         load_success, load_failure = _initialize_check(
             check_config, check_name, check_class, agentConfig, manifest_path, version_override
         )
+        timings['initialization'] += time.time() - start
+
+        if loaded_checks is not None and check_name in load_success:
+            source_path = check_path or inspect.getsourcefile(check_class)
+            if source_path:
+                loaded_checks[check_name] = (
+                    pickle.dumps(check_config, pickle.HIGHEST_PROTOCOL), check_path, source_path, _file_signature(source_path),
+                    agentConfig.get('checksd_hostname'), load_success[check_name]
+                )
 
         _update_python_path(check_config)
 
-        # Validate custom checks and wheels without a `datadog_checks` namespace
-        if not agentConfig.get("disable_py3_validation", False):
+        # Validate custom checks and wheels without a `datadog_checks` namespace,
+        # in the background: the check reports its compatibility once it's known
+        if not agentConfig.get("disable_py3_validation", False) and check_name in load_success:
             if version_override in (UNKNOWN_WHEEL_VERSION_MSG, CUSTOM_CHECK_VERSION_MSG):
-                py3_compatible = PY3_COMPATIBILITY_READY
-                warnings = []
                 try:
-                    file_path = os.path.realpath(check_path.decode(sys.getfilesystemencoding()))
-                    output, _, _ = get_subprocess_output(
-                        [sys.executable, "-m", "pylint", "-f", "json", "--py3k", "-d", "W1618", "--persistent", "no", "--exit-zero", file_path], log)
-                    warnings = json.loads(output)
-                except SubprocessOutputEmptyError as e:
-                    # old versions of pylint return an empty output to indicate there are no warnings
-                    pass
+                    source_path = check_path or inspect.getsourcefile(check_class)
+                    file_path = os.path.realpath(source_path.decode(sys.getfilesystemencoding()))
                 except Exception as e:
-                    py3_compatible = PY3_COMPATIBILITY_UNKNOWN
                     log.error("error running 'validate' on custom check: %s", e)
-
-                if warnings:
-                    py3_compatible = PY3_COMPATIBILITY_NOT_READY
-
-                # for now we don't display anything in the status page
-                # if not py3_compatible:
-                #     load_success[check_name].persistent_warning("check is not compatible with Python3 (see logs for more information)")
-                setattr(load_success[check_name], PY3_COMPATIBILITY_ATTR, py3_compatible)
+                    setattr(load_success[check_name], PY3_COMPATIBILITY_ATTR, PY3_COMPATIBILITY_UNKNOWN)
+                else:
+                    # for now we don't display anything in the status page
+                    # if not py3_compatible:
+                    #     load_success[check_name].persistent_warning("check is not compatible with Python3 (see logs for more information)")
+                    get_py3_validation().validate(load_success[check_name], file_path)
 
         if is_wheel:
             log.debug('Loaded %s' % check_name)
@@ -1224,10 +1450,16 @@ def load_check_from_places(check_config, check_name, checks_places, agentConfig)
 def load_check_directory(agentConfig, hostname):
     ''' Return the initialized checks from checks.d, and a mapping of checks that failed to
     initialize. Only checks that have a configuration
-    file in conf.d will be returned. '''
+    file in conf.d will be returned.
+    The checks whose config and code haven't changed since the last call are kept as they
+    are, and the time spent in each phase of the load is returned in `load_stats`. '''
+    global _loaded_checks
     from checks import AGENT_METRICS_CHECK_NAME
     from jmxfetch import JMX_CHECKS
 
+    load_start = time.time()
+    timings = defaultdict(float)
+    loaded_checks = {}
     initialized_checks = {}
     init_failed_checks = {}
     deprecated_checks = {}
@@ -1245,11 +1477,19 @@ def load_check_directory(agentConfig, hostname):
 
     checks_places = get_checks_places(osname, agentConfig)
 
-    for config_path in _file_configs_paths(osname, agentConfig):
+    config_paths = _file_configs_paths(osname, agentConfig)
+    start = time.time()
+    parsed_configs = _parse_file_configs([p for p in config_paths if p != 'deprecated/nagios'], agentConfig, timings)
+    # Forget the files that are gone
+    for config_path in set(_file_configs_cache) - set(config_paths):
+        del _file_configs_cache[config_path]
+    timings['configs'] = time.time() - start
+
+    for config_path in config_paths:
         # '/etc/dd-agent/checks.d/my_check.py' -> 'my_check'
         check_name = _conf_path_to_check_name(config_path)
 
-        conf_is_valid, check_config, invalid_check = _load_file_config(config_path, check_name, agentConfig)
+        conf_is_valid, check_config, invalid_check = _load_file_config(config_path, check_name, agentConfig, parsed_configs)
         init_failed_checks.update(invalid_check)
         if not conf_is_valid:
             continue
@@ -1258,12 +1498,17 @@ def load_check_directory(agentConfig, hostname):
             configs_and_sources[check_name] = (CONFIG_FROM_FILE, check_config)
 
         # load the check
-        load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig)
+        load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig,
+                                                            loaded_checks, timings)
 
         initialized_checks.update(load_success)
         init_failed_checks.update(load_failure)
 
-    for check_name, service_disco_check_config in _service_disco_configs(agentConfig).iteritems():
+    start = time.time()
+    service_disco_configs = _service_disco_configs(agentConfig)
+    timings['service_discovery'] = time.time() - start
+
+    for check_name, service_disco_check_config in service_disco_configs.iteritems():
         # ignore this config from service disco if the check has been loaded through a file config
         if check_name in initialized_checks or \
                 check_name in init_failed_checks or \
@@ -1279,11 +1524,13 @@ def load_check_directory(agentConfig, hostname):
         check_config = {'init_config': sd_init_config, 'instances': sd_instances}
 
         # load the check
-        load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig)
+        load_success, load_failure = load_check_from_places(check_config, check_name, checks_places, agentConfig,
+                                                            loaded_checks, timings)
 
         initialized_checks.update(load_success)
         init_failed_checks.update(load_failure)
 
+    _loaded_checks = loaded_checks
     init_failed_checks.update(deprecated_checks)
     log.info('initialized checks.d checks: %s' % [k for k in initialized_checks.keys() if k != AGENT_METRICS_CHECK_NAME])
     log.info('initialization failed checks.d checks: %s' % init_failed_checks.keys())
@@ -1291,8 +1538,24 @@ def load_check_directory(agentConfig, hostname):
     if agentConfig.get(TRACE_CONFIG):
         return configs_and_sources
 
+    load_stats = {
+        'configs': len(config_paths),
+        'parsed_configs': int(timings['parsed']),
+        'checks': len(initialized_checks),
+        'reused_checks': int(timings['reused']),
+        'timings': {
+            'configs': timings['configs'],
+            'service_discovery': timings['service_discovery'],
+            'imports': timings['imports'],
+            'initialization': timings['initialization'],
+            'total': time.time() - load_start,
+        },
+    }
+    log.info('loaded checks.d checks in %.2fs', load_stats['timings']['total'])
+
     return {'initialized_checks': initialized_checks.values(),
-            'init_failed_checks': init_failed_checks}
+            'init_failed_checks': init_failed_checks,
+            'load_stats': load_stats}
 
 
 def load_check(agentConfig, hostname, checkname):
@@ -1302,6 +1565,8 @@ def load_check(agentConfig, hostname, checkname):
     agentConfig['checksd_hostname'] = hostname
     osname = get_os()
     checks_places = get_checks_places(osname, agentConfig)
+    # The check of the last load_check_directory is replaced
+    _loaded_checks.pop(checkname, None)
     for config_path in _file_configs_paths(osname, agentConfig):
         check_name = _conf_path_to_check_name(config_path)
         if check_name == checkname and check_name not in JMX_CHECKS:
@@ -407,6 +407,8 @@ class Application(tornado.web.Application):
         self._port = int(port)
         self._agentConfig = agentConfig
         self._metrics = {}
+        # Points of the graphite listeners, if they're enabled
+        self._graphite_buffer = None
         self._dns_cache = None
         AgentTransaction.set_application(self)
         AgentTransaction.set_endpoints(agentConfig['endpoints'])
@@ -470,21 +472,13 @@ class Application(tornado.web.Application):
             handler._request_summary(), request_time
         )
 
-    def appendMetric(self, prefix, name, host, device, ts, value):
-
-        if prefix in self._metrics:
-            metrics = self._metrics[prefix]
-        else:
-            metrics = {}
-            self._metrics[prefix] = metrics
-
-        if name in metrics:
-            metrics[name].append([host, device, ts, value])
-        else:
-            metrics[name] = [[host, device, ts, value]]
-
     def _postMetrics(self):
 
+        if self._graphite_buffer is not None:
+            for name, points in self._graphite_buffer.flush().iteritems():
+                metrics = self._metrics.setdefault('graphite', {})
+                metrics.setdefault(name, []).extend(points)
+
         if len(self._metrics) > 0:
             self._metrics['uuid'] = get_uuid()
             self._metrics['internalHostname'] = get_hostname(self._agentConfig)
@@ -555,16 +549,30 @@ class Application(tornado.web.Application):
         tr_sched = tornado.ioloop.PeriodicCallback(flush_trs, TRANSACTION_FLUSH_INTERVAL,
                                                    io_loop=self.mloop)
 
-        # Register optional Graphite listener
+        # Register optional Graphite listeners
+        graphite_servers = []
         gport = self._agentConfig.get("graphite_listen_port", None)
-        if gport is not None:
-            log.info("Starting graphite listener on port %s" % gport)
-            from graphite import GraphiteServer
-            gs = GraphiteServer(self, get_hostname(self._agentConfig), io_loop=self.mloop)
+        gplaintext_port = self._agentConfig.get("graphite_plaintext_listen_port", None)
+        if gport is not None or gplaintext_port is not None:
+            from graphite import GraphiteBuffer, GraphitePlaintextServer, GraphiteServer, parse_name_rules
+            self._graphite_buffer = GraphiteBuffer()
+            hostname = get_hostname(self._agentConfig)
+            name_rules = parse_name_rules(self._agentConfig.get("graphite_name_rules"))
+            if gport is not None:
+                log.info("Starting graphite listener on port %s" % gport)
+                gs = GraphiteServer(self._graphite_buffer, hostname, io_loop=self.mloop, name_rules=name_rules)
+                graphite_servers.append((gs, gport))
+            if gplaintext_port is not None:
+                log.info("Starting graphite plaintext listener on port %s" % gplaintext_port)
+                gs = GraphitePlaintextServer(self._graphite_buffer, hostname, io_loop=self.mloop,
+                                             name_rules=name_rules)
+                graphite_servers.append((gs, gplaintext_port))
+
+        for gs, port in graphite_servers:
             if non_local_traffic is True:
-                gs.listen(gport)
+                gs.listen(port)
             else:
-                gs.listen(gport, address="localhost")
+                gs.listen(port, address="localhost")
 
         # Start everything
         if self._watchdog:
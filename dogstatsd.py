@@ -16,10 +16,14 @@ from utils.proxy import set_no_proxy_settings  # noqa
 set_no_proxy_settings()
 
 # stdlib
+import BaseHTTPServer
 import copy
+import errno
 import os
 import logging
+import multiprocessing
 import optparse
+import Queue
 import select
 import signal
 import socket
@@ -28,6 +32,7 @@ import sys
 import threading
 from time import sleep, time
 from urllib import urlencode
+import urlparse
 import zlib
 
 # For pickle & PID files, see issue 293
@@ -38,8 +43,14 @@ import requests
 import simplejson as json
 
 # project
-from aggregator import get_formatter, MetricsBucketAggregator
+from aggregator import (
+    DEFAULT_CONTEXT_CACHE_SIZE,
+    DEFAULT_TELEMETRY_CAPACITY,
+    get_formatter,
+    MetricsBucketAggregator,
+)
 from checks.check_status import DogstatsdStatus
+from checks.libs.thread_pool import Pool
 from checks.metric_types import MetricTypes
 from config import (
     get_config,
@@ -56,11 +67,11 @@ from daemon import (
 from util import chunks, get_uuid, plural
 from utils.hostname import get_hostname
 from utils.http import get_expvar_stats
-from utils.net import inet_pton
-from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
+from utils.net import get_udp_socket_drops, inet_pton
+from utils.net import IPV6_V6ONLY, IPPROTO_IPV6, SO_REUSEPORT
 from utils.pidfile import PidFile
 from utils.watchdog import Watchdog
-from utils.logger import RedactedLogRecord
+from utils.logger import RedactedLogRecord, reset_logging_locks
 
 # urllib3 logs a bunch of stuff at the info level
 requests_log = logging.getLogger("requests.packages.urllib3")
@@ -87,6 +98,24 @@ FLUSH_LOGGING_INITIAL = 10
 FLUSH_LOGGING_COUNT = 5
 EVENT_CHUNK_SIZE = 50
 COMPRESS_THRESHOLD = 1024
+# Maximum size of the uncompressed JSON of a series payload
+MAX_PAYLOAD_SIZE = 2 * 1024 * 1024
+# Number of payloads posted concurrently by the reporter
+SUBMIT_THREADS = 4
+# Timeout (in seconds) of the requests posting payloads
+SUBMIT_TIMEOUT = 5
+# Number of flushes waiting to be sent before the oldest one is dropped
+MAX_PENDING_FLUSHES = 3
+# Maximum number of datagrams read per wakeup in batch receive mode
+MAX_BATCH_SIZE = 1024
+# How often (in seconds) the kernel drop counter of the socket is refreshed
+DROPS_CHECK_INTERVAL = 1
+# How often (in seconds) the server pool checks that its workers are alive
+WORKER_CHECK_INTERVAL = 1
+# How long (in seconds) the reporter waits for the state of a worker at flush time
+WORKER_SNAPSHOT_TIMEOUT = 2
+# Number of metric names returned by the telemetry endpoint by default
+DEFAULT_TELEMETRY_TOP = 10
 
 
 def add_serialization_status_metric(status, hostname):
@@ -122,27 +151,85 @@ def unicode_metrics(metrics):
     return metrics
 
 
-def serialize_metrics(metrics, hostname):
-    try:
-        metrics.append(add_serialization_status_metric("success", hostname))
-        serialized = json.dumps({"series": metrics})
-    except UnicodeDecodeError as e:
-        log.exception("Unable to serialize payload. Trying to replace bad characters. %s", e)
-        metrics.append(add_serialization_status_metric("failure", hostname))
-        try:
-            log.error(metrics)
-            serialized = json.dumps({"series": unicode_metrics(metrics)})
-        except Exception as e:
-            log.exception("Unable to serialize payload. Giving up. %s", e)
-            serialized = json.dumps({"series": [add_serialization_status_metric("permanent_failure", hostname)]})
+class SeriesPayload(object):
+    """
+    A `{"series": [...]}` JSON payload written one serialized metric at a
+    time. Once it's bigger than COMPRESS_THRESHOLD, the JSON is compressed as
+    it's written instead of being held in memory.
+    """
+    HEADER = '{"series": ['
+    FOOTER = ']}'
+
+    def __init__(self):
+        self.size = len(self.HEADER) + len(self.FOOTER)
+        self.count = 0
+        self._chunks = [self.HEADER]
+        self._compressor = None
+
+    def write(self, serialized_metric):
+        if self.count:
+            serialized_metric = ', ' + serialized_metric
+        self.count += 1
+        self.size += len(serialized_metric)
+
+        if self._compressor is not None:
+            self._chunks.append(self._compressor.compress(serialized_metric))
+        elif self.size > COMPRESS_THRESHOLD:
+            self._compressor = zlib.compressobj()
+            self._chunks.append(serialized_metric)
+            self._chunks = [self._compressor.compress(''.join(self._chunks))]
+        else:
+            self._chunks.append(serialized_metric)
+
+    def close(self):
+        """ Return the (body, headers) of the payload """
+        if self._compressor is None:
+            self._chunks.append(self.FOOTER)
+            return ''.join(self._chunks), {'Content-Type': 'application/json'}
 
-    if len(serialized) > COMPRESS_THRESHOLD:
+        self._chunks.append(self._compressor.compress(self.FOOTER))
+        self._chunks.append(self._compressor.flush())
         headers = {'Content-Type': 'application/json',
                    'Content-Encoding': 'deflate'}
-        serialized = zlib.compress(serialized)
-    else:
-        headers = {'Content-Type': 'application/json'}
-    return serialized, headers
+        return ''.join(self._chunks), headers
+
+
+def serialize_metrics_payloads(metrics, hostname, max_payload_size=MAX_PAYLOAD_SIZE):
+    """
+    Serialize the metrics one by one into series payloads of at most
+    `max_payload_size` bytes of uncompressed JSON (unless a single metric is
+    bigger), and yield their (body, headers).
+    """
+    payload = SeriesPayload()
+    status = "success"
+    for metric in metrics:
+        try:
+            serialized_metric = json.dumps(metric)
+        except UnicodeDecodeError as e:
+            log.exception("Unable to serialize metric. Trying to replace bad characters. %s", e)
+            if status == "success":
+                status = "failure"
+            try:
+                log.error(metric)
+                serialized_metric = json.dumps(unicode_metrics([metric])[0])
+            except Exception as e:
+                log.exception("Unable to serialize metric. Giving up. %s", e)
+                status = "permanent_failure"
+                continue
+
+        if payload.count and max_payload_size and \
+                payload.size + len(serialized_metric) + 2 > max_payload_size:
+            yield payload.close()
+            payload = SeriesPayload()
+        payload.write(serialized_metric)
+
+    payload.write(json.dumps(add_serialization_status_metric(status, hostname)))
+    yield payload.close()
+
+
+def serialize_metrics(metrics, hostname):
+    """ Serialize the metrics into a single series payload, return its (body, headers) """
+    return next(serialize_metrics_payloads(metrics, hostname, max_payload_size=None))
 
 
 def serialize_event(event):
@@ -198,6 +285,64 @@ def get_socket_address(host, port, ipv4_only=False):
     return sockaddr
 
 
+class TelemetryRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers GET /telemetry?top=<count> with the telemetry report of the aggregator """
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path.rstrip('/') != '/telemetry':
+            self._reply(404, {'error': 'Not found'})
+            return
+
+        try:
+            top = int(urlparse.parse_qs(url.query).get('top', [DEFAULT_TELEMETRY_TOP])[0])
+        except ValueError:
+            self._reply(400, {'error': 'top must be an integer'})
+            return
+
+        report = self.server.aggregator.telemetry_report(top)
+        if report is None:
+            self._reply(503, {'error': 'No telemetry yet, it is available after the first flush'})
+            return
+        self._reply(200, report)
+
+    def _reply(self, code, content):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Telemetry request from %s: %s", self.client_address[0], format % args)
+
+
+class TelemetryServer(BaseHTTPServer.HTTPServer):
+    """
+    Serves the telemetry of an aggregator over HTTP from a background thread,
+    on the loopback interface only.
+    """
+
+    def __init__(self, aggregator, port, host='localhost'):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), TelemetryRequestHandler)
+        self.aggregator = aggregator
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="TelemetryServer")
+        self._thread.daemon = True
+        self._thread.start()
+        log.info("Serving the dogstatsd telemetry on http://%s:%s/telemetry", *self.server_address[:2])
+
+    def stop(self):
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.server_close()
+
+
 class Reporter(threading.Thread):
     """
     The reporter periodically sends the aggregated metrics to the
@@ -205,11 +350,15 @@ class Reporter(threading.Thread):
     """
 
     def __init__(self, interval, metrics_aggregator, api_host, api_key=None,
-                 use_watchdog=False, event_chunk_size=None, hostname=None):
+                 use_watchdog=False, event_chunk_size=None, hostname=None,
+                 server_pool=None, telemetry_port=None):
         threading.Thread.__init__(self)
         self.interval = int(interval)
         self.finished = threading.Event()
         self.metrics_aggregator = metrics_aggregator
+        # When the servers run in worker processes, their aggregated state is
+        # merged into `metrics_aggregator` before each flush
+        self.server_pool = server_pool
         self.flush_count = 0
         self.log_count = 0
         self.hostname = hostname or get_hostname()
@@ -222,6 +371,27 @@ class Reporter(threading.Thread):
         self.api_host = api_host
         self.event_chunk_size = event_chunk_size or EVENT_CHUNK_SIZE
 
+        # Keep-alive connections to the API, shared by the submit threads
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=SUBMIT_THREADS)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Started with the reporter thread, payloads are posted synchronously
+        # until then
+        self.submit_pool = None
+        self.pending_submits = []
+
+        self.http_stats_lock = threading.Lock()
+        self.request_latencies = []
+
+        # Flushes are collected by the reporter thread and sent by the sender
+        # thread, so that a slow intake doesn't delay the next flushes
+        self.flush_queue = Queue.Queue(MAX_PENDING_FLUSHES)
+        self.dropped_flush_count = 0
+
+        # Port of the telemetry endpoint of the aggregator, disabled if None
+        self.telemetry_port = telemetry_port
+
     def stop(self):
         log.info("Stopping reporter")
         self.finished.set()
@@ -234,58 +404,189 @@ class Reporter(threading.Thread):
         # Persist a start-up message.
         DogstatsdStatus().persist()
 
+        telemetry_server = None
+        if self.telemetry_port:
+            try:
+                telemetry_server = TelemetryServer(self.metrics_aggregator, self.telemetry_port)
+                telemetry_server.start()
+            except Exception:
+                log.exception("Cannot serve the dogstatsd telemetry on port %s", self.telemetry_port)
+                telemetry_server = None
+
+        self.submit_pool = Pool(SUBMIT_THREADS, name="Reporter")
+        sender = threading.Thread(target=self.run_sender, name="ReporterSender")
+        sender.start()
+
+        # Flush on a fixed cadence, whatever the time spent collecting
+        next_flush_time = time() + self.interval
         while not self.finished.isSet():  # Use camel case isSet for 2.4 support.
-            self.finished.wait(self.interval)
+            self.finished.wait(max(0, next_flush_time - time()))
+            next_flush_time += self.interval
+            if next_flush_time < time():
+                log.warning("Flush collection is late by more than an interval, skipping ahead")
+                next_flush_time = time() + self.interval
+
+            if self.server_pool is not None:
+                self.merge_worker_snapshots()
             self.metrics_aggregator.send_packet_count('datadog.dogstatsd.packet.count')
-            self.flush()
+            flush = self.collect_flush()
+            if flush is not None:
+                self.queue_flush(flush)
             if self.watchdog:
                 self.watchdog.reset()
 
+        # Send the pending flushes before stopping
+        self.flush_queue.put(None)
+        sender.join()
+        self.submit_pool.terminate()
+        self.submit_pool.join()
+        self.submit_pool = None
+        self.session.close()
+        if telemetry_server is not None:
+            telemetry_server.stop()
+
         # Clean up the status messages.
         log.debug("Stopped reporter")
         DogstatsdStatus.remove_latest_status()
 
+    def merge_worker_snapshots(self):
+        """
+        Merge the closed buckets of every worker into our aggregator, so that
+        each context is flushed exactly once, with its points from all the workers.
+        """
+        try:
+            flush_cutoff_time = self.metrics_aggregator.calculate_bucket_start(time())
+            for snapshot in self.server_pool.collect(flush_cutoff_time):
+                self.metrics_aggregator.merge_snapshot(snapshot)
+            self.metrics_aggregator.dropped_packet_count = self.server_pool.dropped_packet_count()
+        except Exception:
+            log.exception("Error merging the state of the dogstatsd workers")
+
     def flush(self):
+        """ Collect and send a flush from the current thread """
+        flush = self.collect_flush()
+        if flush is not None:
+            self.send_flush(flush)
+
+    def queue_flush(self, flush):
+        """ Hand a collected flush to the sender thread, without blocking """
+        while True:
+            try:
+                self.flush_queue.put_nowait(flush)
+                return
+            except Queue.Full:
+                pass
+            try:
+                self.flush_queue.get_nowait()
+            except Queue.Empty:
+                continue
+            self.dropped_flush_count += 1
+            log.warning("The intake is too slow, %s flushes are pending. Dropping the oldest one." % MAX_PENDING_FLUSHES)
+
+    def run_sender(self):
+        while True:
+            flush = self.flush_queue.get()
+            if flush is None:
+                return
+            self.send_flush(flush)
+
+    def collect_flush(self):
+        """
+        Flush the aggregator, return the metrics, events and service checks
+        to send along with the stats of the flush.
+        """
         try:
+            start_time = time()
             self.flush_count += 1
             self.log_count += 1
-            packets_per_second = self.metrics_aggregator.packets_per_second(self.interval)
-            packet_count = self.metrics_aggregator.total_count
+            if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
+                self.log_count = 0
+            batch_count, batch_packet_count, max_batch_size = self.metrics_aggregator.flush_batch_stats()
+            cache_hits, cache_misses, cache_evictions = self.metrics_aggregator.context_cache.flush_stats()
+            status = dict(
+                flush_count=self.flush_count,
+                packets_per_second=self.metrics_aggregator.packets_per_second(self.interval),
+                dropped_packet_count=self.metrics_aggregator.dropped_packet_count,
+                batch_count=batch_count,
+                avg_batch_size=round(float(batch_packet_count) / batch_count, 2) if batch_count else 0,
+                max_batch_size=max_batch_size,
+                context_cache_hits=cache_hits,
+                context_cache_misses=cache_misses,
+                context_cache_evictions=cache_evictions,
+                discarded_context_point_count=self.metrics_aggregator.num_discarded_new_contexts_points,
+            )
 
             metrics = self.metrics_aggregator.flush()
+            events = self.metrics_aggregator.flush_events()
+            service_checks = self.metrics_aggregator.flush_service_checks()
+            status['packet_count'] = self.metrics_aggregator.total_count
+
+            return {
+                'start_time': start_time,
+                'should_log': self.flush_count <= FLUSH_LOGGING_INITIAL or self.log_count <= FLUSH_LOGGING_COUNT,
+                'metrics': metrics,
+                'events': events,
+                'service_checks': service_checks,
+                'status': status,
+            }
+
+        except Exception:
+            if self.finished.isSet():
+                log.debug("Couldn't flush metrics, but that's expected as we're stopping")
+            else:
+                log.exception("Error flushing metrics")
+
+    def send_flush(self, flush):
+        """ Submit a flush returned by `collect_flush` and persist its status """
+        try:
+            connection_count = self.connection_count()
+
+            metrics = flush['metrics']
             count = len(metrics)
-            if self.flush_count % FLUSH_LOGGING_PERIOD == 0:
-                self.log_count = 0
             if count:
                 self.submit(metrics)
 
-            events = self.metrics_aggregator.flush_events()
+            events = flush['events']
             event_count = len(events)
             if event_count:
                 self.submit_events(events)
 
-            service_checks = self.metrics_aggregator.flush_service_checks()
+            service_checks = flush['service_checks']
             service_check_count = len(service_checks)
             if service_check_count:
                 self.submit_service_checks(service_checks)
 
-            should_log = self.flush_count <= FLUSH_LOGGING_INITIAL or self.log_count <= FLUSH_LOGGING_COUNT
+            self.wait_for_submits()
+            flush_duration = time() - flush['start_time']
+            with self.http_stats_lock:
+                request_latencies = self.request_latencies
+                self.request_latencies = []
+            request_count = len(request_latencies)
+            new_connection_count = self.connection_count() - connection_count
+            if flush_duration > self.interval:
+                log.warning("Flush #%s took %.2fs, longer than the %ss flush interval",
+                            flush['status']['flush_count'], flush_duration, self.interval)
+
+            status = flush['status']
             log_func = log.info
-            if not should_log:
+            if not flush['should_log']:
                 log_func = log.debug
-            log_func("Flush #%s: flushed %s metric%s, %s event%s, and %s service check run%s" % (self.flush_count, count, plural(count), event_count, plural(event_count), service_check_count, plural(service_check_count)))
-            if self.flush_count == FLUSH_LOGGING_INITIAL:
+            log_func("Flush #%s: flushed %s metric%s, %s event%s, and %s service check run%s" % (status['flush_count'], count, plural(count), event_count, plural(event_count), service_check_count, plural(service_check_count)))
+            if status['flush_count'] == FLUSH_LOGGING_INITIAL:
                 log.info("First flushes done, %s flushes will be logged every %s flushes." % (FLUSH_LOGGING_COUNT, FLUSH_LOGGING_PERIOD))
 
             # Persist a status message.
-            packet_count = self.metrics_aggregator.total_count
             DogstatsdStatus(
-                flush_count=self.flush_count,
-                packet_count=packet_count,
-                packets_per_second=packets_per_second,
                 metric_count=count,
                 event_count=event_count,
                 service_check_count=service_check_count,
+                flush_duration=round(flush_duration * 1000.0, 2),
+                request_count=request_count,
+                avg_request_latency=round(sum(request_latencies) / request_count, 2) if request_count else 0,
+                max_request_latency=max(request_latencies) if request_count else 0,
+                reused_connection_count=max(0, request_count - new_connection_count),
+                dropped_flush_count=self.dropped_flush_count,
+                **status
             ).persist()
 
         except Exception:
@@ -295,12 +596,12 @@ class Reporter(threading.Thread):
                 log.exception("Error flushing metrics")
 
     def submit(self, metrics):
-        body, headers = serialize_metrics(metrics, self.hostname)
         params = {}
         if self.api_key:
             params['api_key'] = self.api_key
         url = '%s/api/v1/series?%s' % (self.api_host, urlencode(params))
-        self.submit_http(url, body, headers)
+        for body, headers in serialize_metrics_payloads(metrics, self.hostname):
+            self.submit_async(url, body, headers)
 
     def submit_events(self, events):
         headers = {'Content-Type':'application/json'}
@@ -320,21 +621,47 @@ class Reporter(threading.Thread):
                 params['api_key'] = self.api_key
             url = '%s/intake?%s' % (self.api_host, urlencode(params))
 
-            self.submit_http(url, json.dumps(payload), headers)
+            self.submit_async(url, json.dumps(payload), headers)
+
+    def submit_async(self, url, data, headers):
+        """ Post a payload from the submit threads, see `wait_for_submits` """
+        if self.submit_pool is None:
+            self.submit_http(url, data, headers)
+        else:
+            self.pending_submits.append(self.submit_pool.apply_async(self.submit_http, (url, data, headers)))
+
+    def wait_for_submits(self):
+        """ Wait for the payloads posted with `submit_async` to be sent """
+        for result in self.pending_submits:
+            result.wait()
+        self.pending_submits = []
+
+    def connection_count(self):
+        """ Number of connections opened by the session to post payloads """
+        count = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    count += pool.num_connections
+        return count
 
     def submit_http(self, url, data, headers):
         headers["DD-Dogstatsd-Version"] = get_version()
         log.debug("Posting payload to %s" % string.split(url, "api_key=")[0])
         try:
             start_time = time()
-            r = requests.post(url, data=data, timeout=5, headers=headers)
+            r = self.session.post(url, data=data, timeout=SUBMIT_TIMEOUT, headers=headers)
+            duration = round((time() - start_time) * 1000.0, 4)
+            with self.http_stats_lock:
+                self.request_latencies.append(duration)
             r.raise_for_status()
 
             if r.status_code >= 200 and r.status_code < 205:
                 log.debug("Payload accepted")
 
             status = r.status_code
-            duration = round((time() - start_time) * 1000.0, 4)
             log.debug("%s POST %s (%sms)" % (status, string.split(url, "api_key=")[0], duration))
         except Exception as e:
             log.error("Unable to post payload: %s" % e.message)
@@ -351,14 +678,15 @@ class Reporter(threading.Thread):
             params['api_key'] = self.api_key
 
         url = '{0}/api/v1/check_run?{1}'.format(self.api_host, urlencode(params))
-        self.submit_http(url, json.dumps(service_checks), headers)
+        self.submit_async(url, json.dumps(service_checks), headers)
 
 
 class Server(object):
     """
     A statsd udp server.
     """
-    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None):
+    def __init__(self, metrics_aggregator, host, port, forward_to_host=None, forward_to_port=None, so_rcvbuf=None,
+                 batch_receive=False, max_batch_size=None, reuse_port=False):
         self.sockaddr = None
         self.socket = None
         self.metrics_aggregator = metrics_aggregator
@@ -367,6 +695,13 @@ class Server(object):
         self.buffer_size = 1024 * 8
         self.so_rcvbuf = so_rcvbuf
 
+        # In batch mode, every datagram pending on the socket is read on each
+        # wakeup and the whole batch is submitted to the aggregator at once.
+        self.batch_receive = batch_receive
+        self.max_batch_size = int(max_batch_size or MAX_BATCH_SIZE)
+        # Allow several servers to bind the same port, see `ServerPool`
+        self.reuse_port = reuse_port
+
         self.running = False
 
         self.should_forward = forward_to_host is not None
@@ -404,6 +739,9 @@ class Server(object):
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             ipv4_only = True
 
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
         self.socket.setblocking(0)
 
         #let's get the sockaddr
@@ -427,32 +765,241 @@ class Server(object):
         timeout = UDP_SOCKET_TIMEOUT
         should_forward = self.should_forward
         forward_udp_sock = self.forward_udp_sock
+        batch_receive = self.batch_receive
+        read_batch = self._read_batch
+        record_batch = self.metrics_aggregator.record_batch
+        next_drops_check = 0
 
         # Run our select loop.
         self.running = True
         message = None
         while self.running:
             try:
+                if batch_receive and time() >= next_drops_check:
+                    self._update_dropped_packet_count()
+                    next_drops_check = time() + DROPS_CHECK_INTERVAL
+
                 ready = select_select(sock, [], [], timeout)
                 if ready[0]:
-                    message = socket_recv(buffer_size)
-                    aggregator_submit(message)
-
-                    if should_forward:
-                        forward_udp_sock.send(message)
+                    if batch_receive:
+                        messages = read_batch()
+                        if not messages:
+                            continue
+                        record_batch(len(messages))
+                        if should_forward:
+                            for message in messages:
+                                forward_udp_sock.send(message)
+
+                        # Submitted one by one, so that a malformed datagram
+                        # doesn't discard the rest of the batch
+                        for message in messages:
+                            try:
+                                aggregator_submit(message)
+                            except Exception:
+                                log.exception('Error receiving datagram `%s`', message)
+                    else:
+                        message = socket_recv(buffer_size)
+                        if should_forward:
+                            forward_udp_sock.send(message)
+                        aggregator_submit(message)
             except select_error as se:
                 # Ignore interrupted system calls from sigterm.
-                errno = se[0]
-                if errno != 4:
+                if se[0] != errno.EINTR:
                     raise
             except (KeyboardInterrupt, SystemExit):
                 break
             except Exception:
                 log.exception('Error receiving datagram `%s`', message)
 
+    def _read_batch(self):
+        """
+        Drain the datagrams pending on the (non-blocking) socket, stopping
+        at `max_batch_size` so a flood can't starve the aggregator.
+        """
+        socket_recv = self.socket.recv
+        buffer_size = self.buffer_size
+        max_batch_size = self.max_batch_size
+
+        messages = []
+        while len(messages) < max_batch_size:
+            try:
+                messages.append(socket_recv(buffer_size))
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+        return messages
+
+    def _update_dropped_packet_count(self):
+        drops = get_udp_socket_drops(self.socket)
+        if drops is not None:
+            self.metrics_aggregator.dropped_packet_count = drops
+
+    def stop(self):
+        self.running = False
+
+
+class ServerWorker(multiprocessing.Process):
+    """
+    A dogstatsd server running in its own process, with its own aggregator.
+    Its aggregated state is handed over to the parent process through a
+    pipe, when requested at flush time.
+    """
+
+    def __init__(self, aggregator_factory, host, port, server_kwargs):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.aggregator_factory = aggregator_factory
+        self.host = host
+        self.port = port
+        self.server_kwargs = server_kwargs
+        self.server = None
+        self.conn, self.child_conn = multiprocessing.Pipe()
+
+        # Parent side state
+        self.pending_snapshot = False
+        self.dropped_packet_count = 0
+
+    def _handle_sigterm(self, signum, frame):
+        self.server.stop()
+
+    def run(self):
+        # Workers are forked while the reporter, sender and submit threads of
+        # the parent may be logging
+        reset_logging_locks()
+
+        # The parent process handles the keyboard interrupts, and terminates
+        # the workers
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+
+        aggregator = self.aggregator_factory()
+        self.server = Server(aggregator, self.host, self.port, reuse_port=True, **self.server_kwargs)
+
+        snapshot_thread = threading.Thread(target=self._serve_snapshots, args=(aggregator,))
+        snapshot_thread.daemon = True
+        snapshot_thread.start()
+
+        self.server.start()
+
+    def _serve_snapshots(self, aggregator):
+        while True:
+            try:
+                flush_cutoff_time = self.child_conn.recv()
+            except (EOFError, IOError):
+                # Our parent is gone
+                self.server.stop()
+                return
+            self.child_conn.send(aggregator.snapshot(flush_cutoff_time))
+
+    def request_snapshot(self, flush_cutoff_time):
+        """
+        Ask the worker for its state. If the previous request timed out, wait
+        for it instead: its snapshot will still be merged, one flush late.
+        """
+        if not self.pending_snapshot:
+            self.conn.send(flush_cutoff_time)
+            self.pending_snapshot = True
+
+    def receive_snapshot(self, timeout):
+        if not self.conn.poll(timeout):
+            return None
+
+        snapshot = self.conn.recv()
+        self.pending_snapshot = False
+        self.dropped_packet_count = snapshot['dropped_packet_count']
+        return snapshot
+
+
+class ServerPool(object):
+    """
+    Run several dogstatsd servers in worker processes, all bound to the same
+    UDP port with SO_REUSEPORT so that the kernel spreads the packets between
+    them, and parsing and aggregation aren't capped to a single core.
+    """
+
+    def __init__(self, worker_count, aggregator_factory, host, port, **server_kwargs):
+        self.worker_count = int(worker_count)
+        self.aggregator_factory = aggregator_factory
+        self.host = host
+        self.port = port
+        self.server_kwargs = server_kwargs
+        self.sockaddr = None
+        self.running = False
+
+        self.workers = []
+        self.workers_lock = threading.Lock()
+
+    def _start_worker(self):
+        worker = ServerWorker(self.aggregator_factory, self.host, self.port, self.server_kwargs)
+        worker.start()
+        return worker
+
+    def start(self):
+        """
+        Start the workers, and restart them if they die until we're stopped.
+        """
+        self.sockaddr = get_socket_address(self.host, int(self.port))
+        with self.workers_lock:
+            self.workers = [self._start_worker() for _ in xrange(self.worker_count)]
+        log.info('Started %s dogstatsd workers listening on port %s', self.worker_count, self.port)
+
+        self.running = True
+        try:
+            while self.running:
+                sleep(WORKER_CHECK_INTERVAL)
+                with self.workers_lock:
+                    for i, worker in enumerate(self.workers):
+                        if self.running and not worker.is_alive():
+                            log.warning('Dogstatsd worker %s exited with code %s, restarting it',
+                                        worker.pid, worker.exitcode)
+                            self.workers[i] = self._start_worker()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            self.running = False
+            with self.workers_lock:
+                for worker in self.workers:
+                    worker.terminate()
+                for worker in self.workers:
+                    worker.join(UDP_SOCKET_TIMEOUT * 2)
+
     def stop(self):
         self.running = False
 
+    def collect(self, flush_cutoff_time):
+        """
+        Return the snapshots of the buckets closed before `flush_cutoff_time`
+        by every worker.
+        """
+        with self.workers_lock:
+            workers = list(self.workers)
+
+        for worker in workers:
+            try:
+                worker.request_snapshot(flush_cutoff_time)
+            except (EOFError, IOError) as e:
+                log.warning('Unable to reach dogstatsd worker %s: %s', worker.pid, e)
+
+        snapshots = []
+        for worker in workers:
+            try:
+                snapshot = worker.receive_snapshot(WORKER_SNAPSHOT_TIMEOUT)
+            except (EOFError, IOError) as e:
+                log.warning('Unable to get the state of dogstatsd worker %s: %s', worker.pid, e)
+                continue
+            if snapshot is None:
+                log.warning('Timed out waiting for the state of dogstatsd worker %s, '
+                            'it will be merged with the next flush', worker.pid)
+                continue
+            snapshots.append(snapshot)
+
+        return snapshots
+
+    def dropped_packet_count(self):
+        with self.workers_lock:
+            return sum(worker.dropped_packet_count for worker in self.workers)
+
 
 class Dogstatsd(Daemon):
     """ This class is the dogstatsd daemon. """
@@ -593,6 +1140,15 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     event_chunk_size = agent_config.get('event_chunk_size')
     recent_point_threshold = agent_config.get('recent_point_threshold', None)
     so_rcvbuf = agent_config.get('statsd_so_rcvbuf', None)
+    batch_receive = _is_affirmative(agent_config.get('statsd_batch_receive', False))
+    max_batch_size = agent_config.get('statsd_max_batch_size', None)
+    worker_count = int(agent_config.get('statsd_workers', None) or 1)
+    context_cache_size = agent_config.get('statsd_context_cache_size', None)
+    if context_cache_size is None:
+        context_cache_size = DEFAULT_CONTEXT_CACHE_SIZE
+    max_contexts = agent_config.get('statsd_max_contexts', None)
+    telemetry_port = agent_config.get('statsd_telemetry_port', None)
+    telemetry_port = int(telemetry_port) if telemetry_port else None
     server_host = agent_config['bind_host']
 
     target = agent_config['dd_url']
@@ -606,18 +1162,22 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     # server and reporting threads.
     assert 0 < interval
 
-    aggregator = MetricsBucketAggregator(
-        hostname,
-        aggregator_interval,
-        recent_point_threshold=recent_point_threshold,
-        formatter=get_formatter(agent_config),
-        histogram_aggregates=agent_config.get('histogram_aggregates'),
-        histogram_percentiles=agent_config.get('histogram_percentiles'),
-        utf8_decoding=agent_config['utf8_decoding']
-    )
+    def aggregator_factory(formatter=None):
+        return MetricsBucketAggregator(
+            hostname,
+            aggregator_interval,
+            recent_point_threshold=recent_point_threshold,
+            formatter=formatter,
+            histogram_aggregates=agent_config.get('histogram_aggregates'),
+            histogram_percentiles=agent_config.get('histogram_percentiles'),
+            utf8_decoding=agent_config['utf8_decoding'],
+            histogram_backend=agent_config.get('histogram_backend'),
+            context_cache_size=int(context_cache_size),
+            max_contexts=int(max_contexts) if max_contexts else None,
+            telemetry_capacity=DEFAULT_TELEMETRY_CAPACITY if telemetry_port else None
+        )
 
-    # Start the reporting thread.
-    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size, hostname)
+    aggregator = aggregator_factory(formatter=get_formatter(agent_config))
 
     # NOTICE: when `non_local_traffic` is passed we need to bind to any interface on the box. The forwarder uses
     # Tornado which takes care of sockets creation (more than one socket can be used at once depending on the
@@ -628,7 +1188,24 @@ def init5(agent_config=None, use_watchdog=False, use_forwarder=False, args=None)
     if non_local_traffic:
         server_host = '0.0.0.0'
 
-    server = Server(aggregator, server_host, port, forward_to_host=forward_to_host, forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf)
+    server_kwargs = dict(forward_to_host=forward_to_host, forward_to_port=forward_to_port, so_rcvbuf=so_rcvbuf,
+                         batch_receive=batch_receive, max_batch_size=max_batch_size)
+
+    if worker_count > 1 and SO_REUSEPORT is None:
+        log.warning("SO_REUSEPORT is not available on this platform, starting a single dogstatsd server")
+        worker_count = 1
+
+    server_pool = None
+    if worker_count > 1:
+        # The workers aggregate with the default formatter, the metrics are
+        # formatted by our aggregator when merged
+        server = server_pool = ServerPool(worker_count, aggregator_factory, server_host, port, **server_kwargs)
+    else:
+        server = Server(aggregator, server_host, port, **server_kwargs)
+
+    # Start the reporting thread.
+    reporter = Reporter(interval, aggregator, target, api_key, use_watchdog, event_chunk_size, hostname,
+                        server_pool=server_pool, telemetry_port=telemetry_port)
 
     return reporter, server
 
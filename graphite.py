@@ -4,7 +4,9 @@
 
 # stdlib
 import cPickle as pickle
+from cStringIO import StringIO
 import logging
+import re
 import struct
 
 # 3p
@@ -13,32 +15,134 @@ from tornado.tcpserver import TCPServer
 
 # project
 from utils.hostname import get_hostname
+from utils.lru_cache import LRUCache
 
 log = logging.getLogger(__name__)
 
+DEFAULT_DEVICE = "N/A"
+
+# Metric names whose host and device are kept, to not match the rules for
+# every point
+NAME_CACHE_SIZE = 10000
+
+
+def safe_loads(data):
+    """
+    Unpickle `data`, refusing anything but the builtin types of a graphite
+    pickle payload: no class is looked up, so nothing can be executed.
+    """
+    unpickler = pickle.Unpickler(StringIO(data))
+    unpickler.find_global = None
+    return unpickler.load()
+
+
+def parse_name_rules(rules):
+    r"""
+    Compile the whitespace-separated regular expressions extracting the host
+    and device of the graphite metrics from their name, with the `host` and
+    `device` named groups. A `metric` group replaces the name of the metric.
+    e.g. ^servers\.(?P<host>[^.]+)\.(?P<metric>.+)$
+    """
+    if not rules:
+        return []
+    return [re.compile(rule) for rule in rules.split()]
+
+
+class GraphiteBuffer(object):
+    """
+    Graphite points received since the last flush, aggregated by series and
+    timestamp: the last value received wins, as it does in graphite.
+    """
+
+    def __init__(self):
+        # name -> {(host, device, ts): value}
+        self._points = {}
+
+    def __len__(self):
+        return sum(len(points) for points in self._points.itervalues())
+
+    def add_points(self, points):
+        """ Add (name, host, device, ts, value) points """
+        all_points = self._points
+        for name, host, device, ts, value in points:
+            series = all_points.get(name)
+            if series is None:
+                series = all_points[name] = {}
+            series[(host, device, ts)] = value
+
+    def flush(self):
+        """
+        Return the points by name, in the format of the `graphite` metrics of
+        the forwarder payloads: {name: [[host, device, ts, value], ...]}
+        """
+        metrics = {}
+        for name, series in self._points.iteritems():
+            metrics[name] = [[host, device, ts, value] for (host, device, ts), value in series.iteritems()]
+        self._points = {}
+        return metrics
+
 
 class GraphiteServer(TCPServer):
+    """ Receives graphite points in the pickle protocol """
 
-    def __init__(self, app, hostname, io_loop=None, ssl_options=None, **kwargs):
+    def __init__(self, buffer, hostname, io_loop=None, ssl_options=None, name_rules=None, **kwargs):
         log.warn('Graphite listener is started -- if you do not need graphite, turn it off in datadog.conf.')
-        log.warn('Graphite relay uses pickle to transport messages. Pickle is not secured against remote execution exploits.')
-        log.warn('See http://blog.nelhage.com/2011/03/exploiting-pickle/ for more details')
-        self.app = app
+        self.buffer = buffer
         self.hostname = hostname
+        self.name_rules = name_rules or []
+        self._names = LRUCache(NAME_CACHE_SIZE)
         TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options, **kwargs)
 
     def handle_stream(self, stream, address):
-        GraphiteConnection(stream, address, self.app, self.hostname)
+        GraphiteConnection(stream, address, self)
+
+    def parse_metric(self, metric):
+        """Graphite does not impose a particular metric structure.
+        So the host and device are extracted from the graphite metric name
+        by the first of the `name_rules` matching it, and are the hostname
+        of the agent and N/A otherwise.
+
+        Return the (metric, host, device) of a metric name
+        """
+        parsed = self._names.get(metric)
+        if parsed is None:
+            parsed = (metric, self.hostname, DEFAULT_DEVICE)
+            for rule in self.name_rules:
+                match = rule.match(metric)
+                if match is not None:
+                    groups = match.groupdict()
+                    parsed = (
+                        groups.get('metric') or metric,
+                        groups.get('host') or self.hostname,
+                        groups.get('device') or DEFAULT_DEVICE,
+                    )
+                    break
+            self._names.set(metric, parsed)
+        return parsed
+
+    def add_points(self, points):
+        """ Add (metric name, ts, value) points to the buffer """
+        parse_metric = self.parse_metric
+        self.buffer.add_points(
+            parse_metric(name) + (ts, value) for name, ts, value in points
+        )
+
+
+class GraphitePlaintextServer(GraphiteServer):
+    """ Receives graphite points in the plaintext protocol """
+
+    def handle_stream(self, stream, address):
+        GraphitePlaintextConnection(stream, address, self)
 
 
 class GraphiteConnection(object):
+    """ A connection sending frames of pickled points """
 
-    def __init__(self, stream, address, app, hostname):
+    def __init__(self, stream, address, server):
         log.debug('received a new connection from %s', address)
-        self.app = app
+        self.server = server
         self.stream = stream
         self.address = address
-        self.hostname = hostname
         self.stream.set_close_callback(self._on_close)
         self.stream.read_bytes(4, self._on_read_header)
 
@@ -57,65 +161,68 @@ class GraphiteConnection(object):
     def _on_close(self):
         log.debug('client quit %s', self.address)
 
-    def _parseMetric(self, metric):
-        """Graphite does not impose a particular metric structure.
-        So this is where you can insert logic to extract various bits
-        out of the graphite metric name.
-
-        For instance, if the hostname is in 4th position,
-        you could use: host = components[3]
-        """
-
+    def _decode(self, data):
         try:
-            components = metric.split('.') # NOQA
-
-            host = self.hostname
-            metric = metric
-            device = "N/A"
-
-            return metric, host, device
+            datapoints = safe_loads(data)
         except Exception:
-            log.exception("Unparsable metric: %s" % metric)
-            return None, None, None
+            log.exception("Cannot decode grapite points")
+            return
 
-    def _postMetric(self, name, host, device, datapoint):
+        points = []
+        for datapoint in datapoints:
+            try:
+                metric, (ts, value) = datapoint
+                points.append((metric, float(ts), float(value)))
+            except Exception:
+                log.error("Invalid graphite point: %r", datapoint)
 
-        ts = datapoint[0]
-        value = datapoint[1]
-        if self.app is not None:
-            self.app.appendMetric("graphite", name, host, device, ts, value)
+        self.server.add_points(points)
+        log.debug("Received %s points from %s", len(points), self.address)
 
-    def _processMetric(self, metric, datapoint):
-        """Parse the metric name to fetch (host, metric, device) and
-            send the datapoint to datadog"""
+        self.stream.read_bytes(4, self._on_read_header)
 
-        log.debug("New metric: %s, values: %s" % (metric, datapoint))
-        (metric, host, device) = self._parseMetric(metric)
-        if metric is not None:
-            self._postMetric(metric, host, device, datapoint)
-            log.info("Posted metric: %s, host: %s, device: %s" % (metric, host, device))
 
-    def _decode(self, data):
+class GraphitePlaintextConnection(object):
+    """ A connection sending `<metric name> <value> <timestamp>` lines """
 
-        try:
-            datapoints = pickle.loads(data)
-        except Exception:
-            log.exception("Cannot decode grapite points")
-            return
+    def __init__(self, stream, address, server):
+        log.debug('received a new connection from %s', address)
+        self.server = server
+        self.stream = stream
+        self.address = address
+        # Incomplete line at the end of the last chunk
+        self._pending = ''
+        self.stream.read_until_close(self._on_close, streaming_callback=self._on_read_chunk)
+
+    def _on_read_chunk(self, data):
+        lines = (self._pending + data).split('\n')
+        self._pending = lines.pop()
+        self._decode(lines)
+
+    def _on_close(self, data):
+        if data:
+            self._on_read_chunk(data)
+        if self._pending:
+            self._decode([self._pending])
+            self._pending = ''
+        log.debug('client quit %s', self.address)
 
-        for (metric, datapoint) in datapoints:
+    def _decode(self, lines):
+        points = []
+        for line in lines:
             try:
-                datapoint = (float(datapoint[0]), float(datapoint[1]))
-            except Exception as e:
-                log.error(e)
-                continue
+                metric, value, ts = line.split()
+                points.append((metric, float(ts), float(value)))
+            except Exception:
+                if line.strip():
+                    log.error("Invalid graphite line: %r", line)
 
-            self._processMetric(metric, datapoint)
+        self.server.add_points(points)
+        log.debug("Received %s points from %s", len(points), self.address)
 
-        self.stream.read_bytes(4, self._on_read_header)
 
 def start_graphite_listener(port):
-    echo_server = GraphiteServer(None, get_hostname(None))
+    echo_server = GraphiteServer(GraphiteBuffer(), get_hostname(None))
     echo_server.listen(port)
     IOLoop.instance().start()
 
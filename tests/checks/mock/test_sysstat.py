@@ -1,22 +1,31 @@
 # stdlib
 import logging
+import re
 import sys
+import time
 import unittest
 import mock
 
 # project
 from checks.system.unix import (
+    Cpu,
     IO,
     Load,
     Memory,
+    Processes,
 )
 from checks.system.unix import System
 from config import get_system_stats
+from tests.checks.common import Fixtures
 from utils.platform import Platform
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__file__)
 
+# When the fixtures proc and proc_previous were captured
+CAPTURE_TIME = 1792317627.58
+PREVIOUS_CAPTURE_TIME = 1792317625.51
+
 
 class TestSystem(unittest.TestCase):
 
@@ -284,3 +293,77 @@ ad0        0.0   2.0     0.0    31.8    0   0.2   102
         expected = 0
         for res in results:
             self.assertEqual(results[res]['%util'], expected)
+
+
+@unittest.skipUnless(Platform.is_linux(), "Reads the Linux /proc")
+class TestLinuxProc(unittest.TestCase):
+    """ The stats of the system checks read from /proc instead of commands """
+
+    def setUp(self):
+        # Captured on a Linux 6.18 VM: /proc and /sys/block, the /proc/diskstats
+        # and /proc/stat of the run before, and the `ps auxww` of the processes
+        self.config = {'procfs_path': Fixtures.file('proc'), 'api_key': 'apikey', 'hostname': 'myhost'}
+        self.previous_config = dict(self.config, procfs_path=Fixtures.file('proc_previous'))
+
+    @mock.patch('checks.system.unix.time.time')
+    def testIO(self, mock_time):
+        checker = IO(logger)
+        mock_time.return_value = PREVIOUS_CAPTURE_TIME
+        self.assertEqual(checker.check(self.previous_config), {})
+
+        mock_time.return_value = CAPTURE_TIME
+        results = checker.check(self.config)
+        # The loop and zram devices have never had any I/O
+        self.assertEqual(sorted(results.keys()), ['vda', 'vdb'])
+        # 169 writes of 131608 sectors, 17 merged, in 2.07s
+        self.assertEqual(results['vda'], {
+            'rrqm/s': 0.0,
+            'wrqm/s': 8.21,
+            'r/s': 0.0,
+            'w/s': 81.64,
+            'rkB/s': 0.0,
+            'wkB/s': 31789.37,
+            'avgrq-sz': 778.75,
+            'avgqu-sz': 0.05,
+            'await': 0.59,
+            'r_await': 0.0,
+            'w_await': 0.59,
+            'svctm': 0.26,
+            '%util': 2.13,
+        })
+        self.assertEqual(set(results['vdb'].values()), set([0.0]))
+
+        # The counters are reset, vdb is blacklisted
+        mock_time.return_value = CAPTURE_TIME + 2
+        self.previous_config['device_blacklist_re'] = re.compile('vdb')
+        self.assertEqual(checker.check(self.previous_config), {})
+
+    def testCpu(self):
+        checker = Cpu(logger)
+        self.assertFalse(checker.check(self.previous_config))
+
+        # 212 ticks: user 3, system 3, idle 197, iowait 4, steal 5
+        results = checker.check(self.config)
+        for key, expected in (('cpuUser', 1.42), ('cpuSystem', 1.42), ('cpuWait', 1.89),
+                              ('cpuIdle', 92.92), ('cpuStolen', 2.36), ('cpuGuest', 0.0)):
+            self.assertAlmostEqual(results[key], expected, places=2, msg=key)
+
+    @mock.patch('checks.system.unix.os.sysconf', side_effect=lambda name: {'SC_CLK_TCK': 100, 'SC_PAGE_SIZE': 4096}[name])
+    @mock.patch('checks.system.unix.time.time', return_value=CAPTURE_TIME)
+    # ps ran in UTC
+    @mock.patch('checks.system.unix.time.localtime', side_effect=time.gmtime)
+    def testProcesses(self, mock_localtime, mock_time, mock_sysconf):
+        ps_output = [line.split(None, 10) for line in Fixtures.read_file('ps_auxww').splitlines()[1:]]
+
+        checker = Processes(logger)
+        results = checker.check(self.config)
+        # A multithreaded session leader, niced processes, a command with
+        # parentheses and spaces, a stopped process, one in the foreground of
+        # a terminal and a kernel thread
+        self.assertEqual(results['processes'], ps_output)
+        self.assertEqual(results['apiKey'], 'apikey')
+
+        self.config['exclude_process_args'] = True
+        results = checker.check(self.config)
+        self.assertEqual([p[10] for p in results['processes']], [
+            '[kthreadd]', '/usr/bin/python3', 'sleep', 'sleep', 'bash', '/usr/bin/python3', 'sleep'])
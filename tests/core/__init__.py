@@ -0,0 +1,17 @@
+# stdlib
+import os
+
+# project
+import config
+
+TEST_CONFIG_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'config', 'agent.conf')
+
+_get_config_path = config.get_config_path
+
+
+def get_config_path(cfg_path=None, os_name=None):
+    """ Default to the tests' own config, modules reading it at import time included """
+    return _get_config_path(cfg_path or TEST_CONFIG_PATH, os_name=os_name)
+
+
+config.get_config_path = get_config_path
@@ -2,14 +2,25 @@
 """
 Performance tests for the agent/dogstatsd metrics aggregator.
 """
+# stdlib
+import logging
+import time
+
+# project
 from aggregator import MetricsAggregator, MetricsBucketAggregator
 
+log = logging.getLogger(__name__)
+
 
 class TestAggregatorPerf(object):
 
     FLUSH_COUNT = 10
     LOOPS_PER_FLUSH = 2000
     METRIC_COUNT = 5
+    # samples of a single hot timer per flush
+    HISTOGRAM_SAMPLES = 100000
+    # contexts of the flush benchmark
+    FLUSH_CONTEXTS = 100000
 
     def test_dogstatsd_aggregation_perf(self):
         ma = MetricsBucketAggregator('my.host')
@@ -38,6 +49,34 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+    def test_dogstatsd_tagged_aggregation_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        tags = 'env:prod,service:web,region:us-east-1,availability-zone:us-east-1a,version:1.2.3,role:front'
+
+        for _ in xrange(self.FLUSH_COUNT):
+            for i in xrange(self.LOOPS_PER_FLUSH):
+                for j in xrange(self.METRIC_COUNT):
+                    ma.submit_packets('counter.%s:%s|c|#%s' % (j, i, tags))
+                    ma.submit_packets('timer.%s:%s|ms|@0.5|#%s,endpoint:/api/v%s' % (j, i, tags, i % 10))
+
+            ma.flush()
+
+    def test_dogstatsd_flush_perf(self):
+        # Most counters are idle and keep reporting zeros until they expire
+        ma = MetricsBucketAggregator('my.host', interval=1)
+
+        timestamp = time.time() - self.FLUSH_COUNT
+        for i in xrange(self.FLUSH_CONTEXTS):
+            ma.submit_metric('counter', 1, 'c', tags=('id:%s' % i,), timestamp=timestamp)
+        ma.flush()
+
+        for i in xrange(self.FLUSH_COUNT):
+            timestamp += 1
+            for j in xrange(0, self.FLUSH_CONTEXTS, 100):
+                ma.submit_metric('counter', 1, 'c', tags=('id:%s' % (i + j),), timestamp=timestamp)
+                ma.submit_metric('gauge', 1, 'g', tags=('id:%s' % (i + j),), timestamp=timestamp)
+            ma.flush()
+
     def test_checksd_aggregation_perf(self):
         ma = MetricsAggregator('my.host')
 
@@ -51,6 +90,34 @@ class TestAggregatorPerf(object):
                     ma.set('set.%s' % j, float(i))
             ma.flush()
 
+    def test_metric_packet_parsing_perf(self):
+        ma = MetricsBucketAggregator('my.host')
+        packets = [
+            'counter.1:1|c',
+            'gauge.1:2.5|g|@0.5',
+            'histogram.1:3|h|#tag1,tag2,env:prod,role:db:primary',
+            'histogram.1:3|h|#tag3,host:other.host,device:sda1',
+        ]
+
+        for _ in xrange(self.FLUSH_COUNT):
+            for _ in xrange(self.LOOPS_PER_FLUSH):
+                for packet in packets:
+                    ma.parse_metric_line(packet)
+
+    def _histogram_perf(self, histogram_backend):
+        ma = MetricsAggregator('my.host', histogram_backend=histogram_backend)
+
+        for _ in xrange(self.FLUSH_COUNT):
+            for i in xrange(self.HISTOGRAM_SAMPLES):
+                ma.submit_metric('hot.timer', (i * 7919) % 100000 / 10.0, 'ms')
+            ma.flush()
+
+    def test_exact_histogram_perf(self):
+        self._histogram_perf('exact')
+
+    def test_sketch_histogram_perf(self):
+        self._histogram_perf('sketch')
+
     def create_event_packet(self, title, text):
         p = "_e{{{title_len},{text_len}}}:{title}|{text}".format(
             title_len=len(title),
@@ -106,8 +173,45 @@ class TestAggregatorPerf(object):
 
             ma.flush()
 
+
+def compare_histogram_backends():
+    """ Log the cost of the exact and sketch histogram backends """
+    t = TestAggregatorPerf()
+    for backend in ['exact', 'sketch']:
+        start = time.time()
+        t._histogram_perf(backend)
+        log.info("%s histogram backend: %.3fs for %s flushes of %s samples",
+                 backend, time.time() - start, t.FLUSH_COUNT, t.HISTOGRAM_SAMPLES)
+
+
+def compare_metric_packet_parsers():
+    """ Print the packets per second of the reference and single-pass parsers """
+    ma = MetricsBucketAggregator('my.host')
+    packets = [
+        'counter.1:1|c',
+        'gauge.1:2.5|g|@0.5',
+        'histogram.1:3|h|#tag1,tag2,env:prod,role:db:primary',
+        'histogram.1:3|h|#tag3,host:other.host,device:sda1',
+    ] * 50000
+
+    def reference(packet):
+        for _, _, _, tags, _ in ma.parse_metric_packet(packet):
+            if tags is not None:
+                tags = tuple(ma.deduplicate_tags(tags))
+            ma._extract_magic_tags(tags)
+
+    for name, parse in [('reference', reference), ('single-pass', ma.parse_metric_line)]:
+        start = time.time()
+        for packet in packets:
+            parse(packet)
+        log.info("%s parser: %d packets/s", name, len(packets) / (time.time() - start))
+
+
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
     t = TestAggregatorPerf()
     #t.test_dogstatsd_aggregation_perf()
     #t.test_checksd_aggregation_perf()
+    #compare_histogram_backends()
+    #compare_metric_packet_parsers()
     t.test_dogstatsd_utf8_events()
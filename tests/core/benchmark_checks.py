@@ -0,0 +1,69 @@
+"""
+Performance tests for the checks.d helpers.
+"""
+# stdlib
+import logging
+import time
+
+# project
+from checks import AgentCheck, Check
+from tests.core.test_common import reference_normalize
+
+log = logging.getLogger(__name__)
+
+
+class TestCheckPerf(object):
+
+    RUNS = 20
+    # distinct metric names normalized at each run
+    METRIC_NAMES = 2000
+    # series of each metric of the legacy check
+    SERIES = 1000
+
+    def _metric_names(self):
+        return [
+            ('Server.Requests(%s)/Sec-%s' % (i % 10, i), 'prefix', i % 2 == 0)
+            for i in xrange(self.METRIC_NAMES)
+        ]
+
+    def test_normalize_perf(self):
+        check = AgentCheck('perf', {}, {'checksd_hostname': 'foo'})
+        names = self._metric_names()
+        for _ in xrange(self.RUNS):
+            for metric, prefix, fix_case in names:
+                check.normalize(metric, prefix, fix_case)
+
+    def test_legacy_check_perf(self):
+        check = Check(None)
+        check.gauge('gauge')
+        check.counter('counter')
+        tags = [['series:%s' % i, 'role:db'] for i in xrange(self.SERIES)]
+        for run in xrange(self.RUNS):
+            for i in xrange(self.SERIES):
+                check.save_sample('gauge', i, run, tags=tags[i])
+                check.save_sample('counter', i * run, run, tags=tags[i], device_name='sda')
+            check.get_metrics()
+
+
+def compare_normalizers():
+    """ Print the per-call cost of the regex-based and memoized normalizers """
+    t = TestCheckPerf()
+    check = AgentCheck('perf', {}, {'checksd_hostname': 'foo'})
+    names = t._metric_names()
+    calls = t.RUNS * len(names)
+
+    for name, normalize in [('regex-based', lambda *args: reference_normalize(check, *args)),
+                            ('memoized', check.normalize)]:
+        start = time.time()
+        for _ in xrange(t.RUNS):
+            for metric, prefix, fix_case in names:
+                normalize(metric, prefix, fix_case)
+        log.info("%s normalizer: %.2fus per call", name, (time.time() - start) * 1e6 / calls)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    compare_normalizers()
+    start = time.time()
+    TestCheckPerf().test_legacy_check_perf()
+    log.info("legacy check: %.3fs", time.time() - start)
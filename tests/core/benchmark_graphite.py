@@ -0,0 +1,73 @@
+"""
+Performance tests for the graphite listener.
+"""
+# stdlib
+import cPickle as pickle
+import logging
+import time
+
+# 3p
+import mock
+
+# project
+from graphite import (
+    GraphiteBuffer,
+    GraphiteConnection,
+    GraphitePlaintextConnection,
+    GraphiteServer,
+    parse_name_rules,
+)
+
+log = logging.getLogger(__name__)
+
+
+class TestGraphitePerf(object):
+
+    # points pushed by each test, what a busy relay sends in a minute
+    POINTS = 1000000
+    # points in a pickle frame, the default of carbon relays
+    FRAME_SIZE = 500
+    # plaintext data read at once
+    CHUNK_SIZE = 64 * 1024
+    SERIES = 10000
+    FLUSH_POINTS = 100000
+
+    def _server(self):
+        rules = parse_name_rules(r'^servers\.(?P<host>[^.]+)\.(?P<metric>.+)$')
+        return GraphiteServer(GraphiteBuffer(), 'myhost', name_rules=rules)
+
+    def _points(self, count):
+        ts = int(time.time())
+        return [
+            ('servers.host-%s.metric.%s' % (i % 100, i % self.SERIES), (ts + i / self.SERIES, i))
+            for i in xrange(count)
+        ]
+
+    def test_pickle_perf(self):
+        server = self._server()
+        connection = GraphiteConnection(mock.Mock(), ('127.0.0.1', 1234), server)
+        points = self._points(self.FLUSH_POINTS)
+        frames = [
+            pickle.dumps(points[i:i + self.FRAME_SIZE], pickle.HIGHEST_PROTOCOL)
+            for i in xrange(0, len(points), self.FRAME_SIZE)
+        ]
+
+        start = time.time()
+        for _ in xrange(self.POINTS / self.FLUSH_POINTS):
+            for frame in frames:
+                connection._decode(frame)
+            server.buffer.flush()
+        log.info("pickle: %d points/s", self.POINTS / (time.time() - start))
+
+    def test_plaintext_perf(self):
+        server = self._server()
+        connection = GraphitePlaintextConnection(mock.Mock(), ('127.0.0.1', 1234), server)
+        data = ''.join('%s %s %s\n' % (name, value, ts) for name, (ts, value) in self._points(self.FLUSH_POINTS))
+        chunks = [data[i:i + self.CHUNK_SIZE] for i in xrange(0, len(data), self.CHUNK_SIZE)]
+
+        start = time.time()
+        for _ in xrange(self.POINTS / self.FLUSH_POINTS):
+            for chunk in chunks:
+                connection._on_read_chunk(chunk)
+            server.buffer.flush()
+        log.info("plaintext: %d points/s", self.POINTS / (time.time() - start))
@@ -586,6 +586,66 @@ class TestMetricsAggregator(unittest.TestCase):
         nt.assert_equal(first['metric'], 'datadog.dogstatsd.packet.count')
         nt.assert_equal(first['points'][0][1], 10)
 
+    def test_batch_stats(self):
+        stats = MetricsAggregator('myhost')
+        nt.assert_equal(stats.flush_batch_stats(), (0, 0, 0))
+
+        stats.record_batch(3)
+        stats.record_batch(10)
+        stats.record_batch(2)
+        nt.assert_equal(stats.flush_batch_stats(), (3, 15, 10))
+
+        # Stats are reset at each flush
+        nt.assert_equal(stats.flush_batch_stats(), (0, 0, 0))
+
+    def test_context_cache(self):
+        stats = MetricsAggregator('myhost', context_cache_size=1)
+
+        stats.submit_packets('my.gauge:1|g|#b,a,host:other')
+        stats.submit_packets('my.gauge:2|g|#b,a,host:other')
+        stats.submit_packets('my.gauge:3|g')
+        stats.submit_packets('my.counter:1|c|#a,b,a')
+        # Untagged packets don't go through the cache
+        nt.assert_equal(stats.context_cache.flush_stats(), (1, 2, 1))
+
+        # The cached contexts are the same as the uncached ones
+        stats.submit_metric('my.counter', 2, 'c', tags=['b', 'a'])
+        stats.submit_metric('my.gauge', 4, 'g', tags=['a', 'b'], hostname='other')
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal(len(metrics), 3)
+        counter, gauge, tagged_gauge = metrics
+        nt.assert_equal(counter['points'][0][1], 3)
+        nt.assert_equal(counter['tags'], ('a', 'b'))
+        nt.assert_equal(gauge['points'][0][1], 3)
+        nt.assert_equal(gauge['tags'], None)
+        nt.assert_equal(gauge['host'], 'myhost')
+        nt.assert_equal(tagged_gauge['points'][0][1], 4)
+        nt.assert_equal(tagged_gauge['tags'], ('a', 'b'))
+        nt.assert_equal(tagged_gauge['host'], 'other')
+
+    def test_max_contexts(self):
+        stats = MetricsAggregator('myhost', max_contexts=2)
+
+        stats.submit_packets('my.counter:1|c\nmy.gauge:1|g\nmy.gauge:2|g|#new\nmy.counter:3|c')
+        stats.histogram('my.histogram', 1)
+        nt.assert_equal(stats.num_discarded_new_contexts_points, 2)
+
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+                        [('my.counter', 4), ('my.gauge', 1)])
+        nt.assert_equal(stats.num_discarded_new_contexts_points, 0)
+
+    def test_metrics_have_no_dict(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch')
+        for mtype in ['g', 'c', 'h', 'ms', 's', '_dd-r', 'ct', 'ct-c']:
+            stats.submit_metric('my.metric.%s' % mtype, 1, mtype)
+
+        for metric in stats.metrics.itervalues():
+            nt.assert_false(hasattr(metric, '__dict__'), type(metric))
+            # The formatter is passed at flush time, not kept by every context
+            nt.assert_false(hasattr(metric, 'formatter'), type(metric))
+
     @attr(requires='core_integration')
     def test_histogram_counter(self):
         # Test whether histogram.count == increment
@@ -863,3 +923,49 @@ class TestMetricsAggregator(unittest.TestCase):
 
         nt.assert_equals(third['metric'], 'line_ending.windows')
         nt.assert_equals(third['points'][0][1], 300)
+
+    def _reference_parse(self, stats, packet):
+        parsed = []
+        for name, value, mtype, tags, sample_rate in stats.parse_metric_packet(packet):
+            if tags is not None:
+                tags = tuple(stats.deduplicate_tags(tags))
+            hostname, device_name, tags = stats._extract_magic_tags(tags)
+            parsed.append((name, value, mtype, tags, sample_rate, hostname, device_name))
+        return parsed
+
+    def test_parse_metric_line(self):
+        stats = MetricsAggregator('myhost')
+
+        nt.assert_equals(
+            stats.parse_metric_line('my.metric:1|c|@0.5|#b,a:x:y,host:h,a:x:y:2.5|g'),
+            [
+                ('my.metric', 1, 'c', ('a:x:y', 'b'), 0.5, 'h', None),
+                ('my.metric', 2.5, 'g', None, 1, None, None),
+            ]
+        )
+
+        # Compare with the reference parser on random packets
+        rand = random.Random(42)
+        pieces = ['a', 'b', 'tag', 'host:h1', 'host:h2', 'device:d', 'k:v', 'k:v:w', 'x:', '', 'hostile']
+        metadata = ['@0.5', '@2', '@-1', '@x', '', '#', '#a', '@', 'junk']
+        for _ in xrange(2000):
+            data = []
+            for _ in xrange(rand.randint(1, 3)):
+                datum = [rand.choice(['1', '2.5', '-3', '1e3', 'x', '']),
+                         rand.choice(['c', 'g', 'h', 'ms', 's', 'd', ''])]
+                for _ in xrange(rand.randint(0, 3)):
+                    if rand.random() < 0.5:
+                        datum.append('#' + ','.join(rand.choice(pieces) for _ in xrange(rand.randint(1, 5))))
+                    else:
+                        datum.append(rand.choice(metadata))
+                data.append('|'.join(datum))
+            packet = rand.choice(['my.metric', 'other', '']) + ':' + ':'.join(data)
+            if rand.random() < 0.05:
+                packet = packet.replace(':', '', 1)
+
+            try:
+                expected = self._reference_parse(stats, packet)
+            except Exception as e:
+                nt.assert_raises(type(e), stats.parse_metric_line, packet)
+            else:
+                nt.assert_equals(stats.parse_metric_line(packet), expected, packet)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 # stdlib
+import cPickle as pickle
 import random
 import time
 import unittest
@@ -1042,3 +1043,166 @@ class TestUnitMetricsBucketAggregator(unittest.TestCase):
         stats = MetricsBucketAggregator('myhost', interval=5)
         nt.assert_equal(stats.calculate_bucket_start(13284287), 13284285)
         nt.assert_equal(stats.calculate_bucket_start(13284280), 13284280)
+
+    def test_merge_snapshot(self):
+        ag_interval = 1
+        workers = [
+            MetricsBucketAggregator('myhost', interval=ag_interval),
+            MetricsBucketAggregator('myhost', interval=ag_interval),
+        ]
+        stats = MetricsBucketAggregator('myhost', interval=ag_interval)
+
+        self.wait_for_bucket_boundary(ag_interval)
+        workers[0].submit_packets('my.counter:1|c\nmy.gauge:1|g\nmy.histogram:1|h\nmy.histogram:2|h\nmy.set:a|s')
+        workers[0].submit_packets('_e{5,4}:title|text')
+        time.sleep(0.01)
+        workers[1].submit_packets('my.counter:2|c\nmy.gauge:5|g\nmy.histogram:3|h\nmy.set:a|s\nmy.set:b|s')
+        workers[1].submit_packets('_sc|check|0')
+
+        self.sleep_for_interval_length(ag_interval)
+        flush_cutoff_time = stats.calculate_bucket_start(time.time())
+        for worker in workers:
+            # Snapshots are pickled to be sent by the worker processes
+            snapshot = pickle.dumps(worker.snapshot(flush_cutoff_time), pickle.HIGHEST_PROTOCOL)
+            stats.merge_snapshot(pickle.loads(snapshot))
+            # The closed buckets were handed over
+            nt.assert_equal(worker.metric_by_bucket, {})
+
+        nt.assert_equal(stats.count, 10)
+        nt.assert_equal(len(stats.flush_events()), 1)
+        nt.assert_equal(len(stats.flush_service_checks()), 1)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        # counters are summed
+        nt.assert_equal(metrics['my.counter'], 3)
+        # last gauge write wins
+        nt.assert_equal(metrics['my.gauge'], 5)
+        # histograms are merged
+        nt.assert_equal(metrics['my.histogram.count'], 3)
+        nt.assert_equal(metrics['my.histogram.max'], 3)
+        nt.assert_equal(metrics['my.histogram.avg'], 2)
+        # sets are unioned
+        nt.assert_equal(metrics['my.set'], 2)
+
+        # Every metric is flushed once, only the non-expired counter remains
+        self.sleep_for_interval_length(ag_interval)
+        for worker in workers:
+            stats.merge_snapshot(worker.snapshot(stats.calculate_bucket_start(time.time())))
+        metrics = stats.flush()
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics], [('my.counter', 0)])
+
+    def test_max_contexts(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, max_contexts=2)
+
+        self.wait_for_bucket_boundary()
+        stats.submit_packets('my.counter:1|c\nmy.gauge:1|g\nmy.gauge:2|g|#new\nmy.counter:3|c')
+        stats.submit_packets('my.histogram:1|h')
+        nt.assert_equal(stats.num_discarded_new_contexts_points, 2)
+
+        self.sleep_for_interval_length()
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+                        [('my.counter', 4), ('my.gauge', 1)])
+        nt.assert_equal(stats.num_discarded_new_contexts_points, 0)
+
+    def test_max_contexts_across_buckets(self):
+        stats = MetricsBucketAggregator('myhost', interval=10, max_contexts=2)
+        now = time.time()
+
+        # The limit applies to all the buckets, not to each of them
+        for ts in [now - 20, now - 10, now]:
+            stats.submit_metric('my.gauge', 1, 'g', timestamp=ts)
+        nt.assert_equal(stats.num_discarded_new_contexts_points, 1)
+        nt.assert_equal(stats.bucket_context_count, 2)
+
+        stats.flush()
+        nt.assert_equal(stats.bucket_context_count, 0)
+
+    def test_max_contexts_counters(self):
+        stats = MetricsBucketAggregator('myhost', interval=10, max_contexts=2)
+        now = time.time()
+        stats.submit_metric('my.counter.1', 1, 'c', timestamp=now - 20)
+        stats.submit_metric('my.counter.2', 1, 'c', timestamp=now - 20)
+        stats.flush()
+        nt.assert_equal(stats.bucket_context_count, 0)
+
+        # The counters kept reporting 0 count, but are never discarded
+        stats.submit_metric('my.gauge', 1, 'g', timestamp=now - 10)
+        stats.submit_metric('my.counter.1', 1, 'c', timestamp=now - 10)
+        nt.assert_equal(stats.num_discarded_new_contexts_points, 1)
+        metrics = self.sort_metrics(stats.flush())
+        nt.assert_equal([(m['metric'], m['points'][0][1]) for m in metrics],
+                        [('my.counter.1', 0.1), ('my.counter.2', 0)])
+
+    def test_merge_snapshot_max_contexts(self):
+        workers = [
+            MetricsBucketAggregator('myhost', interval=10),
+            MetricsBucketAggregator('myhost', interval=10),
+        ]
+        stats = MetricsBucketAggregator('myhost', interval=10, max_contexts=3)
+        ts = time.time() - 10
+        for i, worker in enumerate(workers):
+            worker.submit_metric('my.gauge', 1, 'g', timestamp=ts)
+            worker.submit_metric('my.gauge.%s' % i, 1, 'g', timestamp=ts)
+            worker.submit_metric('my.other.%s' % i, 1, 'g', timestamp=ts)
+
+        for worker in workers:
+            stats.merge_snapshot(worker.snapshot(time.time() + 10))
+        nt.assert_equal(stats.bucket_context_count, 3)
+        nt.assert_equal(stats.num_discarded_new_contexts_points, 2)
+        nt.assert_equal(len(stats.flush()), 3)
+
+    def test_snapshot_keeps_open_bucket(self):
+        stats = MetricsBucketAggregator('myhost', interval=10)
+        stats.submit_packets('my.counter:1|c')
+
+        snapshot = stats.snapshot(stats.calculate_bucket_start(time.time()))
+        nt.assert_equal(snapshot['buckets'], {})
+        nt.assert_equal(snapshot['count'], 1)
+        nt.assert_equal(len(stats.metric_by_bucket), 1)
+
+    def test_telemetry(self):
+        stats = MetricsBucketAggregator('myhost', interval=self.interval)
+        stats.submit_packets('my.counter:1|c')
+        stats.flush()
+        nt.assert_equal(stats.telemetry_report(10), None)
+
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, telemetry_capacity=10)
+        self.wait_for_bucket_boundary()
+        stats.submit_packets('my.counter:1|c|#a\nmy.counter:1|c|#b\nmy.counter:1|c|#b\nmy.gauge:1|g|@0.5')
+        stats.submit_packets('my.counter:1|c|#c:d:2|c|#e')
+        # Only complete windows are reported
+        nt.assert_equal(stats.telemetry_report(10), None)
+
+        self.sleep_for_interval_length()
+        stats.flush()
+        report = stats.telemetry_report(1)
+        nt.assert_equal(report['sample_count'], 6)
+        nt.assert_equal(report['context_count'], 5)
+        nt.assert_equal([(m['name'], m['samples'], m['error']) for m in report['top_samples']],
+                        [('my.counter', 5, 0)])
+        nt.assert_equal([(m['name'], m['contexts'], m['error']) for m in report['top_contexts']],
+                        [('my.counter', 4, 0)])
+        assert report['top_samples'][0]['samples_per_second'] > 0
+        assert report['end_time'] > report['start_time']
+
+        # A new window starts at each flush
+        stats.submit_packets('my.gauge:1|g')
+        stats.flush()
+        report = stats.telemetry_report(10)
+        nt.assert_equal([(m['name'], m['samples']) for m in report['top_samples']], [('my.gauge', 1)])
+
+    def test_merge_snapshot_telemetry(self):
+        worker = MetricsBucketAggregator('myhost', interval=self.interval, telemetry_capacity=10)
+        stats = MetricsBucketAggregator('myhost', interval=self.interval, telemetry_capacity=10)
+        worker.submit_packets('my.counter:1|c\nmy.counter:1|c|#a')
+        stats.submit_packets('my.gauge:1|g')
+
+        snapshot = pickle.dumps(worker.snapshot(time.time()), pickle.HIGHEST_PROTOCOL)
+        stats.merge_snapshot(pickle.loads(snapshot))
+        stats.flush()
+        report = stats.telemetry_report(10)
+        nt.assert_equal([(m['name'], m['samples']) for m in report['top_samples']],
+                        [('my.counter', 2), ('my.gauge', 1)])
+        # The worker starts a new window after each snapshot
+        nt.assert_equal(worker.telemetry.samples.total, 0)
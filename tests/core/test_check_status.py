@@ -1,12 +1,23 @@
+# stdlib
+import os
+import shutil
+import tempfile
+import unittest
+
 # 3p
+import mock
 from nose.plugins.attrib import attr
 import nose.tools as nt
 
 # project
 from checks import AgentCheck
 from checks.check_status import (
+    AgentStatus,
     CheckStatus,
     CollectorStatus,
+    COUNTERS_TRAILER,
+    DogstatsdStatus,
+    ForwarderStatus,
     InstanceStatus,
     STATUS_ERROR,
     STATUS_WARNING,
@@ -91,3 +102,100 @@ def test_persistence_fail():
 
     status = CollectorStatus.load_latest_status()
     assert not status
+
+
+@mock.patch('checks.check_status.get_config', return_value={})
+@mock.patch('checks.check_status.get_ntp_info', return_value=(0, []))
+def test_checks_load_stats(*args):
+    load_stats = {
+        'configs': 3,
+        'parsed_configs': 1,
+        'checks': 2,
+        'reused_checks': 1,
+        'timings': {
+            'configs': 0.01,
+            'service_discovery': 0,
+            'imports': 0.2,
+            'initialization': 0.3,
+            'total': 0.51,
+        },
+    }
+    lines = CollectorStatus(checks_load_stats=load_stats).body_lines()
+    assert "  3 configs (1 parsed), 2 checks (1 unchanged) loaded in 0.51s" in lines
+    assert "    - Import checks: 0.20s" in lines
+
+    lines = CollectorStatus().body_lines()
+    assert "  No checks have been loaded yet." in lines
+
+
+class TestCountersStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.patcher = mock.patch.object(AgentStatus, '_get_status_dir', return_value=self.tmp_dir)
+        self.patcher.start()
+
+    def tearDown(self):
+        DogstatsdStatus.remove_latest_status()
+        ForwarderStatus.remove_latest_status()
+        self.patcher.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_persistence(self):
+        self.assertIsNone(ForwarderStatus.load_latest_status())
+
+        ForwarderStatus(queue_length=3, queue_size=1024, flush_count=2, transactions_received=5,
+                        transactions_flushed=2, transactions_rejected=1).persist()
+        status = ForwarderStatus.load_latest_status()
+        self.assertEqual(status.queue_length, 3)
+        self.assertEqual(status.queue_size, 1024)
+        self.assertEqual(status.flush_count, 2)
+        self.assertEqual(status.transactions_received, 5)
+        self.assertEqual(status.transactions_flushed, 2)
+        self.assertEqual(status.transactions_rejected, 1)
+        self.assertEqual(status.created_by_pid, os.getpid())
+
+        written = DogstatsdStatus(flush_count=4, packet_count=100, packets_per_second=0.5, flush_duration=0.25)
+        written.persist()
+        status = DogstatsdStatus.load_latest_status()
+        self.assertEqual(status.flush_count, 4)
+        self.assertEqual(status.packet_count, 100)
+        self.assertEqual(status.packets_per_second, 0.5)
+        self.assertEqual(status.flush_duration, 0.25)
+        self.assertEqual(status.metric_count, 0)
+        self.assertEqual(status.created_at, written.created_at)
+        self.assertFalse(os.path.exists(DogstatsdStatus._get_pickle_path()))
+
+    def test_update_in_place(self):
+        ForwarderStatus(flush_count=1).persist()
+        path = ForwarderStatus._get_counters_path()
+        inode = os.stat(path).st_ino
+
+        ForwarderStatus(flush_count=2).persist()
+        self.assertEqual(os.stat(path).st_ino, inode)
+        self.assertEqual(ForwarderStatus.load_latest_status().flush_count, 2)
+
+        ForwarderStatus.remove_latest_status()
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(ForwarderStatus.load_latest_status())
+
+        # A new file is published after a removal
+        ForwarderStatus(flush_count=3).persist()
+        self.assertEqual(ForwarderStatus.load_latest_status().flush_count, 3)
+
+    def test_incomplete_update(self):
+        ForwarderStatus(flush_count=1).persist()
+        path = ForwarderStatus._get_counters_path()
+
+        # An update was started but not completed
+        with open(path, 'r+b') as f:
+            f.seek(-COUNTERS_TRAILER.size, os.SEEK_END)
+            f.write(COUNTERS_TRAILER.pack(42))
+        with mock.patch('checks.check_status.time.sleep'):
+            self.assertIsNone(ForwarderStatus.load_latest_status())
+
+    def test_other_layout(self):
+        ForwarderStatus(flush_count=1).persist()
+        counters = ForwarderStatus.COUNTERS + (('other_count', 'q'),)
+        with mock.patch.object(ForwarderStatus, 'COUNTERS', counters):
+            self.assertIsNone(ForwarderStatus.load_latest_status())
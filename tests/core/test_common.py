@@ -1,9 +1,15 @@
 # stdlib
 import logging
 import os
+import random
+import re
+import threading
 import time
 import unittest
 
+# 3p
+import mock
+
 # project
 from aggregator import MetricsAggregator
 from checks import (
@@ -21,6 +27,36 @@ from utils.proxy import get_proxy
 logger = logging.getLogger()
 
 
+def reference_normalize(check, metric, prefix=None, fix_case=False):
+    """ The regex-based implementation of `AgentCheck.normalize` """
+    if fix_case:
+        name = check.convert_to_underscore_separated(metric)
+        if prefix is not None:
+            prefix = check.convert_to_underscore_separated(prefix)
+    else:
+        name = re.sub(r"[,\@\+\*\-/()\[\]{}\s]", "_", metric)
+    name = re.sub(r"__+", "_", name)
+    name = re.sub(r"^_", "", name)
+    name = re.sub(r"_$", "", name)
+    name = re.sub(r"\._", ".", name)
+    name = re.sub(r"_\.", ".", name)
+    if prefix is not None:
+        return prefix + "." + name
+    return name
+
+
+class BlockingCheck(AgentCheck):
+    """ Submits a gauge once `release` is set """
+
+    def __init__(self, *args, **kwargs):
+        AgentCheck.__init__(self, *args, **kwargs)
+        self.release = threading.Event()
+
+    def check(self, instance):
+        self.release.wait()
+        self.gauge('%s.metric' % self.name, 1)
+
+
 class TestCore(unittest.TestCase):
     "Tests to validate the core check logic"
 
@@ -50,6 +86,15 @@ class TestCore(unittest.TestCase):
         # get_samples()
         self.assertEquals(self.c.get_samples(), {"test-metric": 3.0})
 
+    def test_gauge_value_types(self):
+        # Values are kept as cast, without a round trip through a float
+        for value in [3, 2**60 + 1, 1.5]:
+            self.c.save_sample("test-metric", value)
+            sample = self.c.get_sample("test-metric")
+            self.assertEquals(sample, value)
+            self.assertEquals(type(sample), type(value))
+        self.assertEquals([m[2] for m in self.c.get_metrics()], [1.5])
+
     def testEdgeCases(self):
         self.assertRaises(CheckException, self.c.get_sample, "unknown-metric")
         # same value
@@ -90,6 +135,30 @@ class TestCore(unittest.TestCase):
         # Tagged metrics are not available through get_samples anymore
         self.assertEquals(self.c.get_samples(), {})
 
+    def test_series(self):
+        for i in xrange(3):
+            tags = ["series:%s" % i]
+            self.c.save_sample("test-counter", 10.0 * i, 1.0, tags=tags, device_name="sda")
+            self.c.save_sample("test-counter", 20.0 * i, 3.0, tags=tags, device_name="sda",
+                               hostname="other")
+            self.c.save_sample("test-metric", i, 3.0, tags=tags)
+
+        results = sorted(self.c.get_metrics())
+        self.assertEquals(results[:3], [
+            ("test-counter", 3, 5.0 * i, {"tags": ["series:%s" % i], "device_name": "sda", "host_name": "other"})
+            for i in xrange(3)
+        ])
+        self.assertEquals([r[2] for r in results[3:]], [0, 1, 2])
+        # Expired, the counters need a new sample
+        self.assertEquals([r[0] for r in self.c.get_metrics()], ["test-metric"] * 3)
+
+        # A reset drops the series of the metric, their slots are reused
+        self.c.gauge("test-metric")
+        self.assertEquals(self.c.get_metrics(), [])
+        self.c.save_sample("test-metric", 4.0, 5.0)
+        self.assertEquals(self.c.get_metrics(), [("test-metric", 5, 4.0, {})])
+        self.assertEquals(len(self.c._series_metrics), 6)
+
     def test_samples(self):
         self.assertEquals(self.c.get_samples(), {})
         self.c.save_sample("test-metric", 1.0, 0.0)  # value, ts
@@ -100,6 +169,58 @@ class TestCore(unittest.TestCase):
         assert "test-counter" in self.c.get_samples_with_timestamps(expire=False), self.c.get_samples_with_timestamps(expire=False)
         self.assertEquals(self.c.get_samples_with_timestamps(expire=False)["test-counter"], (2.0, 3.0, None, None))
 
+    def test_instance_copies(self):
+        class MutatingCheck(AgentCheck):
+            def check(self, instance):
+                self.instances_seen.append(instance)
+                if instance.get('mutate'):
+                    instance['tags'].append('mutated')
+                self.gauge('tags', len(instance['tags']))
+
+        instances = [{'tags': ['a']}, {'tags': ['a'], 'mutate': True}]
+        check = MutatingCheck('mutating', {}, {'checksd_hostname': 'foo'}, instances=instances)
+        check.instances_seen = []
+        check.run()
+        check.run()
+
+        # The copy is reused until the check modifies it
+        first_runs, second_runs = check.instances_seen[:2], check.instances_seen[2:]
+        self.assertTrue(first_runs[0] is second_runs[0])
+        self.assertFalse(first_runs[1] is second_runs[1])
+        self.assertEquals(second_runs[1]['tags'], ['a', 'mutated'])
+        self.assertEquals(instances[1]['tags'], ['a'])
+        self.assertEquals([m[2] for m in check.get_metrics()], [2])
+
+    def test_instance_copies_invalidation(self):
+        class Tagged(object):
+            pass
+
+        class SetCheck(AgentCheck):
+            def check(self, instance):
+                self.instances_seen.append(instance)
+                if 'names' in instance:
+                    instance['names'].add('mutated')
+
+        instances = [{'tags': ['a']}, {'names': set(['a'])}, {'object': Tagged()}]
+        check = SetCheck('sets', {}, {'checksd_hostname': 'foo'}, instances=instances)
+        check.instances_seen = []
+        check.run()
+
+        # The original is modified in place
+        instances[0]['tags'].append('b')
+        check.run()
+        first_runs, second_runs = check.instances_seen[:3], check.instances_seen[3:]
+        self.assertEquals(second_runs[0]['tags'], ['a', 'b'])
+        # Changes to the values that aren't guarded don't leak into the next runs
+        self.assertEquals(instances[1]['names'], set(['a']))
+        self.assertFalse(first_runs[1] is second_runs[1])
+        self.assertEquals(second_runs[1]['names'], set(['a', 'mutated']))
+        # Objects only equal to themselves are copied at every run
+        self.assertFalse(first_runs[2]['object'] is second_runs[2]['object'])
+
+        check.run()
+        self.assertTrue(check.instances_seen[6] is second_runs[0])
+
     def test_name(self):
         self.assertEquals(self.c.normalize("metric"), "metric")
         self.assertEquals(self.c.normalize("metric", "prefix"), "prefix.metric")
@@ -121,6 +242,24 @@ class TestCore(unittest.TestCase):
         self.assertEqual(self.ac.normalize("Metric.wordThatShouldBeSeparated", "prefix", fix_case = True), "prefix.metric.word_that_should_be_separated")
         self.assertEqual(self.ac.normalize_device_name(",@+*-()[]{}//device@name"), "___________//device_name")
 
+    def test_normalize_equivalence(self):
+        self.setUpAgentCheck()
+        rand = random.Random(42)
+        alphabet = 'aB._-@ ()[]{}/,+*\t'
+        for _ in xrange(5000):
+            metric = ''.join(rand.choice(alphabet) for _ in xrange(rand.randint(0, 12)))
+            prefix = rand.choice([None, 'prefix', 'Some.Prefix_'])
+            fix_case = rand.choice([False, True])
+            expected = reference_normalize(self.ac, metric, prefix, fix_case)
+            # Twice, the second time from the cache
+            for _ in xrange(2):
+                self.assertEquals(self.ac.normalize(metric, prefix, fix_case), expected,
+                                  (metric, prefix, fix_case))
+            if not fix_case:
+                self.assertEquals(self.c.normalize(metric, prefix), expected, (metric, prefix))
+
+        self.assertEquals(self.ac.normalize(u'caf\xe9.metric'), 'cafe.metric')
+
     def test_service_check(self):
         check_name = 'test.service_check'
         status = AgentCheck.CRITICAL
@@ -302,6 +441,50 @@ class TestCollectionInterval(unittest.TestCase):
         metrics = check.get_metrics()
         self.assertTrue(len(metrics) > 0, metrics)
 
+    def test_collection_interval_does_not_drift(self):
+        agentConfig = {
+            'version': '0.1',
+            'api_key': 'toto'
+        }
+        check = BlockingCheck('drift', {}, agentConfig, instances=[{'min_collection_interval': 30}])
+        check.release.set()
+
+        def run_at(now):
+            with mock.patch('time.time', return_value=now):
+                return len(check.run())
+
+        # Collector runs every 15s, each one a bit late
+        self.assertEquals(run_at(1000.2), 1)
+        self.assertEquals(run_at(1015.3), 0)
+        # Due at 1030, runs at the next collector run
+        self.assertEquals(run_at(1030.1), 1)
+        self.assertEquals(run_at(1045.4), 0)
+        self.assertEquals(run_at(1059.9), 1)
+        # The missed slots are skipped
+        self.assertEquals(run_at(1150.2), 1)
+        self.assertAlmostEqual(check.last_collection_time[0], 1150.2)
+        self.assertEquals(run_at(1165.3), 0)
+
+    def test_collector_schedule_metrics(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'collect_ec2_tags': False,
+            'collect_orchestrator_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        c = Collector(agentConfig, [], {}, get_hostname(agentConfig))
+        payload = c.run({
+            'initialized_checks': [],
+            'init_failed_checks': {}
+        }, scheduled_time=time.time() - 2, overrun_count=1)
+        metrics = dict((m[0], m[2]) for m in payload['metrics'])
+
+        self.assertTrue(metrics['datadog.agent.collector.schedule_lag'] >= 2)
+        self.assertEquals(metrics['datadog.agent.collector.overruns'], 1)
+
     def test_collector(self):
         agentConfig = {
             'api_key': 'test_apikey',
@@ -370,6 +553,61 @@ class TestCollectionInterval(unittest.TestCase):
         # We check that the redis DD_CHECK_TAG is sent in the payload
         self.assertTrue('dd_check:disk' in payload['host-tags']['system'])
 
+    def test_concurrent_checks_timeout(self):
+        agentConfig = {
+            'api_key': 'test_apikey',
+            'check_workers': 2,
+            'check_timeout': 0.5,
+            'collect_ec2_tags': False,
+            'collect_orchestrator_tags': False,
+            'collect_instance_metadata': False,
+            'create_dd_check_tags': False,
+            'version': 'test',
+            'tags': '',
+        }
+        blocking_check = BlockingCheck('blocking', {}, agentConfig, instances=[{}])
+        fast_check = BlockingCheck('fast', {}, agentConfig, instances=[{}])
+        fast_check.release.set()
+        checks = {
+            'initialized_checks': [blocking_check, fast_check],
+            'init_failed_checks': {}
+        }
+
+        c = Collector(agentConfig, [], {}, get_hostname(agentConfig))
+        try:
+            # The fast check is collected while the blocking check times out
+            payload = c.run(checks)
+            metric_names = set(m[0] for m in payload['metrics'])
+            self.assertTrue('fast.metric' in metric_names, metric_names)
+            self.assertFalse('blocking.metric' in metric_names)
+            check_status = dict(
+                (sc['tags'][0], sc['status']) for sc in payload['service_checks']
+                if sc['check'] == 'datadog.agent.check_status'
+            )
+            self.assertEquals(check_status['check:blocking'], AgentCheck.CRITICAL)
+            self.assertEquals(check_status['check:fast'], AgentCheck.OK)
+
+            # Still running: skipped without waiting for the timeout again
+            start = time.time()
+            c.run(checks)
+            self.assertTrue(time.time() - start < 0.5)
+
+            # Once done, what it collected is sent with the next run
+            blocking_check.release.set()
+            c.check_runs[blocking_check].wait(5)
+            payload = c.run(checks)
+            metric_names = set(m[0] for m in payload['metrics'])
+            self.assertTrue('blocking.metric' in metric_names, metric_names)
+
+            # The runs of the checks replaced by a reload are dropped
+            reloaded_check = BlockingCheck('fast', {}, agentConfig, instances=[{}])
+            reloaded_check.release.set()
+            c.run({'initialized_checks': [reloaded_check], 'init_failed_checks': {}})
+            self.assertEquals(c.check_runs.keys(), [reloaded_check])
+        finally:
+            blocking_check.release.set()
+            c.stop()
+
 
 class TestAggregator(unittest.TestCase):
     def setUp(self):
@@ -333,6 +333,74 @@ class TestConfigLoadCheckDirectory(unittest.TestCase):
         self.assertEquals(1, len(checks['initialized_checks']))
         self.assertEquals(2, checks['initialized_checks'][0].instance_count())  # check that we picked the right conf
 
+    def touch(self, path, offset):
+        # Modification times can be counted in seconds
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + offset))
+
+    def testConfigReload(self, *args):
+        copyfile('%s/valid_conf.yaml' % FIXTURE_PATH,
+            '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+        copyfile('%s/valid_check_1.py' % FIXTURE_PATH,
+            '%s/test_check.py' % TEMP_ETC_CHECKS_DIR)
+        agentConfig = {"additional_checksd": TEMP_ETC_CHECKS_DIR}
+        checks = load_check_directory(agentConfig, "foo")
+        self.assertEquals(1, len(checks['initialized_checks']))
+        check = checks['initialized_checks'][0]
+        self.assertEquals(1, checks['load_stats']['parsed_configs'])
+
+        # Nothing has changed, the check is kept
+        with mock.patch('config.check_yaml') as check_yaml, mock.patch('config.imp.load_source') as load_source:
+            checks = load_check_directory(agentConfig, "foo")
+        self.assertFalse(check_yaml.called)
+        self.assertFalse(load_source.called)
+        self.assertTrue(checks['initialized_checks'][0] is check)
+        self.assertEquals(0, checks['load_stats']['parsed_configs'])
+        self.assertEquals(1, checks['load_stats']['reused_checks'])
+
+        # Its config has changed
+        copyfile('%s/valid_conf_2.yaml' % FIXTURE_PATH,
+            '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+        self.touch('%s/test_check.yaml' % TEMP_ETC_CONF_DIR, 1)
+        with mock.patch('config.imp.load_source') as load_source:
+            checks = load_check_directory(agentConfig, "foo")
+        self.assertFalse(load_source.called)
+        self.assertFalse(checks['initialized_checks'][0] is check)
+        self.assertEquals(2, checks['initialized_checks'][0].instance_count())
+        check = checks['initialized_checks'][0]
+
+        # Its code has changed
+        copyfile('%s/valid_check_2.py' % FIXTURE_PATH,
+            '%s/test_check.py' % TEMP_ETC_CHECKS_DIR)
+        self.touch('%s/test_check.py' % TEMP_ETC_CHECKS_DIR, 1)
+        checks = load_check_directory(agentConfig, "foo")
+        self.assertFalse(checks['initialized_checks'][0] is check)
+        self.assertEquals('valid_check_2', checks['initialized_checks'][0].check(None))
+        check = checks['initialized_checks'][0]
+
+        # A custom check takes precedence over the loaded one
+        copyfile('%s/valid_check_1.py' % FIXTURE_PATH,
+            '%s/test_check.py' % TEMP_AGENT_CHECK_DIR)
+        agentConfig['additional_checksd'] = TEMP_AGENT_CHECK_DIR
+        checks = load_check_directory(agentConfig, "foo")
+        self.assertEquals('valid_check_1', checks['initialized_checks'][0].check(None))
+
+    @mock.patch('config.PARALLEL_CONFIG_PARSING_MIN', 2)
+    def testConfigParallelParsing(self, *args):
+        for i in range(4):
+            copyfile('%s/valid_conf_2.yaml' % FIXTURE_PATH,
+                '%s/test_check_%s.yaml' % (TEMP_ETC_CONF_DIR, i))
+            copyfile('%s/valid_check_1.py' % FIXTURE_PATH,
+                '%s/test_check_%s.py' % (TEMP_ETC_CHECKS_DIR, i))
+        copyfile('%s/invalid_conf.yaml' % FIXTURE_PATH,
+            '%s/test_check.yaml' % TEMP_ETC_CONF_DIR)
+        checks = load_check_directory({"additional_checksd": TEMP_ETC_CHECKS_DIR, "check_load_workers": 2}, "foo")
+        self.assertEquals(4, len(checks['initialized_checks']))
+        for check in checks['initialized_checks']:
+            self.assertEquals(2, check.instance_count())
+        self.assertEquals(['test_check'], checks['init_failed_checks'].keys())
+        self.assertEquals(5, checks['load_stats']['parsed_configs'])
+
     def tearDown(self):
         for _dir in self.TEMP_DIRS:
             rmtree(_dir)
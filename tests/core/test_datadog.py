@@ -9,6 +9,7 @@ import time
 import unittest
 
 # 3p
+import mock
 from nose.plugins.attrib import attr
 
 # project
@@ -211,6 +212,47 @@ class TestDogstream(TailTestCase):
         self.assertEquals(expected_output, actual_output)
 
 
+    def test_dogstream_positions(self):
+        positions_file = NamedTemporaryFile()
+        self._write_log(['test_metric.e 1000000000 1 metric_type=gauge'])
+        with mock.patch.object(Dogstreams, '_get_positions_path', return_value=positions_file.name):
+            actual_output = self.dogstream.check(self.config, move_end=False)
+            self.assertEquals([('test_metric.e', 1000000000, 1, self.gauge)], actual_output['dogstream'])
+
+            # Written while the agent is restarting
+            self._write_log(['test_metric.e 1000000005 2 metric_type=gauge'])
+            dogstream = Dogstreams.init(self.logger, self.config)
+            actual_output = dogstream.check(self.config, move_end=True)
+            self.assertEquals([('test_metric.e', 1000000005, 2, self.gauge)], actual_output['dogstream'])
+
+    def test_dogstream_workers(self):
+        log_files = [NamedTemporaryFile() for _ in range(3)]
+        for i, log_file in enumerate(log_files):
+            print >> log_file, 'test.metric.%s 1000000000 %s metric_type=gauge' % (i, i)
+            print >> log_file, 'test.metric.%s 1000000000 %s metric_type=gauge tags=b,a' % (i, i)
+            print >> log_file, 'test.metric.%s 1000000001 1 metric_type=counter tags=a,b' % i
+            log_file.flush()
+        config = {
+            'dogstreams': ','.join(f.name for f in log_files),
+            'dogstream_workers': 2,
+            'check_freq': 5,
+        }
+        dogstream = Dogstreams.init(self.logger, config)
+        try:
+            self.assertEquals(dogstream.workers, 2)
+            actual_output = dogstream.check(config, move_end=False)
+        finally:
+            dogstream.stop()
+
+        expected_output = []
+        for i in range(3):
+            expected_output.extend([
+                ('test.metric.%s' % i, 1000000000, i, self.gauge),
+                # Same tags, in another order
+                ('test.metric.%s' % i, 1000000000, i + 1, {'metric_type': 'counter', 'tags': 'a,b'}),
+            ])
+        self.assertEquals(sorted(expected_output), sorted(actual_output['dogstream']))
+
     def test_dogstream_log_path_globbing(self):
         """Make sure that globbed dogstream logfile matching works."""
         # Create a tmpfile to serve as a prefix for the other temporary
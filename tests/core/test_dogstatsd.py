@@ -1,23 +1,39 @@
 # stdlib
+import BaseHTTPServer
+import logging
 import unittest
 from unittest import TestCase
 import os
 import socket
+import SocketServer
+from StringIO import StringIO
 import threading
+import time
 import Queue
 from collections import defaultdict
+import zlib
 
 # 3p
 import mock
+import requests
+import simplejson as json
 
 # project
+from checks.libs.thread_pool import Pool
 from dogstatsd import mapto_v6, get_socket_address
+from aggregator import api_formatter, MetricsBucketAggregator
 from dogstatsd import (
+    MAX_PENDING_FLUSHES,
+    Reporter,
     Server,
+    ServerPool,
+    TelemetryServer,
     init5,
-    init6
+    init6,
+    serialize_metrics,
+    serialize_metrics_payloads,
 )
-from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
+from utils.net import IPV6_V6ONLY, IPPROTO_IPV6, SO_REUSEPORT
 
 def _get_ipv6_socket(addr, port):
     sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
@@ -95,6 +111,50 @@ class TestFunctions(TestCase):
         self.assertEqual(kwargs['so_rcvbuf'], '1024')
 
 
+    def _load_payload(self, body, headers):
+        if headers.get('Content-Encoding') == 'deflate':
+            body = zlib.decompress(body)
+        return json.loads(body)['series']
+
+    def test_serialize_metrics_payloads(self):
+        metrics = [api_formatter('my.metric.%s' % i, i, 1, ('tag',), 'host') for i in range(200)]
+        expected = json.loads(json.dumps(metrics))
+
+        payloads = list(serialize_metrics_payloads(list(metrics), 'test-host', max_payload_size=5000))
+        self.assertTrue(len(payloads) > 1)
+        series = []
+        for body, headers in payloads:
+            self.assertEqual(headers['Content-Encoding'], 'deflate')
+            self.assertTrue(len(zlib.decompress(body)) <= 5000)
+            series.extend(self._load_payload(body, headers))
+
+        # Every metric is sent once, followed by the serialization status
+        self.assertEqual(series[:-1], expected)
+        self.assertEqual(series[-1]['metric'], 'datadog.dogstatsd.serialization_status')
+        self.assertEqual(series[-1]['tags'], ['status:success'])
+
+        # Same payload as a single json.dumps
+        body, headers = serialize_metrics(list(metrics), 'test-host')
+        self.assertEqual(self._load_payload(body, headers)[:-1], expected)
+
+    def test_serialize_metrics_small_payload(self):
+        body, headers = serialize_metrics([api_formatter('foo', 12, 1, ('tag',), 'host')], 'test-host')
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual([m['metric'] for m in json.loads(body)['series']],
+                         ['foo', 'datadog.dogstatsd.serialization_status'])
+
+    def test_serialize_metrics_bad_characters(self):
+        metrics = [
+            api_formatter('foo', 1, 1, ('tag:\xff',), 'host'),
+            api_formatter('bar', 2, 1, None, 'host'),
+        ]
+        body, headers = serialize_metrics(metrics, 'test-host')
+        series = self._load_payload(body, headers)
+        self.assertEqual(series[0]['tags'], [u'tag:\ufffd'])
+        self.assertEqual(series[1]['metric'], 'bar')
+        self.assertEqual(series[-1]['tags'], ['status:failure'])
+
+
 class TestServer(TestCase):
     def test_init(self):
         s = Server(None, 'localhost', '1234')
@@ -126,6 +186,276 @@ class TestServer(TestCase):
         s2.start()
         self.assertFalse(s2.running)
 
+    def test_read_batch(self):
+        s = Server(mock.MagicMock(), '127.0.0.1', '2346', max_batch_size=3)
+        s.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.socket.setblocking(0)
+        s.socket.bind(('127.0.0.1', 0))
+
+        # nothing pending
+        self.assertEqual(s._read_batch(), [])
+
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        for i in range(5):
+            client_sock.sendto('metric.%s:1|c' % i, s.socket.getsockname())
+        time.sleep(0.1)
+
+        # the batch is capped by max_batch_size, the remainder is kept for the next wakeup
+        self.assertEqual(s._read_batch(), ['metric.0:1|c', 'metric.1:1|c', 'metric.2:1|c'])
+        self.assertEqual(s._read_batch(), ['metric.3:1|c', 'metric.4:1|c'])
+
+    @mock.patch('dogstatsd.select')
+    def test_start_batch_receive(self, select):
+        aggregator = mock.MagicMock()
+        s = Server(aggregator, '127.0.0.1', '2347', batch_receive=True)
+        client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        wakeups = []
+
+        def select_side_effect(rlist, wlist, xlist, timeout):
+            if wakeups:
+                raise KeyboardInterrupt
+            wakeups.append(1)
+            for packet in ['metric.0:1|c', 'malformed', 'metric.2:1|c']:
+                client_sock.sendto(packet, ('127.0.0.1', 2347))
+            time.sleep(0.1)
+            return rlist, [], []
+
+        def submit_packets(packets):
+            if packets == 'malformed':
+                raise Exception('Unparseable metric packet: malformed')
+
+        select.select.side_effect = select_side_effect
+        aggregator.submit_packets.side_effect = submit_packets
+        s.forward_udp_sock = mock.MagicMock()
+        s.should_forward = True
+        s.start()
+
+        # A malformed datagram doesn't discard the rest of its batch
+        self.assertEqual(aggregator.submit_packets.call_args_list,
+                         [mock.call('metric.0:1|c'), mock.call('malformed'), mock.call('metric.2:1|c')])
+        self.assertEqual(s.forward_udp_sock.send.call_count, 3)
+        aggregator.record_batch.assert_called_once_with(3)
+
+    @unittest.skipIf(SO_REUSEPORT is None, "SO_REUSEPORT required for this test")
+    def test_server_pool(self):
+        pool = ServerPool(2, lambda: MetricsBucketAggregator('myhost', interval=10), '127.0.0.1', '2348')
+        pool_thread = threading.Thread(target=pool.start)
+        pool_thread.start()
+        try:
+            time.sleep(1)
+            with pool.workers_lock:
+                self.assertEqual(len(pool.workers), 2)
+                self.assertTrue(all(w.is_alive() for w in pool.workers))
+
+            # Use a new source port for every packet, so that they're spread among the workers
+            for _ in range(50):
+                client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                client_sock.sendto('my.counter:1|c', ('127.0.0.1', 2348))
+                client_sock.close()
+            time.sleep(0.5)
+
+            # Collect every bucket, even the open ones
+            snapshots = pool.collect(time.time() + 3600)
+            self.assertEqual(len(snapshots), 2)
+            self.assertEqual(sum(snapshot['count'] for snapshot in snapshots), 50)
+
+            stats = MetricsBucketAggregator('myhost', interval=10)
+            for snapshot in snapshots:
+                stats.merge_snapshot(snapshot)
+            counters = [metric for mbc in stats.metric_by_bucket.values() for metric in mbc.values()]
+            self.assertEqual(sum(c.value for c in counters), 50)
+        finally:
+            pool.stop()
+            pool_thread.join()
+
+        self.assertFalse(any(w.is_alive() for w in pool.workers))
+
+    @unittest.skipIf(SO_REUSEPORT is None, "SO_REUSEPORT required for this test")
+    def test_server_pool_fork_with_logging_lock_held(self):
+        handler = logging.StreamHandler(StringIO())
+        logger = logging.getLogger('dogstatsd')
+        level = logger.level
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with handler.lock:
+                held.set()
+                release.wait()
+
+        lock_thread = threading.Thread(target=hold_lock)
+        lock_thread.start()
+        held.wait()
+        pool = ServerPool(1, lambda: MetricsBucketAggregator('myhost', interval=10), '127.0.0.1', '2349')
+        pool_thread = threading.Thread(target=pool.start)
+        try:
+            # The worker is forked while another thread holds the lock of the handler
+            pool_thread.start()
+            time.sleep(1)
+            release.set()
+            lock_thread.join()
+
+            client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            client_sock.sendto('my.counter:1|c', ('127.0.0.1', 2349))
+            client_sock.close()
+            time.sleep(0.5)
+
+            snapshots = pool.collect(time.time() + 3600)
+            self.assertEqual(sum(snapshot['count'] for snapshot in snapshots), 1)
+        finally:
+            release.set()
+            pool.stop()
+            pool_thread.join()
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+    @mock.patch('dogstatsd.Server')
+    @mock.patch('dogstatsd.ServerPool')
+    def test_init_with_workers(self, pool, s):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        cfg['statsd_workers'] = '4'
+        cfg['api_key'] = "0123456789abcdefghijklmnopqrstuv"
+
+        reporter, server = init5(cfg)
+
+        self.assertFalse(s.called)
+        pool.assert_called_once()
+        args, _ = pool.call_args
+        self.assertEqual(args[0], 4)
+        self.assertEqual(server, pool.return_value)
+        self.assertEqual(reporter.server_pool, pool.return_value)
+
+    def test_reporter_merges_worker_snapshots(self):
+        worker = MetricsBucketAggregator('myhost', interval=10)
+        worker.submit_packets('my.counter:1|c')
+        stats = MetricsBucketAggregator('myhost', interval=10)
+
+        pool = mock.MagicMock()
+        pool.collect.side_effect = lambda flush_cutoff_time: [worker.snapshot(flush_cutoff_time + 10)]
+        pool.dropped_packet_count.return_value = 3
+        reporter = Reporter(10, stats, 'http://localhost', hostname='myhost', server_pool=pool)
+
+        reporter.merge_worker_snapshots()
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(stats.dropped_packet_count, 3)
+        self.assertEqual(len(stats.metric_by_bucket), 1)
+
+    @mock.patch('dogstatsd.get_hostname', return_value='myhost')
+    @mock.patch('dogstatsd.DogstatsdStatus')
+    def test_reporter_reuses_connections(self, status, _):
+        paths = []
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                paths.append(self.path.split('?')[0])
+                self.send_response(202)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        httpd = HTTPServer(('localhost', 0), Handler)
+        server_thread = threading.Thread(target=httpd.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        stats = MetricsBucketAggregator('myhost', interval=1)
+        reporter = Reporter(10, stats, 'http://localhost:%s' % httpd.server_port, hostname='myhost')
+        reporter.submit_pool = Pool(1)
+        try:
+            for _ in range(2):
+                stats.submit_packets('my.counter:1|c')
+                stats.submit_packets('_e{5,4}:title|text')
+                stats.submit_packets('_sc|check|0')
+                time.sleep(1.1)
+                reporter.flush()
+        finally:
+            reporter.submit_pool.terminate()
+            reporter.session.close()
+            httpd.shutdown()
+
+        self.assertEqual(sorted(paths), sorted(['/api/v1/series', '/intake', '/api/v1/check_run'] * 2))
+        _, kwargs = status.call_args
+        self.assertEqual(kwargs['request_count'], 3)
+        # The connection opened by the first flush is kept alive
+        self.assertEqual(kwargs['reused_connection_count'], 3)
+        self.assertTrue(kwargs['max_request_latency'] > 0)
+
+    def test_reporter_drops_oldest_pending_flush(self):
+        reporter = Reporter(10, MetricsBucketAggregator('myhost'), 'http://localhost', hostname='myhost')
+        for i in range(MAX_PENDING_FLUSHES + 2):
+            reporter.queue_flush(i)
+
+        self.assertEqual(reporter.dropped_flush_count, 2)
+        pending = [reporter.flush_queue.get_nowait() for _ in range(MAX_PENDING_FLUSHES)]
+        self.assertEqual(pending, range(2, MAX_PENDING_FLUSHES + 2))
+
+    @mock.patch('dogstatsd.DogstatsdStatus')
+    def test_reporter_slow_intake(self, status):
+        reporter = Reporter(1, MetricsBucketAggregator('myhost'), 'http://localhost', hostname='myhost')
+        sent = []
+
+        def send_flush(flush):
+            # Slower than the flush interval
+            time.sleep(1.5)
+            sent.append(flush)
+
+        with mock.patch.object(reporter, 'send_flush', side_effect=send_flush):
+            with mock.patch.object(reporter, 'collect_flush', wraps=reporter.collect_flush) as collect_flush:
+                reporter.start()
+                time.sleep(2.5)
+                reporter.stop()
+                reporter.join()
+
+        # The flushes were collected on time, and all sent before stopping
+        self.assertTrue(collect_flush.call_count >= 2)
+        self.assertEqual(len(sent), collect_flush.call_count)
+
+    def test_telemetry_server(self):
+        aggregator = MetricsBucketAggregator('myhost', telemetry_capacity=10)
+        server = TelemetryServer(aggregator, 0)
+        server.start()
+        try:
+            url = 'http://localhost:%s/telemetry' % server.server_address[1]
+            self.assertEqual(requests.get(url).status_code, 503)
+
+            aggregator.submit_packets('my.counter:1|c|#a\nmy.counter:1|c|#b\nmy.gauge:1|g')
+            aggregator.flush()
+            r = requests.get(url, params={'top': 1})
+            self.assertEqual(r.status_code, 200)
+            report = r.json()
+            self.assertEqual([m['name'] for m in report['top_samples']], ['my.counter'])
+            self.assertEqual(report['top_contexts'][0]['contexts'], 2)
+
+            self.assertEqual(requests.get(url, params={'top': 'a'}).status_code, 400)
+            self.assertEqual(requests.get(url.replace('telemetry', 'other')).status_code, 404)
+        finally:
+            server.stop()
+
+    @mock.patch('dogstatsd.Server')
+    def test_init_with_telemetry(self, s):
+        cfg = defaultdict(str)
+        cfg['use_dogstatsd'] = True
+        reporter, _ = init5(cfg)
+        self.assertIsNone(reporter.telemetry_port)
+        self.assertIsNone(reporter.metrics_aggregator.telemetry)
+
+        cfg['statsd_telemetry_port'] = '17126'
+        reporter, _ = init5(cfg)
+        self.assertEqual(reporter.telemetry_port, 17126)
+        self.assertIsNotNone(reporter.metrics_aggregator.telemetry)
+
     def _get_socket(self, addr, port):
         return _get_ipv6_socket(addr, port)
 
@@ -0,0 +1,82 @@
+# stdlib
+import cPickle as pickle
+from datetime import datetime
+import unittest
+
+# 3p
+import mock
+
+# project
+from graphite import (
+    GraphiteBuffer,
+    GraphiteConnection,
+    GraphitePlaintextConnection,
+    GraphiteServer,
+    parse_name_rules,
+    safe_loads,
+)
+
+
+class TestGraphite(unittest.TestCase):
+
+    def setUp(self):
+        self.buffer = GraphiteBuffer()
+        rules = parse_name_rules(r'^servers\.(?P<host>[^.]+)\.disk\.(?P<device>[^.]+)\.(?P<metric>.+)$ '
+                                 r'^servers\.(?P<host>[^.]+)\.')
+        self.server = GraphiteServer(self.buffer, 'myhost', name_rules=rules)
+        self.stream = mock.Mock()
+
+    def test_safe_loads(self):
+        points = [('a.b', (1000000000, 1.5)), (u'c', [1000000000.5, 2])]
+        self.assertEquals(safe_loads(pickle.dumps(points, pickle.HIGHEST_PROTOCOL)), points)
+        self.assertEquals(safe_loads(pickle.dumps(points, 0)), points)
+
+        # Nothing that needs a class is unpickled
+        self.assertRaises(pickle.UnpicklingError, safe_loads, pickle.dumps([datetime.now()]))
+        self.assertRaises(pickle.UnpicklingError, safe_loads, "cos\nsystem\n(S'echo hello'\ntR.")
+
+    def test_parse_metric(self):
+        self.assertEquals(self.server.parse_metric('servers.web1.disk.sda.free'), ('free', 'web1', 'sda'))
+        self.assertEquals(self.server.parse_metric('servers.web1.cpu.idle'),
+                          ('servers.web1.cpu.idle', 'web1', 'N/A'))
+        self.assertEquals(self.server.parse_metric('cpu.idle'), ('cpu.idle', 'myhost', 'N/A'))
+        # From the cache
+        self.assertEquals(self.server.parse_metric('cpu.idle'), ('cpu.idle', 'myhost', 'N/A'))
+
+    def test_pickle_frame(self):
+        connection = GraphiteConnection(self.stream, ('127.0.0.1', 1234), self.server)
+        connection._decode(pickle.dumps([
+            ('cpu.idle', (1000000000, 1)),
+            ('cpu.idle', (1000000000, 2)),
+            ('cpu.idle', (1000000010, 3)),
+            ('invalid', ('a', 'b')),
+            ('invalid',),
+            ('servers.web1.disk.sda.free', ('1000000000', '4')),
+        ], pickle.HIGHEST_PROTOCOL))
+
+        metrics = self.buffer.flush()
+        self.assertEquals(sorted(metrics['cpu.idle']), [
+            # The last value of a point wins
+            ['myhost', 'N/A', 1000000000, 2],
+            ['myhost', 'N/A', 1000000010, 3],
+        ])
+        self.assertEquals(metrics['free'], [['web1', 'sda', 1000000000, 4]])
+        self.assertEquals(len(metrics), 2)
+        self.assertEquals(self.buffer.flush(), {})
+
+        # Waiting for the next frame
+        self.assertEquals(self.stream.read_bytes.call_count, 2)
+
+    def test_plaintext_lines(self):
+        connection = GraphitePlaintextConnection(self.stream, ('127.0.0.1', 1234), self.server)
+        connection._on_read_chunk('cpu.idle 1 1000000000\ncpu.us')
+        self.assertEquals(len(self.buffer), 1)
+        connection._on_read_chunk('er 2 1000000000\r\n\ninvalid line\nmem.free 3')
+        connection._on_close(' 1000000000')
+
+        metrics = self.buffer.flush()
+        self.assertEquals(metrics, {
+            'cpu.idle': [['myhost', 'N/A', 1000000000, 1]],
+            'cpu.user': [['myhost', 'N/A', 1000000000, 2]],
+            'mem.free': [['myhost', 'N/A', 1000000000, 3]],
+        })
@@ -1,9 +1,11 @@
 # stdlib
+import random
 import unittest
 
 # project
-from aggregator import Histogram, MetricsAggregator
-from config import get_histogram_aggregates, get_histogram_percentiles
+from aggregator import Histogram, MetricsAggregator, SketchHistogram
+from config import get_histogram_aggregates, get_histogram_backend, get_histogram_percentiles
+from utils.sketch import QuantileSketch
 
 class TestHistogram(unittest.TestCase):
     def test_default(self):
@@ -152,3 +154,93 @@ class TestHistogram(unittest.TestCase):
         self.assertEquals(value_by_type['max'], 19, value_by_type)
         self.assertEquals(value_by_type['sum'], 190, value_by_type)
         self.assertEquals(value_by_type['95percentile'], 18, value_by_type)
+
+    def test_backend_config(self):
+        self.assertEquals(get_histogram_backend('sketch'), 'sketch')
+        self.assertEquals(get_histogram_backend(' Exact'), 'exact')
+        self.assertIsNone(get_histogram_backend('tdigest'))
+        self.assertIsNone(get_histogram_backend(None))
+
+        stats = MetricsAggregator('myhost')
+        self.assertEquals(stats.metric_type_to_class['h'], Histogram)
+
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_percentiles=get_histogram_percentiles('0.5, 0.99'),
+            histogram_backend='sketch'
+        )
+        self.assertEquals(stats.metric_type_to_class['h'], SketchHistogram)
+        self.assertEquals(stats.metric_type_to_class['ms'], SketchHistogram)
+        self.assertEquals(stats.metric_config[SketchHistogram]['percentiles'], [0.5, 0.99])
+
+    def test_sketch_backend(self):
+        configstr = '0.4, 0.65, 0.999'
+        stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, sum, count'),
+            histogram_percentiles=get_histogram_percentiles(configstr),
+            histogram_backend='sketch'
+        )
+        exact_stats = MetricsAggregator(
+            'myhost',
+            histogram_aggregates=get_histogram_aggregates('min, max, median, avg, sum, count'),
+            histogram_percentiles=get_histogram_percentiles(configstr)
+        )
+
+        random.seed(42)
+        for i in xrange(10000):
+            packet = 'myhistogram:{0}|h'.format(random.lognormvariate(3, 2))
+            stats.submit_packets(packet)
+            exact_stats.submit_packets(packet)
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        exact_metrics = dict((m['metric'], m['points'][0][1]) for m in exact_stats.flush())
+
+        self.assertEquals(sorted(metrics.keys()), sorted(exact_metrics.keys()))
+        for name in ['min', 'max', 'count']:
+            self.assertEquals(metrics['myhistogram.' + name], exact_metrics['myhistogram.' + name])
+        for name in ['avg', 'sum']:
+            self.assertAlmostEqual(metrics['myhistogram.' + name], exact_metrics['myhistogram.' + name])
+        for name in ['median', '40percentile', '65percentile', '99percentile']:
+            value = metrics['myhistogram.' + name]
+            exact_value = exact_metrics['myhistogram.' + name]
+            self.assertTrue(abs(value - exact_value) <= 0.01 * exact_value, (name, value, exact_value))
+
+    def test_sketch_backend_small_samples(self):
+        stats = MetricsAggregator('myhost', histogram_backend='sketch')
+        for value in [-5, 0, 3]:
+            stats.submit_packets('myhistogram:{0}|h'.format(value))
+        stats.submit_packets('single:7|h')
+
+        metrics = dict((m['metric'], m['points'][0][1]) for m in stats.flush())
+        self.assertEquals(metrics['myhistogram.max'], 3)
+        self.assertEquals(metrics['myhistogram.median'], -5)
+        self.assertEquals(metrics['myhistogram.95percentile'], 3)
+        self.assertEquals(metrics['single.median'], 7)
+        self.assertEquals(metrics['single.95percentile'], 7)
+
+        # The state is reset at flush
+        self.assertEquals(stats.flush(), [])
+
+    def test_sketch_memory_is_bounded(self):
+        sketch = QuantileSketch(max_bins=100)
+        for i in xrange(1, 100000):
+            sketch.add(i * i)
+        self.assertEquals(sketch.count, 99999)
+        self.assertTrue(len(sketch.positive_bins) <= 100)
+
+        # The highest values are still within the relative accuracy
+        value = sketch.value_at_rank(99998)
+        self.assertTrue(abs(value - 99999 ** 2) <= 0.01 * 99999 ** 2)
+
+    def test_sketch_merge(self):
+        first, second = QuantileSketch(), QuantileSketch()
+        for i in xrange(1, 501):
+            first.add(i)
+            second.add(-i)
+        first.merge(second)
+
+        self.assertEquals(first.count, 1000)
+        self.assertTrue(abs(first.value_at_rank(0) + 500) <= 5)
+        self.assertTrue(abs(first.value_at_rank(999) - 500) <= 5)
+        self.assertTrue(abs(first.value_at_rank(749) - 250) <= 2.5)
@@ -0,0 +1,162 @@
+# stdlib
+import logging
+import os
+import signal
+from StringIO import StringIO
+import threading
+import time
+from unittest import TestCase
+
+# 3p
+from nose.plugins.skip import SkipTest
+
+# project
+from checks import AgentCheck
+from checks.check_status import STATUS_ERROR, STATUS_OK
+from checks.process_check import ProcessIsolatedCheck
+from config import _initialize_check
+from utils.platform import Platform
+
+
+class PidCheck(AgentCheck):
+    """ Submits the pid of the process it runs in """
+
+    def check(self, instance):
+        if instance.get('fail'):
+            raise Exception("failed")
+        if instance.get('hang'):
+            time.sleep(60)
+        if instance.get('log'):
+            self.log.warning("running")
+        self.gauge('worker.pid', os.getpid(), tags=instance.get('tags'))
+        self.event({'msg_title': 'ran'})
+        self.service_check('worker.up', AgentCheck.OK)
+
+
+class TestProcessIsolatedCheck(TestCase):
+
+    def setUp(self):
+        if Platform.is_windows():
+            raise SkipTest("Process isolation is not supported on Windows")
+        self.agentConfig = {'api_key': 'toto', 'checksd_hostname': 'foo'}
+        self.checks = []
+
+    def tearDown(self):
+        for check in self.checks:
+            check.stop()
+
+    def _isolated_check(self, instances, memory_limit=None, timeout=None):
+        check = PidCheck('pid', {}, self.agentConfig, instances=instances)
+        check = ProcessIsolatedCheck(check, memory_limit=memory_limit, timeout=timeout)
+        self.checks.append(check)
+        return check
+
+    def _worker_pids(self, check):
+        return set(m[2] for m in check.get_metrics() if m[0] == 'worker.pid')
+
+    def test_run(self):
+        check = self._isolated_check([{'tags': ['instance:1']}, {'fail': True}])
+
+        instance_statuses = check.run()
+        self.assertEquals([s.status for s in instance_statuses], [STATUS_OK, STATUS_ERROR])
+
+        metrics = check.get_metrics()
+        self.assertEquals(len(metrics), 1)
+        self.assertEquals(metrics[0][0], 'worker.pid')
+        self.assertEquals(list(metrics[0][3]['tags']), ['instance:1'])
+        self.assertNotEquals(metrics[0][2], os.getpid())
+        self.assertEquals(len(check.get_events()), 1)
+        self.assertEquals(len(check.get_service_metadata()), 2)
+
+        # Service checks submitted in the collector are added to the worker's
+        check.service_check('datadog.agent.check_status', AgentCheck.OK)
+        service_checks = [sc['check'] for sc in check.get_service_checks()]
+        self.assertEquals(service_checks, ['worker.up', 'datadog.agent.check_status'])
+
+        # Everything is flushed
+        self.assertEquals(check.get_metrics(), [])
+        self.assertEquals(check.get_events(), [])
+        self.assertEquals(check.get_service_checks(), [])
+
+        # Delegated to the check
+        self.assertEquals(check.name, 'pid')
+
+    def test_worker_restart(self):
+        check = self._isolated_check([{}])
+        check.run()
+        pids = self._worker_pids(check)
+        check.run()
+        self.assertEquals(self._worker_pids(check), pids)
+
+        # A dead worker fails the run, and is restarted by the next one
+        os.kill(check.worker.pid, signal.SIGKILL)
+        check.worker.join()
+        instance_statuses = check.run()
+        self.assertEquals([s.status for s in instance_statuses], [STATUS_ERROR])
+        check.run()
+        new_pids = self._worker_pids(check)
+        self.assertEquals(len(new_pids), 1)
+        self.assertNotEquals(new_pids, pids)
+        self.assertEquals(check.worker_restarts, 1)
+
+    def test_memory_limit(self):
+        # Any worker is above the limit, and is restarted after each run
+        check = self._isolated_check([{}], memory_limit=1)
+        check.run()
+        check.run()
+        self.assertEquals(len(self._worker_pids(check)), 2)
+        self.assertEquals(check.worker_restarts, 1)
+
+    def test_timeout(self):
+        check = self._isolated_check([{'hang': True}], timeout=0.5)
+        worker = check.worker
+
+        start = time.time()
+        instance_statuses = check.run()
+        self.assertTrue(time.time() - start < 5)
+        self.assertEquals([s.status for s in instance_statuses], [STATUS_ERROR])
+        self.assertTrue('0.5s' in instance_statuses[0].error)
+        # The hung worker is killed, and restarted by the next run
+        self.assertFalse(worker.is_alive())
+        self.assertIsNone(check.worker)
+        check.check.instances = [{}]
+        self.assertEquals([s.status for s in check.run()], [STATUS_OK])
+        self.assertEquals(check.worker_restarts, 1)
+
+    def test_fork_with_logging_lock_held(self):
+        handler = logging.StreamHandler(StringIO())
+        logger = logging.getLogger('checks.pid')
+        logger.addHandler(handler)
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with handler.lock:
+                held.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        held.wait()
+        try:
+            # Forked while another thread holds the lock of the handler
+            check = self._isolated_check([{'log': True}], timeout=5)
+        finally:
+            release.set()
+            thread.join()
+        try:
+            self.assertEquals([s.status for s in check.run()], [STATUS_OK])
+        finally:
+            logger.removeHandler(handler)
+
+    def test_initialize_check(self):
+        check_config = {'init_config': {'process_isolation': True}, 'instances': [{}]}
+        checks, _ = _initialize_check(check_config, 'pid', PidCheck, self.agentConfig, None)
+        check = checks['pid']
+        self.checks.append(check)
+        self.assertTrue(isinstance(check, ProcessIsolatedCheck))
+        self.assertEquals(check.timeout, 60)
+
+        check_config['init_config'] = {}
+        checks, _ = _initialize_check(check_config, 'pid', PidCheck, self.agentConfig, None)
+        self.assertTrue(isinstance(checks['pid'], PidCheck))
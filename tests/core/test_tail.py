@@ -1,4 +1,6 @@
 import logging
+import os
+import shutil
 import subprocess
 import tempfile
 import unittest
@@ -6,6 +8,9 @@ import unittest
 # 3p
 from nose.plugins.attrib import attr
 
+# project
+from utils.tailfile import TailFile
+
 
 # Don't run these tests on Windows because the temp file scheme used in them
 # is hard to support on Windows
@@ -70,3 +75,88 @@ class TestTail(unittest.TestCase):
             self.assertEquals(self.last_line, new_string[:-1], self.last_line)
         except OSError:
             "logrotate is not present"
+
+
+@attr('unix')
+class TestTailFile(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.log')
+        self.lines = []
+        self._write('')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write(self, data, mode='a'):
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def _tail(self, **kwargs):
+        tail = TailFile(logging.getLogger(), self.path, self.lines.append)
+        return tail, tail.tail(line_by_line=False, **kwargs)
+
+    def test_bulk_lines(self):
+        tail, gen = self._tail(move_end=False)
+        tail.CHUNK_SIZE = 7
+        self._write("first line\n\x00\x00second\r\n\nthird line, not complete")
+        gen.next()
+        self.assertEquals(self.lines, ["first line", "second", ""])
+        self.assertEquals(tail.position()[1], len("first line\n\x00\x00second\r\n\n"))
+
+        self._write(" yet\nfourth\n")
+        gen.next()
+        self.assertEquals(self.lines[3:], ["third line, not complete yet", "fourth"])
+
+    def test_rotation(self):
+        tail, gen = self._tail(move_end=True)
+        gen.next()
+        self._write("before rotation\n")
+        os.rename(self.path, self.path + '.1')
+        self._write("after rotation\n", mode='w')
+        gen.next()
+        self.assertEquals(self.lines, ["before rotation", "after rotation"])
+
+        # Truncated
+        self._write("new\n", mode='w')
+        gen.next()
+        self.assertEquals(self.lines[2:], ["new"])
+
+        # Truncated then written past the previous offset
+        self._write("a much longer line than before\n", mode='w')
+        gen.next()
+        self.assertEquals(self.lines[3:], ["a much longer line than before"])
+
+    def test_resume(self):
+        self._write("parsed\n")
+        tail, gen = self._tail(move_end=False)
+        gen.next()
+        position = tail.position()
+        gen.close()
+        self.assertTrue(tail._fd is None)
+
+        # Written while the agent was stopped
+        self._write("not parsed yet\n")
+        tail, gen = self._tail(move_end=True, position=position)
+        gen.next()
+        self.assertEquals(self.lines, ["parsed", "not parsed yet"])
+
+        # The file has been replaced since then
+        self._write("replaced\n", mode='w')
+        tail, gen = self._tail(move_end=True, position=position)
+        gen.next()
+        self.assertEquals(self.lines[2:], ["replaced"])
+
+    def test_max_lines(self):
+        self._write("".join("line %s\n" % i for i in range(5)))
+        tail, gen = self._tail(move_end=False, max_lines=2)
+        gen.next()
+        self.assertEquals(self.lines, ["line 0", "line 1"])
+        gen.next()
+        self.assertEquals(self.lines[2:], ["line 2", "line 3"])
+
+        # The rest of a rotated file is read first
+        os.rename(self.path, self.path + '.1')
+        self._write("after rotation\n", mode='w')
+        gen.next()
+        self.assertEquals(self.lines[4:], ["line 4", "after rotation"])
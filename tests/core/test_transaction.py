@@ -1,6 +1,7 @@
 # stdlib
 from datetime import datetime, timedelta
 import threading
+from operator import attrgetter
 import time
 import unittest
 
@@ -22,6 +23,11 @@ from ddagent import (
 from transaction import Transaction, TransactionManager
 
 
+def sorted_transactions(trManager):
+    """ The queued transactions, oldest first """
+    return sorted(trManager.get_transactions(), key=attrgetter('_id'))
+
+
 class memTransaction(Transaction):
     def __init__(self, size, manager):
         Transaction.__init__(self)
@@ -90,22 +96,22 @@ class TestTransaction(unittest.TestCase):
 
         # There should be exactly step transaction in the list, with
         # a flush count of 1
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertEqual(tr._flush_count, 1)
 
         # Try to add one more
         trManager.append(memTransaction(oneTrSize + 10, trManager))
 
         # At this point, transaction one (the oldest) should have been removed from the list
-        self.assertEqual(len(trManager._transactions), step)
-        for tr in trManager._transactions:
+        self.assertEqual(len(trManager.get_transactions()), step)
+        for tr in trManager.get_transactions():
             self.assertNotEqual(tr._id, 1)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         # Check and allow transactions to be flushed
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
             # Last transaction has been flushed only once
             if tr._id == step + 1:
@@ -114,7 +120,7 @@ class TestTransaction(unittest.TestCase):
                 self.assertEqual(tr._flush_count, 2)
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 0)
 
     def testThrottling(self):
         """Test throttling while flushing"""
@@ -247,6 +253,41 @@ class TestTransaction(unittest.TestCase):
                               headers={'Content-Type': "application/json"})
             r.raise_for_status()
 
+    def test_queue_order(self):
+        """Transactions are flushed when they're due, evicted latest next flush first"""
+        trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
+                                       timedelta(seconds=0), max_endpoint_errors=100)
+        step = 10
+        oneTrSize = (MAX_QUEUE_SIZE / step) - 1
+        trs = [memTransaction(oneTrSize, trManager) for i in xrange(step)]
+        for tr in trs:
+            trManager.append(tr)
+
+        # Not due yet
+        now = datetime.utcnow()
+        trs[2]._next_flush = trs[5]._next_flush = now + timedelta(seconds=60)
+        trs[7]._next_flush = now + timedelta(seconds=30)
+        for tr in (trs[2], trs[5], trs[7]):
+            trManager._schedule(tr)
+        for tr in trs:
+            tr.is_flushable = tr not in (trs[0], trs[1])
+
+        trManager.flush()
+        self.assertEqual([tr._flush_count for tr in trs], [1, 1, 0, 1, 1, 0, 1, 0, 1, 1])
+        self.assertEqual(sorted_transactions(trManager), [trs[0], trs[1], trs[2], trs[5], trs[7]])
+
+        # The ones to be flushed last are evicted first
+        trManager.append(memTransaction(oneTrSize * 7, trManager))
+        self.assertEqual([tr._id for tr in sorted_transactions(trManager)], [1, 2, 8, 11])
+        trManager.append(memTransaction(oneTrSize, trManager))
+        self.assertEqual([tr._id for tr in sorted_transactions(trManager)], [1, 2, 11, 12])
+
+        # Rescheduling doesn't grow the queues indefinitely
+        for i in xrange(1000):
+            trManager.flush()
+        self.assertEqual(trs[0]._flush_count, 1001)
+        self.assertTrue(len(trManager._evict_queue) < 200)
+
     def test_endpoint_error(self):
         trManager = TransactionManager(timedelta(seconds=0), MAX_QUEUE_SIZE,
                                        timedelta(seconds=0), max_endpoint_errors=2)
@@ -260,28 +301,28 @@ class TestTransaction(unittest.TestCase):
 
         # There should be exactly step transaction in the list,
         # and only 2 of them with a flush count of 1
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         flush_count = 0
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             flush_count += tr._flush_count
         self.assertEqual(flush_count, 2)
 
         # If we retry to flush, two OTHER transactions should be tried
         trManager.flush()
 
-        self.assertEqual(len(trManager._transactions), step)
+        self.assertEqual(len(trManager.get_transactions()), step)
         flush_count = 0
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             flush_count += tr._flush_count
             self.assertIn(tr._flush_count, [0, 1])
         self.assertEqual(flush_count, 4)
 
         # Finally when it's possible to flush, everything should go smoothly
-        for tr in trManager._transactions:
+        for tr in trManager.get_transactions():
             tr.is_flushable = True
 
         trManager.flush()
-        self.assertEqual(len(trManager._transactions), 0)
+        self.assertEqual(len(trManager.get_transactions()), 0)
 
     @attr('unix')
     def test_parallelism(self):
@@ -346,6 +387,7 @@ class TestTransaction(unittest.TestCase):
 
         MetricTransaction({}, {})
         # 2 endpoints = 2 transactions
-        self.assertEqual(len(trManager._transactions), 2)
-        self.assertEqual(trManager._transactions[0]._endpoint, 'https://app.datadoghq.com')
-        self.assertEqual(trManager._transactions[1]._endpoint, 'https://app.example.com')
+        transactions = sorted_transactions(trManager)
+        self.assertEqual(len(transactions), 2)
+        self.assertEqual(transactions[0]._endpoint, 'https://app.datadoghq.com')
+        self.assertEqual(transactions[1]._endpoint, 'https://app.example.com')
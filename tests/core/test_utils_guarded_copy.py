@@ -0,0 +1,73 @@
+# stdlib
+import copy
+import cPickle as pickle
+from unittest import TestCase
+
+# project
+from utils.guarded_copy import MutationGuard, guarded_copy
+
+
+class TestGuardedCopy(TestCase):
+
+    def setUp(self):
+        self.original = {
+            'host': 'localhost',
+            'tags': ['a', 'b'],
+            'queries': [{'query': 'SELECT 1', 'columns': ['x']}],
+            'pair': ('x', ['y']),
+        }
+
+    def test_copy(self):
+        guard = MutationGuard()
+        instance = guarded_copy(self.original, guard)
+        self.assertEqual(instance, self.original)
+        self.assertTrue(isinstance(instance, dict))
+        self.assertTrue(isinstance(instance['tags'], list))
+        self.assertFalse(instance['tags'] is self.original['tags'])
+        self.assertFalse(instance['queries'][0] is self.original['queries'][0])
+        self.assertFalse(instance['pair'][1] is self.original['pair'][1])
+
+        # Reading doesn't count as modifying
+        instance.get('tags', []) + ['c']
+        sorted(instance['tags'])
+        [q['query'] for q in instance['queries']]
+        self.assertFalse(guard.mutated)
+
+    def test_mutations(self):
+        mutations = [
+            lambda i: i.__setitem__('host', 'remote'),
+            lambda i: i.pop('host'),
+            lambda i: i.setdefault('port', 80),
+            lambda i: i.update(port=80),
+            lambda i: i['tags'].append('c'),
+            lambda i: i['tags'].extend(['c']),
+            lambda i: i['tags'].sort(reverse=True),
+            lambda i: i['queries'][0]['columns'].insert(0, 'y'),
+            lambda i: i['queries'][0].__delitem__('query'),
+            lambda i: i['pair'][1].remove('y'),
+        ]
+        for mutate in mutations:
+            guard = MutationGuard()
+            instance = guarded_copy(self.original, guard)
+            mutate(instance)
+            self.assertTrue(guard.mutated)
+
+        guard = MutationGuard()
+        instance = guarded_copy(self.original, guard)
+        tags = instance['tags']
+        tags += ['c']
+        self.assertTrue(guard.mutated)
+
+        # The original is left untouched
+        self.assertEqual(self.original['tags'], ['a', 'b'])
+        self.assertEqual(self.original['queries'][0]['columns'], ['x'])
+
+    def test_copies_are_plain(self):
+        guard = MutationGuard()
+        instance = guarded_copy(self.original, guard)
+        for instance_copy in (copy.deepcopy(instance),
+                              pickle.loads(pickle.dumps(instance, pickle.HIGHEST_PROTOCOL))):
+            self.assertEqual(type(instance_copy), dict)
+            self.assertEqual(type(instance_copy['tags']), list)
+            instance_copy['tags'].append('c')
+        self.assertFalse(guard.mutated)
@@ -0,0 +1,48 @@
+# stdlib
+from unittest import TestCase
+
+# project
+from utils.lru_cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(3)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('a', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 3)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.flush_stats(), (2, 2, 0))
+
+        # Stats are reset at each flush
+        self.assertEqual(cache.flush_stats(), (0, 0, 0))
+
+    def test_eviction(self):
+        cache = LRUCache(3)
+        for key in ['a', 'b', 'c']:
+            cache.set(key, key)
+
+        # 'a' becomes the most recently used, 'b' is evicted first
+        cache.get('a')
+        cache.set('d', 'd')
+        cache.set('e', 'e')
+
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), None)
+        for key in ['a', 'd', 'e']:
+            self.assertEqual(cache.get(key), key)
+        self.assertEqual(cache.flush_stats(), (4, 2, 2))
+
+    def test_disabled(self):
+        cache = LRUCache(0)
+        cache.set('a', 1)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.flush_stats(), (0, 1, 0))
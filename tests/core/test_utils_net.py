@@ -11,7 +11,8 @@ from nose.plugins.skip import SkipTest
 # project
 from utils.net import inet_pton, _inet_pton_win
 from utils.net import IPV6_V6ONLY, IPPROTO_IPV6
-from utils.net import DNSCache
+from utils.net import DNSCache, get_udp_socket_drops
+from utils.platform import Platform
 from config import get_url_endpoint
 
 DEFAULT_ENDPOINT = "https://app.datadoghq.com"
@@ -38,6 +39,17 @@ class TestUtilsNet(TestCase):
         if not hasattr(socket, 'IPV6_V6ONLY'):
             self.assertEqual(IPV6_V6ONLY, 27)
 
+    def test_get_udp_socket_drops(self):
+        if not Platform.is_linux():
+            raise SkipTest('/proc/net/udp is only available on Linux')
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        self.assertEqual(get_udp_socket_drops(sock), 0)
+        sock.close()
+
+        self.assertIsNone(get_udp_socket_drops(sock))
+
     def test_dns_cache(self):
         side_effects = [(None, None, ['1.1.1.1', '2.2.2.2']),
                         (None, None, ['3.3.3.3'])]
@@ -0,0 +1,126 @@
+# stdlib
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+# 3p
+import mock
+
+# project
+from utils.py3_validation import (
+    Py3Validation,
+    PY3_COMPATIBILITY_ATTR,
+    PY3_COMPATIBILITY_NOT_READY,
+    PY3_COMPATIBILITY_READY,
+    PY3_COMPATIBILITY_UNKNOWN,
+    validate_py3,
+)
+from utils.subprocess_output import SubprocessOutputEmptyError
+
+
+class FakeCheck(object):
+    pass
+
+
+class TestPy3Validation(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp_dir, 'py3_validation.json')
+        self.check_path = os.path.join(self.tmp_dir, 'my_check.py')
+        self.write_check("print 'hello'\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_check(self, content):
+        with open(self.check_path, 'w') as f:
+            f.write(content)
+
+    def test_validate_py3(self):
+        with mock.patch('utils.py3_validation.get_subprocess_output', return_value=('[{"symbol": "print-statement"}]', '', 0)):
+            self.assertEqual(validate_py3(self.check_path), PY3_COMPATIBILITY_NOT_READY)
+        with mock.patch('utils.py3_validation.get_subprocess_output', return_value=('[]', '', 0)):
+            self.assertEqual(validate_py3(self.check_path), PY3_COMPATIBILITY_READY)
+        with mock.patch('utils.py3_validation.get_subprocess_output', side_effect=SubprocessOutputEmptyError()):
+            self.assertEqual(validate_py3(self.check_path), PY3_COMPATIBILITY_READY)
+        with mock.patch('utils.py3_validation.get_subprocess_output', side_effect=OSError()):
+            self.assertEqual(validate_py3(self.check_path), PY3_COMPATIBILITY_UNKNOWN)
+
+    def test_background_validation(self):
+        validated = threading.Event()
+
+        def slow_validation(file_path):
+            validated.wait()
+            return PY3_COMPATIBILITY_NOT_READY
+
+        validation = Py3Validation(self.cache_path)
+        checks = [FakeCheck(), FakeCheck()]
+        with mock.patch('utils.py3_validation.validate_py3', side_effect=slow_validation) as validate_py3:
+            # The checks are loaded without waiting for the validation
+            for check in checks:
+                validation.validate(check, self.check_path)
+                self.assertFalse(hasattr(check, PY3_COMPATIBILITY_ATTR))
+
+            validated.set()
+            validation.join()
+
+        # The file is validated once for both checks
+        self.assertEqual(validate_py3.call_count, 1)
+        for check in checks:
+            self.assertEqual(getattr(check, PY3_COMPATIBILITY_ATTR), PY3_COMPATIBILITY_NOT_READY)
+
+    def test_cache(self):
+        validation = Py3Validation(self.cache_path)
+        with mock.patch('utils.py3_validation.validate_py3', return_value=PY3_COMPATIBILITY_NOT_READY):
+            validation.validate(FakeCheck(), self.check_path)
+            validation.join()
+
+        # The result is known right away after a restart
+        validation = Py3Validation(self.cache_path)
+        check = FakeCheck()
+        with mock.patch('utils.py3_validation.validate_py3') as validate_py3:
+            validation.validate(check, self.check_path)
+        self.assertFalse(validate_py3.called)
+        self.assertEqual(getattr(check, PY3_COMPATIBILITY_ATTR), PY3_COMPATIBILITY_NOT_READY)
+
+        # A modified file is validated again
+        self.write_check("print('hello')\n")
+        check = FakeCheck()
+        with mock.patch('utils.py3_validation.validate_py3', return_value=PY3_COMPATIBILITY_READY) as validate_py3:
+            validation.validate(check, self.check_path)
+            validation.join()
+        self.assertEqual(validate_py3.call_count, 1)
+        self.assertEqual(getattr(check, PY3_COMPATIBILITY_ATTR), PY3_COMPATIBILITY_READY)
+
+    def test_unknown_not_cached(self):
+        validation = Py3Validation(self.cache_path)
+        with mock.patch('utils.py3_validation.validate_py3', return_value=PY3_COMPATIBILITY_UNKNOWN) as validate_py3:
+            for _ in range(2):
+                check = FakeCheck()
+                validation.validate(check, self.check_path)
+                validation.join()
+                self.assertEqual(getattr(check, PY3_COMPATIBILITY_ATTR), PY3_COMPATIBILITY_UNKNOWN)
+        self.assertEqual(validate_py3.call_count, 2)
+        self.assertFalse(os.path.exists(self.cache_path))
+
+    def test_validation_error(self):
+        validation = Py3Validation(self.cache_path, workers=1)
+        checks = [FakeCheck(), FakeCheck()]
+        with mock.patch('utils.py3_validation.validate_py3', side_effect=[Exception("boom"), PY3_COMPATIBILITY_READY]):
+            validation.validate(checks[0], self.check_path)
+            validation.join()
+            self.assertEqual(getattr(checks[0], PY3_COMPATIBILITY_ATTR), PY3_COMPATIBILITY_UNKNOWN)
+
+            # The worker is still around to validate the file again
+            validation.validate(checks[1], self.check_path)
+            validation.join()
+            self.assertEqual(getattr(checks[1], PY3_COMPATIBILITY_ATTR), PY3_COMPATIBILITY_READY)
+        self.assertEqual(validation._pending, {})
+
+    def test_missing_file(self):
+        check = FakeCheck()
+        Py3Validation(self.cache_path).validate(check, os.path.join(self.tmp_dir, 'missing.py'))
+        self.assertEqual(getattr(check, PY3_COMPATIBILITY_ATTR), PY3_COMPATIBILITY_UNKNOWN)
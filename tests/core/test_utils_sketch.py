@@ -0,0 +1,59 @@
+# stdlib
+import random
+from unittest import TestCase
+
+# project
+from utils.sketch import HeavyHitters
+
+
+class TestHeavyHitters(TestCase):
+
+    def test_exact_under_capacity(self):
+        hitters = HeavyHitters(capacity=10)
+        for key, count in [('a', 5), ('b', 3), ('c', 1)]:
+            for _ in range(count):
+                hitters.add(key)
+        hitters.add('b', 4)
+
+        self.assertEqual(hitters.total, 13)
+        self.assertEqual(hitters.top(2), [('b', 7, 0), ('a', 5, 0)])
+        self.assertEqual(hitters.top(10), [('b', 7, 0), ('a', 5, 0), ('c', 1, 0)])
+
+    def test_bounded(self):
+        hitters = HeavyHitters(capacity=10)
+        rng = random.Random(42)
+        exact = {}
+        for i in xrange(20000):
+            # A few heavy keys among many rare ones
+            key = 'heavy%d' % (i % 3) if i % 4 == 0 else 'rare%d' % rng.randint(0, 5000)
+            exact[key] = exact.get(key, 0) + 1
+            hitters.add(key)
+            self.assertLess(len(hitters), 20)
+
+        top = hitters.top(3)
+        self.assertEqual(sorted(key for key, _, _ in top), ['heavy0', 'heavy1', 'heavy2'])
+        for key, count, error in top:
+            self.assertLessEqual(count - error, exact[key])
+            self.assertGreaterEqual(count, exact[key])
+
+    def test_merge(self):
+        hitters = HeavyHitters(capacity=10)
+        other = HeavyHitters(capacity=10)
+        hitters.add('a', 5)
+        hitters.add('b', 1)
+        other.add('a', 2)
+        other.add('c', 3)
+
+        hitters.merge(other)
+        self.assertEqual(hitters.total, 11)
+        self.assertEqual(hitters.top(3), [('a', 7, 0), ('c', 3, 0), ('b', 1, 0)])
+
+        # The keys missing from an evicted sketch may have been counted in it
+        evicted = HeavyHitters(capacity=1)
+        evicted.add('c', 4)
+        evicted.add('d', 1)
+        evicted.add('e', 2)
+        hitters.merge(evicted)
+        counts = dict((key, (count, error)) for key, count, error in hitters.top(10))
+        self.assertEqual(counts['a'], (7 + evicted.floor, evicted.floor))
+        self.assertEqual(counts['c'][0], 7)
@@ -4,8 +4,8 @@
 
 # stdlib
 from datetime import datetime, timedelta
+import heapq
 import logging
-from operator import attrgetter
 import sys
 import time
 
@@ -21,6 +21,12 @@ log = logging.getLogger(__name__)
 FLUSH_LOGGING_PERIOD = 20
 FLUSH_LOGGING_INITIAL = 5
 
+# The eviction queue is rebuilt when it has this many entries more than twice
+# the number of transactions, most being outdated
+COMPACT_THRESHOLD = 100
+
+EPOCH = datetime(1970, 1, 1)
+
 class Transaction(object):
 
     def __init__(self):
@@ -70,7 +76,13 @@ class Transaction(object):
 
 class TransactionManager(object):
     """Holds any transaction derived object list and make sure they
-       are all commited, without exceeding parameters (throttling, memory consumption) """
+       are all commited, without exceeding parameters (throttling, memory consumption)
+
+       Transactions are indexed by id, and scheduled in two heaps: one by next
+       flush to find the ones to flush, one by latest next flush to find the
+       ones to evict when the queue is too big. Rescheduling a transaction
+       doesn't update its entries in the heaps, it adds new ones: the outdated
+       ones are skipped when they're popped. """
 
     def __init__(self, max_wait_for_replay, max_queue_size, throttling_delay,
                  max_parallelism=1, max_endpoint_errors=4):
@@ -83,7 +95,14 @@ class TransactionManager(object):
 
         self._flush_without_ioloop = False # useful for tests
 
-        self._transactions = []  # List of all non commited transactions
+        self._transactions = {}  # All non commited transactions, by id
+        # Heap of (next flush, id, schedule) of the transactions waiting to be flushed
+        self._flush_queue = []
+        # Heap of (-next flush timestamp, id, schedule) of all the transactions
+        self._evict_queue = []
+        # Current schedule of each transaction, to tell the outdated heap entries
+        self._schedules = {}
+        self._schedule_count = 0
         self._total_count = 0  # Maintain size/count not to recompute it everytime
         self._total_size = 0
         self._flush_count = 0
@@ -108,7 +127,7 @@ class TransactionManager(object):
         ForwarderStatus().persist()
 
     def get_transactions(self):
-        return self._transactions
+        return self._transactions.values()
 
     def print_queue_stats(self):
         log.debug("Queue size: at %s, %s transaction(s), %s KB" %
@@ -131,14 +150,16 @@ class TransactionManager(object):
 
         if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
             log.warn("Queue is too big, removing old transactions...")
-            new_trs = sorted(self._transactions,key=attrgetter('_next_flush'), reverse = True)
-            for tr2 in new_trs:
-                if (self._total_size + tr_size) > self._MAX_QUEUE_SIZE:
-                    self._remove(tr2)
-                    log.warn("Removed transaction %s from queue" % tr2.get_id())
+            # The ones to be flushed the latest go first
+            while (self._total_size + tr_size) > self._MAX_QUEUE_SIZE and self._evict_queue:
+                _, tr_id, schedule = heapq.heappop(self._evict_queue)
+                if self._schedules.get(tr_id) == schedule:
+                    self._remove(self._transactions[tr_id])
+                    log.warn("Removed transaction %s from queue" % tr_id)
 
         # Done
-        self._transactions.append(tr)
+        self._transactions[tr.get_id()] = tr
+        self._schedule(tr)
         self._total_count += 1
         self._transactions_received += 1
         self._total_size = self._total_size + tr_size
@@ -146,14 +167,34 @@ class TransactionManager(object):
         log.debug("Transaction %s added" % (tr.get_id()))
         self.print_queue_stats()
 
+    def _schedule(self, tr):
+        '''Queue the transaction to be flushed at its next flush'''
+        tr_id = tr.get_id()
+        if tr_id not in self._transactions:
+            # Removed while it was being flushed
+            return
+
+        self._schedule_count += 1
+        self._schedules[tr_id] = self._schedule_count
+        next_flush = tr.get_next_flush()
+        heapq.heappush(self._flush_queue, (next_flush, tr_id, self._schedule_count))
+        heapq.heappush(self._evict_queue,
+                       (-(next_flush - EPOCH).total_seconds(), tr_id, self._schedule_count))
+
+        if len(self._evict_queue) > 2 * len(self._transactions) + COMPACT_THRESHOLD:
+            self._evict_queue = [
+                entry for entry in self._evict_queue if self._schedules.get(entry[1]) == entry[2]
+            ]
+            heapq.heapify(self._evict_queue)
+
     def _remove(self, tr):
         '''Safely remove transaction from list'''
-        try:
-            self._transactions.remove(tr)
-        except ValueError:
+        if self._transactions.pop(tr.get_id(), None) is None:
             # Should not happen if we order the queue consistently, but we should catch the error anyway
             log.warn("Tried to remove transaction %s from queue but it was not in the queue anymore.", tr.get_id())
         else:
+            # Its entries in the heaps are outdated from now on
+            del self._schedules[tr.get_id()]
             self._total_count -= 1
             self._total_size -= tr.get_size()
 
@@ -166,9 +207,11 @@ class TransactionManager(object):
         to_flush = []
         # Do we have something to do ?
         now = datetime.utcnow()
-        for tr in self._transactions:
-            if tr.time_to_flush(now):
-                to_flush.append(tr)
+        while self._flush_queue and self._flush_queue[0][0] <= now:
+            _, tr_id, schedule = heapq.heappop(self._flush_queue)
+            if self._schedules.get(tr_id) == schedule:
+                # Scheduled again once it's flushed, unless it's successful
+                to_flush.append(self._transactions[tr_id])
 
         count = len(to_flush)
         should_log = self._flush_count + 1 <= FLUSH_LOGGING_INITIAL or (self._flush_count + 1) % FLUSH_LOGGING_PERIOD == 0
@@ -214,6 +257,7 @@ class TransactionManager(object):
                     # Recompute these transactions' next flush so that if we hit the max queue size
                     # newer transactions are preserved
                     tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+                    self._schedule(tr)
                 self._trs_to_flush = []
                 return self.flush_next()
 
@@ -261,6 +305,7 @@ class TransactionManager(object):
         self._finished_flushes += 1
         tr.inc_error_count()
         tr.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+        self._schedule(tr)
         log.warn("Transaction %d in error (%s error%s), it will be replayed after %s",
                  tr.get_id(),
                  tr.get_error_count(),
@@ -276,6 +321,7 @@ class TransactionManager(object):
                     new_trs_to_flush.append(transaction)
                 else:
                     transaction.compute_next_flush(self._MAX_WAIT_FOR_REPLAY)
+                    self._schedule(transaction)
             log.debug('Endpoint %s seems down, removed %s transaction from current flush',
                       tr._endpoint,
                       len(self._trs_to_flush) - len(new_trs_to_flush))
@@ -0,0 +1,79 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+import copy
+
+# Types that can't be modified and don't need to be copied
+IMMUTABLE_TYPES = (basestring, int, long, float, bool, type(None))
+
+
+class MutationGuard(object):
+    """ Tells whether any container of a guarded copy has been modified """
+    __slots__ = ('mutated',)
+
+    def __init__(self):
+        self.mutated = False
+
+
+def _mutating(method_name, base):
+    method = getattr(base, method_name)
+
+    def mutating_method(self, *args, **kwargs):
+        self._guard.mutated = True
+        return method(self, *args, **kwargs)
+
+    mutating_method.__name__ = method_name
+    return mutating_method
+
+
+class GuardedDict(dict):
+    """ A dict that flags its guard when it's modified """
+    __slots__ = ('_guard',)
+
+    def __reduce__(self):
+        # Copies and pickles are plain dicts
+        return dict, (dict(self),)
+
+
+class GuardedList(list):
+    """ A list that flags its guard when it's modified """
+    __slots__ = ('_guard',)
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+for _name in ('__setitem__', '__delitem__', 'clear', 'pop', 'popitem',
+              'setdefault', 'update'):
+    setattr(GuardedDict, _name, _mutating(_name, dict))
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'reverse', 'sort'):
+    setattr(GuardedList, _name, _mutating(_name, list))
+
+
+def guarded_copy(obj, guard):
+    """
+    Return a deep copy of `obj`, a structure of dicts, lists and tuples like
+    the ones loaded from YAML, whose dicts and lists set `guard.mutated` when
+    they are modified. Other mutable objects are deep copied, their changes
+    aren't tracked.
+    """
+    if isinstance(obj, IMMUTABLE_TYPES):
+        return obj
+    if isinstance(obj, dict):
+        guarded = GuardedDict()
+        dict.update(guarded, ((k, guarded_copy(v, guard)) for k, v in obj.iteritems()))
+    elif isinstance(obj, list):
+        guarded = GuardedList()
+        list.extend(guarded, (guarded_copy(v, guard) for v in obj))
+    elif isinstance(obj, tuple):
+        return tuple(guarded_copy(v, guard) for v in obj)
+    else:
+        return copy.deepcopy(obj)
+
+    guarded._guard = guard
+    return guarded
@@ -4,8 +4,10 @@
 
 # stdlib
 from functools import wraps
+import logging
 from logging import LogRecord
 import re
+import threading
 
 # project
 import config
@@ -29,6 +31,18 @@ def log_exceptions(logger):
         return wrapper
     return decorator
 
+def reset_logging_locks():
+    """
+    Replace the locks of the logging module and handlers in a forked
+    process: another thread of the parent may have held them at fork time,
+    they would never be released in the child.
+    """
+    logging._lock = threading.RLock()
+    for handler_ref in logging._handlerList:
+        handler = handler_ref()
+        if handler is not None:
+            handler.createLock()
+
 class DisableLoggerInit():
     '''
     Context manager to disable the logging initialization.
@@ -0,0 +1,87 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# Fields of the linked list entries
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+
+class LRUCache(object):
+    """
+    A dict-like cache holding at most `max_size` entries, evicting the least
+    recently used one when full. A `max_size` of 0 disables the cache.
+
+    Entries are kept in a circular doubly linked list of
+    [prev, next, key, value] lists, most recently used last, so that both
+    `get` and `set` are O(1).
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        # Move the entry to the most recently used end
+        prev_entry, next_entry = entry[PREV], entry[NEXT]
+        prev_entry[NEXT] = next_entry
+        next_entry[PREV] = prev_entry
+        root = self._root
+        last = root[PREV]
+        last[NEXT] = root[PREV] = entry
+        entry[PREV] = last
+        entry[NEXT] = root
+
+        return entry[VALUE]
+
+    def set(self, key, value):
+        if not self.max_size:
+            return
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[VALUE] = value
+            return
+
+        root = self._root
+        if len(self._entries) >= self.max_size:
+            # Evict the least recently used entry
+            oldest = root[NEXT]
+            del self._entries[oldest[KEY]]
+            root[NEXT] = oldest[NEXT]
+            oldest[NEXT][PREV] = root
+            self.evictions += 1
+
+        last = root[PREV]
+        entry = [last, root, key, value]
+        last[NEXT] = root[PREV] = self._entries[key] = entry
+
+    def clear(self):
+        self._entries.clear()
+        self._root[:] = [self._root, self._root, None, None]
+
+    def flush_stats(self):
+        """
+        Return the (hits, misses, evictions) counts since the last call and
+        reset them.
+        """
+        stats = (self.hits, self.misses, self.evictions)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        return stats
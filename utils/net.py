@@ -4,6 +4,7 @@
 
 # lib
 import ctypes
+import os
 import time
 import random
 import socket
@@ -29,6 +30,10 @@ try:
 except AttributeError:
     IPV6_V6ONLY = 27  # from `Ws2ipdef.h`
 
+# SO_REUSEPORT isn't available on every platform (e.g. Windows), and is only
+# supported by Linux since kernel 3.9
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', None)
+
 DEFAULT_DNS_TTL = 300
 
 class Sockaddr(ctypes.Structure):
@@ -62,6 +67,34 @@ class DNSCache(object):
 
         return resolve
 
+def get_udp_socket_drops(sock, procfs_path='/proc'):
+    """
+    Return the number of datagrams dropped by the kernel for `sock`, read
+    from the `drops` column of `/proc/net/udp` and `/proc/net/udp6`.
+    Only available on Linux, return None when the counter can't be found.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except Exception:
+        return None
+
+    for proto in ('udp', 'udp6'):
+        try:
+            with open(os.path.join(procfs_path, 'net', proto)) as f:
+                # skip the header
+                next(f, None)
+                for line in f:
+                    fields = line.split()
+                    # sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+                    # retrnsmt uid timeout inode ref pointer drops
+                    if len(fields) >= 13 and fields[9] == inode:
+                        return int(fields[12])
+        except (IOError, OSError, ValueError):
+            continue
+
+    return None
+
+
 def _inet_pton_win(address_family, ip_string):
     """
     Window specific version of `inet_pton` based on:
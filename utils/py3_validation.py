@@ -0,0 +1,169 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+import atexit
+import hashlib
+import logging
+import Queue
+import sys
+import threading
+
+# 3p
+import simplejson as json
+
+# project
+from utils.subprocess_output import (
+    get_subprocess_output,
+    SubprocessOutputEmptyError,
+)
+
+log = logging.getLogger(__name__)
+
+PY3_COMPATIBILITY_ATTR = 'py3_compatible'
+PY3_COMPATIBILITY_READY = 'ready'
+PY3_COMPATIBILITY_NOT_READY = 'not_ready'
+PY3_COMPATIBILITY_UNKNOWN = 'unknown'
+
+# pylint runs are CPU bound, a couple of them at a time is enough
+DEFAULT_WORKERS = 2
+
+
+def file_digest(file_path):
+    """ SHA-1 of the content of a file """
+    sha = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), ''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def validate_py3(file_path):
+    """ Run `pylint --py3k` on a file, return its Python 3 compatibility """
+    try:
+        output, _, _ = get_subprocess_output(
+            [sys.executable, "-m", "pylint", "-f", "json", "--py3k", "-d", "W1618", "--persistent", "no", "--exit-zero", file_path], log)
+        warnings = json.loads(output)
+    except SubprocessOutputEmptyError:
+        # old versions of pylint return an empty output to indicate there are no warnings
+        return PY3_COMPATIBILITY_READY
+    except Exception as e:
+        log.error("error running 'validate' on custom check: %s", e)
+        return PY3_COMPATIBILITY_UNKNOWN
+
+    if warnings:
+        return PY3_COMPATIBILITY_NOT_READY
+    return PY3_COMPATIBILITY_READY
+
+
+class Py3Validation(object):
+    """
+    Validates the Python 3 compatibility of check files in background
+    threads, and sets it as the `py3_compatible` attribute of their checks
+    once known. The results are cached by file path and content hash, in
+    `cache_path` if given, so a file is only validated again when it changes.
+    """
+
+    def __init__(self, cache_path=None, workers=DEFAULT_WORKERS):
+        self._cache_path = cache_path
+        # file path -> (digest, compatibility)
+        self._cache = self._load_cache()
+        # (file path, digest) -> checks waiting for its validation
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._queue = Queue.Queue()
+        self._workers = workers
+        self._threads = []
+        self._stopped = False
+        atexit.register(self.stop)
+
+    def _load_cache(self):
+        if not self._cache_path:
+            return {}
+        try:
+            with open(self._cache_path) as f:
+                return dict((path, tuple(result)) for path, result in json.load(f).iteritems())
+        except IOError:
+            return {}
+        except Exception:
+            log.warning("Can't load the cached py3 validations", exc_info=True)
+            return {}
+
+    def _save_cache(self):
+        if not self._cache_path:
+            return
+        try:
+            with open(self._cache_path, 'w') as f:
+                json.dump(self._cache, f)
+        except Exception:
+            log.warning("Can't save the cached py3 validations", exc_info=True)
+
+    def _start_workers(self):
+        while len(self._threads) < self._workers:
+            thread = threading.Thread(target=self._work, name="Py3Validation-%d" % len(self._threads))
+            # Validations left at exit are just dropped
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def validate(self, check, file_path):
+        """
+        Set the Python 3 compatibility of the `check` loaded from `file_path`
+        right away if it's cached, in the background otherwise. Never blocks.
+        """
+        try:
+            digest = file_digest(file_path)
+        except Exception as e:
+            log.error("error running 'validate' on custom check: %s", e)
+            setattr(check, PY3_COMPATIBILITY_ATTR, PY3_COMPATIBILITY_UNKNOWN)
+            return
+
+        with self._lock:
+            cached = self._cache.get(file_path)
+            if cached is not None and cached[0] == digest:
+                setattr(check, PY3_COMPATIBILITY_ATTR, cached[1])
+                return
+
+            key = (file_path, digest)
+            waiting = self._pending.get(key)
+            if waiting is not None:
+                waiting.append(check)
+                return
+            self._pending[key] = [check]
+            self._start_workers()
+        self._queue.put(key)
+
+    def _work(self):
+        while not self._stopped:
+            file_path, digest = self._queue.get()
+            try:
+                compatibility = validate_py3(file_path)
+            except Exception:
+                if self._stopped:
+                    return
+                # Don't let it kill the worker, nor leave the checks waiting forever
+                log.exception("Can't validate the py3 compatibility of %s", file_path)
+                compatibility = PY3_COMPATIBILITY_UNKNOWN
+            if self._stopped:
+                # The interpreter is exiting, its modules may be torn down already
+                return
+            try:
+                with self._lock:
+                    for check in self._pending.pop((file_path, digest), []):
+                        setattr(check, PY3_COMPATIBILITY_ATTR, compatibility)
+                    # pylint couldn't run, it's worth trying again at the next load
+                    if compatibility != PY3_COMPATIBILITY_UNKNOWN:
+                        self._cache[file_path] = (digest, compatibility)
+                        self._save_cache()
+                log.debug("Validated %s: %s", file_path, compatibility)
+            finally:
+                self._queue.task_done()
+
+    def stop(self):
+        """ Drop the pending validations """
+        self._stopped = True
+
+    def join(self):
+        """ Wait for the pending validations """
+        self._queue.join()
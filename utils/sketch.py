@@ -0,0 +1,210 @@
+# (C) Datadog, Inc. 2010-2017
+# All rights reserved
+# Licensed under Simplified BSD License (see LICENSE)
+
+# stdlib
+from heapq import nlargest
+from math import ceil, log
+from operator import itemgetter
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+DEFAULT_MAX_BINS = 2048
+
+DEFAULT_HEAVY_HITTERS_CAPACITY = 1000
+
+# Values closer to zero than this are counted as zeros
+MIN_INDEXABLE_VALUE = 1e-9
+
+
+class QuantileSketch(object):
+    """
+    A DDSketch-like quantile sketch.
+
+    Values are counted in bins whose boundaries grow geometrically, so that
+    the value returned for any rank is within `relative_accuracy` of the
+    exact value at that rank, e.g. within 1% for the default accuracy.
+    Memory is bounded by `max_bins` per sign, whatever the number of values
+    added: with the default settings the guarantee holds for values spanning
+    17 orders of magnitude, past that the lowest bins are collapsed and only
+    the highest values keep the guarantee.
+    """
+    __slots__ = ('relative_accuracy', 'max_bins', 'gamma', 'log_gamma',
+                 'count', 'zero_count', 'positive_bins', 'negative_bins')
+
+    def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = log(self.gamma)
+
+        self.count = 0
+        self.zero_count = 0
+        self.positive_bins = {}
+        self.negative_bins = {}
+
+    def _key(self, value):
+        return int(ceil(log(value) / self.log_gamma))
+
+    def _value(self, key):
+        # The middle of the bin, in relative terms
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def _add_to_bins(self, bins, key, count):
+        if key in bins:
+            bins[key] += count
+            return
+
+        bins[key] = count
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def _collapse(self, bins):
+        """ Merge the lowest bins together to get back to `max_bins` """
+        keys = sorted(bins)
+        collapsed_key = keys[-self.max_bins]
+        for key in keys[:-self.max_bins]:
+            bins[collapsed_key] += bins.pop(key)
+
+    def add(self, value):
+        self.count += 1
+        if value > MIN_INDEXABLE_VALUE:
+            bins = self.positive_bins
+        elif value < -MIN_INDEXABLE_VALUE:
+            bins = self.negative_bins
+            value = -value
+        else:
+            self.zero_count += 1
+            return
+
+        # Inlined `_key` and `_add_to_bins`, this is called for every sample
+        key = int(ceil(log(value) / self.log_gamma))
+        if key in bins:
+            bins[key] += 1
+        else:
+            self._add_to_bins(bins, key, 1)
+
+    def merge(self, other):
+        """ Add the values of a sketch with the same accuracy to this one """
+        self.count += other.count
+        self.zero_count += other.zero_count
+        for key, count in other.positive_bins.iteritems():
+            self._add_to_bins(self.positive_bins, key, count)
+        for key, count in other.negative_bins.iteritems():
+            self._add_to_bins(self.negative_bins, key, count)
+
+    def value_at_rank(self, rank):
+        """
+        Return an approximation of the value that would be at index `rank`
+        (between 0 and count - 1) in the sorted list of the values added.
+        """
+        if not self.count:
+            return None
+
+        seen = 0
+        # The highest negative keys are the lowest values
+        for key in sorted(self.negative_bins, reverse=True):
+            seen += self.negative_bins[key]
+            if seen > rank:
+                return -self._value(key)
+
+        seen += self.zero_count
+        if seen > rank:
+            return 0
+
+        keys = sorted(self.positive_bins)
+        for key in keys:
+            seen += self.positive_bins[key]
+            if seen > rank:
+                return self._value(key)
+
+        if keys:
+            return self._value(keys[-1])
+        return 0
+
+
+class HeavyHitters(object):
+    """
+    A Space-Saving heavy hitters sketch: counts keys, keeping the ones counted
+    the most, whatever the number of distinct keys added.
+
+    Between `capacity` and twice as many keys are kept: when full, the least
+    counted half is evicted at once so that adding a key is O(1) amortized.
+    A key added after an eviction may have been counted and evicted before,
+    so it starts at the highest count evicted, which is its error: the exact
+    count of a key is between its count minus its error and its count. Any
+    key counted more than `total / capacity` times is kept.
+    """
+    __slots__ = ('capacity', 'total', 'counts', 'errors', 'floor')
+
+    def __init__(self, capacity=DEFAULT_HEAVY_HITTERS_CAPACITY):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        # Errors of the keys added after an eviction
+        self.errors = {}
+        # Highest count evicted
+        self.floor = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def add(self, key, count=1):
+        self.total += count
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+            return
+
+        self._add_new(key, count, 0)
+
+    def _add_new(self, key, count, error):
+        floor = self.floor
+        self.counts[key] = floor + count
+        if floor or error:
+            self.errors[key] = floor + error
+        if len(self.counts) >= 2 * self.capacity:
+            self._evict()
+
+    def _evict(self):
+        """ Keep the `capacity` keys counted the most """
+        ranked = sorted(self.counts.iteritems(), key=itemgetter(1), reverse=True)
+        self.floor = ranked[self.capacity][1]
+        counts = self.counts
+        errors = self.errors
+        for key, _ in ranked[self.capacity:]:
+            del counts[key]
+            errors.pop(key, None)
+
+    def merge(self, other):
+        """ Add the counts of another sketch to this one """
+        self.total += other.total
+        counts = self.counts
+        errors = self.errors
+        other_counts = other.counts
+        other_errors = other.errors
+
+        # The keys missing from the other sketch may have been evicted from it
+        if other.floor:
+            for key in counts:
+                if key not in other_counts:
+                    counts[key] += other.floor
+                    errors[key] = errors.get(key, 0) + other.floor
+
+        for key, count in other_counts.iteritems():
+            error = other_errors.get(key, 0)
+            if key in counts:
+                counts[key] += count
+                if error:
+                    errors[key] = errors.get(key, 0) + error
+            else:
+                self._add_new(key, count, error)
+
+    def top(self, k):
+        """
+        Return the (key, count, error) of the `k` keys counted the most,
+        highest count first.
+        """
+        errors = self.errors
+        # `items` copies the counts at once, they can be read from another thread
+        return [(key, count, errors.get(key, 0))
+                for key, count in nlargest(k, self.counts.items(), key=itemgetter(1))]
@@ -4,103 +4,169 @@
 
 import binascii
 import os
-from stat import ST_INO, ST_SIZE
 
 
 class TailFile(object):
 
     CRC_SIZE = 16
+    # Size of the reads, lines are split a chunk at a time
+    CHUNK_SIZE = 1024 * 1024
 
     def __init__(self, logger, path, callback):
         self._path = path
-        self._f = None
+        # Read unbuffered, a buffer could hold data the file doesn't have anymore
+        self._fd = None
         self._inode = None
         self._size = 0
+        # Offset of the end of the last line passed to the callback
+        self._offset = 0
+        # CRC of the first `_crc_size` bytes
+        self._crc_size = 0
         self._crc = None
+        # Lines left to read in the current pass, None if there's no limit
+        self._lines_left = None
         self._log = logger
         self._callback = callback
 
-    def _open_file(self, move_end=False, pos=False):
+    def position(self):
+        """
+        Return the (inode, offset, crc) of the data consumed so far, to resume
+        tailing from there with `tail(position=...)`.
+        """
+        return self._inode, self._offset, self._crc
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _read_crc(self, size):
+        """ CRC of the first `size` bytes of the file """
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        crc = binascii.crc32(os.read(self._fd, size))
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        return crc
+
+    def _update_crc(self):
+        """
+        Keep the CRC of the beginning of the data consumed, to tell when the
+        file is replaced by one of the same size or larger
+        """
+        crc_size = min(self.CRC_SIZE, self._offset)
+        if crc_size != self._crc_size:
+            self._crc = self._read_crc(crc_size) if crc_size else None
+            self._crc_size = crc_size
+
+    def _open_file(self, move_end=False, position=None):
+        self.close()
+        # Binary mode, for the offsets to be byte counts everywhere
+        self._fd = os.open(self._path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        stat = os.fstat(self._fd)
+        self._inode = stat.st_ino
+        self._size = stat.st_size
+        self._offset = 0
+        self._crc_size = 0
+        self._crc = None
 
-        already_open = False
-        # close and reopen to handle logrotate
-        if self._f is not None:
-            self._f.close()
-            self._f = None
-            already_open = True
+        if position is not None:
+            # Rotated or truncated since then, what's there is new
+            move_end = False
+            inode, offset, crc = position
+            crc_size = min(self.CRC_SIZE, offset)
+            if inode == self._inode and offset <= self._size and \
+                    (not crc_size or self._read_crc(crc_size) == crc):
+                self._log.debug("Resuming file %s at %s" % (self._path, offset))
+                self._offset = offset
 
-        stat = os.stat(self._path)
-        inode = stat[ST_INO]
-        size = stat[ST_SIZE]
-
-        # Compute CRC of the beginning of the file
-        crc = None
-        if size >= self.CRC_SIZE:
-            tmp_file = open(self._path, 'r')
-            data = tmp_file.read(self.CRC_SIZE)
-            crc = binascii.crc32(data)
-
-        if already_open:
-            # Check if file has been removed
-            if self._inode is not None and inode != self._inode:
-                self._log.debug("File removed, reopening")
-                move_end = False
-                pos = False
-
-            # Check if file has been truncated
-            elif self._size > 0 and size < self._size:
-                self._log.debug("File truncated, reopening")
-                move_end = False
-                pos = False
-
-            # Check if file has been truncated and too much data has
-            # alrady been written (copytruncate and opened files...)
-            if size >= self.CRC_SIZE and self._crc is not None and crc != self._crc:
-                self._log.debug("Begining of file modified, reopening")
-                move_end = False
-                pos = False
-
-        self._inode = inode
-        self._size = size
-        self._crc = crc
-
-        self._f = open(self._path, 'r')
         if move_end:
             self._log.debug("Opening file %s" % (self._path))
-            self._f.seek(0, os.SEEK_END)
-        elif pos:
-            self._log.debug("Reopening file %s at %s" % (self._path, pos))
-            self._f.seek(pos)
-
-        return True
+            self._offset = self._size
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        self._update_crc()
+
+    def _check_file(self):
+        """
+        Go back to the start of the file if it has been truncated, return
+        whether it has been rotated, in which case the rest of the current
+        one is to be read before opening the new one.
+        """
+        stat = os.stat(self._path)
+        if stat.st_ino != self._inode:
+            self._log.debug("File removed, reopening")
+            return True
+
+        self._size = os.fstat(self._fd).st_size
+        if self._size < self._offset:
+            self._log.debug("File truncated, reopening")
+            self._reset()
+        # Check if file has been truncated and too much data has
+        # already been written (copytruncate and opened files...)
+        elif self._crc_size and self._read_crc(self._crc_size) != self._crc:
+            self._log.debug("Begining of file modified, reopening")
+            self._reset()
+        return False
+
+    def _reset(self):
+        self._offset = 0
+        self._crc_size = 0
+        self._crc = None
+        os.lseek(self._fd, 0, os.SEEK_SET)
+
+    def _read_lines(self, line_by_line):
+        """
+        Pass the complete lines appended to the file to the callback, yield
+        when it returns True if `line_by_line`.
+        """
+        pending = ''
+        while self._lines_left != 0:
+            chunk = os.read(self._fd, self.CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (pending + chunk).split('\n')
+            # The last line is incomplete, it's read again with the next chunk
+            pending = lines.pop()
+            if self._lines_left is not None:
+                # The lines over the limit are read again on the next pass
+                del lines[self._lines_left:]
+                self._lines_left -= len(lines)
+            for line in lines:
+                self._offset += len(line) + 1
+                line = line.strip(chr(0))  # a truncate may have create holes in the file
+                if line.endswith('\r'):
+                    line = line[:-1]
+                if self._callback(line) and line_by_line:
+                    yield True
+        os.lseek(self._fd, self._offset, os.SEEK_SET)
+        self._update_crc()
 
-    def tail(self, line_by_line=True, move_end=True):
+    def tail(self, line_by_line=True, move_end=True, position=None, max_lines=None):
         """Read line-by-line and run callback on each line.
         line_by_line: yield each time a callback has returned True
-        move_end: start from the last line of the log"""
+        move_end: start from the last line of the log
+        position: resume from a `position()`, if it's still the same file
+        max_lines: read at most this many lines before yielding at the end of
+                   a pass, the rest is left for the next ones"""
         try:
-            self._open_file(move_end=move_end)
+            self._open_file(move_end=move_end, position=position)
 
             while True:
-                pos = self._f.tell()
-                line = self._f.readline()
-                if line:
-                    line = line.strip(chr(0))  # a truncate may have create holes in the file
-                    if self._callback(line.rstrip("\n")):
-                        if line_by_line:
-                            yield True
-                            pos = self._f.tell()
-                            self._open_file(move_end=False, pos=pos)
-                        else:
-                            continue
-                    else:
-                        continue
-                else:
-                    yield True
-                    assert pos == self._f.tell()
-                    self._open_file(move_end=False, pos=pos)
+                self._lines_left = max_lines
+                rotated = self._check_file()
+                for result in self._read_lines(line_by_line):
+                    yield result
+                if rotated and self._lines_left != 0:
+                    # What was left in the rotated file is read, on to the new one
+                    self._open_file()
+                    for result in self._read_lines(line_by_line):
+                        yield result
+                if self._lines_left == 0:
+                    self._log.debug("Read %s lines of %s, leaving the rest for the next pass"
+                                    % (max_lines, self._path))
+                yield True
 
         except Exception as e:
             # log but survive
             self._log.exception(e)
             raise StopIteration(e)
+        finally:
+            self.close()